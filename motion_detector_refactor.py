@@ -1,10 +1,16 @@
 # USAGE
 # python motion_detector.py
 # python motion_detector.py --video videos/example_01.mp4
+# python motion_detector_refactor.py --cameras cameras.json
+#
+# Needs OpenCV (cv2), numpy and imutils. PyAV is optional and only needed
+# for --record-mode copy: pip install av
 
 # import the necessary packages
 import argparse
-from threading import Thread
+from threading import Thread, Condition, Lock
+from collections import deque
+from queue import Queue
 import datetime
 import imutils
 import time
@@ -19,26 +25,110 @@ import subprocess
 import tty
 import termios
 import os
+import shutil
 import signal
+import socket
+import struct
+import tempfile
+import multiprocessing
+import tracemalloc
+import resource
+import bisect
+import sqlite3
+import ctypes
+import ctypes.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+# PyAV is only needed for --record-mode copy
+try:
+	import av
+except ImportError:
+	av = None
 
 # construct the argument parser and parse the arguments
-ap = argparse.ArgumentParser()
-ap.add_argument("-v", "--video", help="path to the video file")
-ap.add_argument("-u", "--show-video", action="store_true")
-ap.add_argument("-a", "--min-area", type=int, default=1000, help="minimum area size")
-ap.add_argument("-m", "--max-area", type=int, default=11500, help="maximum area size")
-ap.add_argument("-b", "--blend-rate", type=int, default=3, help="background image blend rate. Higher is faster")
-ap.add_argument("-f", "--filename", type=str, default="motion_%Y-%m-%d_%H-%M-%S", help="strftime() string to use for capture file names")
-ap.add_argument("-c", "--codec", type=str, default="XVID", help="Codec to use for output videos")
-ap.add_argument("-l", "--motion-buffer", type=int, default=20, help="number of frames to capture after movement ends")
-ap.add_argument("-j", "--polygon-json", default="zones.json", help="Polygon zones file")
-ap.add_argument("-d", "--debug", action="store_true", help="Debug image stream and polygons")
-ap.add_argument("-r", "--resolution", type=float, default=1.0, help="Resolution multiplier. Use to reduce CPU utilization.")
-ap.add_argument("-p", "--filepath", type=str, default="/motiondata/motioneye/Camera1/%Y-%m-%d/", help="Folder path to store screenshots and video. In strftime format.")
-ap.add_argument("-M", "--max-hitseconds", type=int, default=20, help="The maximum amount of time before forcing a keyframe reset. Does not interrupt active events.")
-ap.add_argument("-z", "--zabbix-server", type=str, default="192.168.6.6", help="The zabbix server to send events to")
-ap.add_argument("-H", "--zabbix-name", type=str, default="Front Camera", help="The name of the zabbix item to report events under")
-args = vars(ap.parse_args())
+def parseArguments(argv=None):
+	ap = argparse.ArgumentParser()
+	ap.add_argument("-v", "--video", help="path to the video file")
+	ap.add_argument("--record-video", help="Higher resolution stream of the same camera to record and snapshot. --video is then only used for detection, and zones are drawn on this stream")
+	ap.add_argument("--stream-offset", type=float, default=0.0, help="Seconds the --record-video stream arrives behind --video")
+	ap.add_argument("--max-stream-skew", type=float, default=0.25, help="Largest time difference in seconds between a detection frame and the recorded frame used for it. Without a close enough frame, the detection frame is scaled up instead")
+	ap.add_argument("-u", "--show-video", action="store_true")
+	ap.add_argument("-a", "--min-area", type=int, default=1000, help="minimum area size")
+	ap.add_argument("-m", "--max-area", type=int, default=0, help="maximum area size. 0 for no maximum")
+	ap.add_argument("-b", "--blend-rate", type=int, default=3, help="background image blend rate. Higher is faster")
+	ap.add_argument("--background-model", type=str, default="accumulate", choices=["accumulate", "blend", "median", "mog2", "knn"], help="How to model the background. blend is the original uint8 key frame")
+	ap.add_argument("--background-interval", type=float, default=0.2, help="Seconds between background updates. The blend rate applies per interval")
+	ap.add_argument("--background-samples", type=int, default=9, help="Number of updates the median background model keeps")
+	ap.add_argument("--benchmark-background", action="store_true", help="Run the video through every background model and print the cost and number of contours of each")
+	ap.add_argument("-f", "--filename", type=str, default="motion_%Y-%m-%d_%H-%M-%S", help="strftime() string to use for capture file names")
+	ap.add_argument("-c", "--codec", type=str, default="XVID", help="Codec to use for output videos")
+	ap.add_argument("--record-mode", type=str, default="encode", choices=["encode", "copy"], help="encode: decode, annotate and re-encode recorded frames with --codec. copy: write the camera's compressed stream as it is, which needs PyAV")
+	ap.add_argument("--copy-container", type=str, default="mp4", choices=["mp4", "mkv"], help="File format of clips recorded with --record-mode copy")
+	ap.add_argument("--overlay-sidecar", action="store_true", help="With --record-mode copy, write the detected objects and zone states of every processed frame next to each clip as JSON lines")
+	ap.add_argument("--writer-queue", type=int, default=64, help="Number of frames that may wait for the video encoder before frames are dropped")
+	ap.add_argument("--encoder-workers", type=int, default=1, help="Number of threads encoding video clips")
+	ap.add_argument("--clip-seconds", type=int, default=0, help="Split long recordings into clips of this many seconds. 0 to disable")
+	ap.add_argument("--event-db", type=str, default=None, help="SQLite file to index zone state changes, events, snapshots and clips in")
+	ap.add_argument("--query-events", action="store_true", help="List the events in --event-db matching the --query options, with their files, and exit")
+	ap.add_argument("--query-zone", type=str, default=None, help="Only events in which this zone was active")
+	ap.add_argument("--query-camera", type=str, default=None, help="Only events of the camera with this --zabbix-name")
+	ap.add_argument("--query-since", type=str, default=None, help="Only events starting after this time: YYYY-MM-DD[ HH:MM[:SS]], or a number of seconds, minutes, hours or days ago like 90m or 7d")
+	ap.add_argument("--query-until", type=str, default=None, help="Only events starting before this time, in the same formats as --query-since")
+	ap.add_argument("--query-min-duration", type=float, default=None, help="Only events lasting at least this many seconds")
+	ap.add_argument("--query-max-duration", type=float, default=None, help="Only events lasting at most this many seconds")
+	ap.add_argument("--dvr-dir", type=str, default=None, help="Record continuously into fixed-length segments in this folder. Events are then logged to events.jsonl there as time ranges of the segments instead of being recorded as clips")
+	ap.add_argument("--dvr-segment-seconds", type=float, default=60, help="Length of each --dvr-dir segment")
+	ap.add_argument("--dvr-max-gb", type=float, default=20.0, help="Delete the oldest segments when --dvr-dir holds more than this")
+	ap.add_argument("--dvr-max-hours", type=float, default=24.0, help="Delete segments older than this")
+	ap.add_argument("-l", "--motion-buffer", type=float, default=3, help="Seconds of footage from before an event to include at the start of each recording")
+	ap.add_argument("--motion-buffer-scale", type=float, default=1.0, help="Resolution multiplier for the frames kept in the motion buffer")
+	ap.add_argument("--motion-buffer-quality", type=int, default=80, help="JPEG quality of the frames kept in the motion buffer")
+	ap.add_argument("-j", "--polygon-json", default="zones.json", help="Polygon zones file")
+	ap.add_argument("--zone-reload-interval", type=float, default=1.0, help="Seconds between checks of --polygon-json for changes when inotify is not available. 0 to never reload the zones")
+	ap.add_argument("-d", "--debug", action="store_true", help="Debug image stream and polygons")
+	ap.add_argument("-r", "--resolution", type=float, default=1.0, help="Resolution multiplier. Use to reduce CPU utilization.")
+	ap.add_argument("--grey-first", action="store_true", help="Convert to greyscale before downscaling instead of after")
+	ap.add_argument("--downscale", type=str, default="linear", choices=["linear", "area", "pyramid"], help="How to shrink frames to the working resolution. pyramid uses pyrDown, which also smooths")
+	ap.add_argument("--blur", type=str, default="gaussian", choices=["gaussian", "box", "median", "none"], help="Filter used to smooth the working frame")
+	ap.add_argument("--blur-size", type=int, default=21, help="Kernel size of the smoothing filter")
+	ap.add_argument("--mask-scale", type=float, default=1.0, help="Resolution multiplier for dilating the motion mask and finding contours")
+	ap.add_argument("--dilate-iterations", type=int, default=2, help="Number of times to dilate the motion mask")
+	ap.add_argument("--blobs", type=str, default="contours", choices=["contours", "components"], help="How to find and measure moving areas: contours with findContours, or components with connectedComponentsWithStats, which filters them without a Python loop")
+	ap.add_argument("--benchmark-blobs", action="store_true", help="Find the moving areas of --video with both --blobs methods and check that they agree")
+	ap.add_argument("--benchmark-preprocess", action="store_true", help="Run the video through the configured and the original preprocessing and print the cost of each stage and how well they agree")
+	ap.add_argument("--metrics-port", type=int, default=0, help="Time every pipeline stage and serve the latencies in Prometheus format on this port. 0 to disable")
+	ap.add_argument("--metrics-address", type=str, default="127.0.0.1", help="Address the metrics endpoint listens on")
+	ap.add_argument("--metrics-zabbix-interval", type=float, default=0, help="Time every pipeline stage and send p50/p95/p99/max to Zabbix every this many seconds. 0 to disable")
+	ap.add_argument("--replay", action="store_true", help="Run --video, a file or a directory of images, through the whole pipeline as fast as possible without sending anything, and report timings and zone changes as JSON")
+	ap.add_argument("--replay-report", type=str, default="-", help="Where to write the --replay report. - for the console")
+	ap.add_argument("--benchmark-allocations", action="store_true", help="Replay --video, measure how much memory each frame allocates end to end and fail when the median frame is over --allocation-budget")
+	ap.add_argument("--allocation-budget", type=float, default=64, help="kB that detection may allocate per frame in --benchmark-allocations")
+	ap.add_argument("--zone-engine", type=str, default="objects", choices=["objects", "vector"], help="Run the zone state machines one Zone object at a time, or all at once on numpy arrays")
+	ap.add_argument("--zone-conformance", action="store_true", help="Replay --video with both zone engines and check that they change zone states identically")
+	ap.add_argument("--crop-to-zones", action="store_true", help="Only run detection on the part of the frame that can affect a zone")
+	ap.add_argument("--crop-conformance", action="store_true", help="Replay --video on the whole frame and cropped to the zones and check that every zone sees the same blobs")
+	ap.add_argument("--crop-margin", type=int, default=32, help="Extra pixels around the zones to include when cropping. Frames with motion near the edge of the crop are processed whole, which a wider margin makes less frequent")
+	ap.add_argument("-p", "--filepath", type=str, default="/motiondata/motioneye/Camera1/%Y-%m-%d/", help="Folder path to store screenshots and video. In strftime format.")
+	ap.add_argument("--s3-bucket", type=str, default="s3://motion.aws.bradwoodward.io/", help="Upload destination for snapshots and clips. Overridden by 's3_bucket' in the zones file")
+	ap.add_argument("--upload-spool", type=str, default="/motiondata/upload_spool/", help="Folder holding queued uploads, so they survive restarts")
+	ap.add_argument("--upload-script", type=str, default="/motiondata/s3_upload.sh", help="Script used to upload files to s3:// destinations")
+	ap.add_argument("--upload-workers", type=int, default=2, help="Number of uploads to run at once")
+	ap.add_argument("--upload-concurrency", type=int, default=1, help="Number of uploads to run at once to any one destination")
+	ap.add_argument("-M", "--max-hitseconds", type=int, default=20, help="The maximum amount of time before forcing a keyframe reset. Does not interrupt active events.")
+	ap.add_argument("-z", "--zabbix-server", type=str, default="192.168.6.6", help="The zabbix server to send events to")
+	ap.add_argument("-H", "--zabbix-name", type=str, default="Front Camera", help="The name of the zabbix item to report events under")
+	ap.add_argument("--zabbix-port", type=int, default=10051, help="The zabbix server trapper port")
+	ap.add_argument("-B", "--buffer-size", type=int, default=4, help="Number of captured frames to queue for detection")
+	ap.add_argument("--decode-on-demand", action="store_true", help="Grab every frame from the camera but only decode the ones detection will use")
+	ap.add_argument("--capture-process", action="store_true", help="Capture and decode in a separate process, handing frames over through shared memory")
+	ap.add_argument("--drop-policy", type=str, default="drop-oldest", choices=["drop-oldest", "drop-newest", "block"], help="What to do with new frames when the capture buffer is full")
+	ap.add_argument("--cameras", type=str, default=None, help="JSON file describing several cameras to run in this one process")
+	ap.add_argument("--workers", type=int, default=0, help="Number of detection threads shared by all cameras. Defaults to the number of CPUs")
+	ap.add_argument("--idle-fps", type=float, default=0, help="Frames per second to run detection at while every zone is inactive. 0 to always run at full rate")
+	ap.add_argument("--target-fps", type=float, default=0, help="Frames per second to run detection at when sharing workers with other cameras. 0 for as fast as possible")
+	ap.add_argument("--keyframe-image", type=str, default="/motiondata/last_keyframe.jpg", help="Where to save the initial key frame")
+	return vars(ap.parse_args(argv))
 
 # Define some proper exit strategies
 def unix_hard_exit():
@@ -51,16 +141,18 @@ def install_hard_ctrl_c():
 	signal.signal(signal.SIGINT, sigint_unix_hard_exit_handler)
  
 class FrameCounter:
-	def __init__(self):
+	def __init__(self, clock=None):
 		# store the start time, end time, and total number of frames
 		# that were examined between the start and end intervals
 		self._start = None
 		self._end = None
 		self._numFrames = 0
+		# seconds since the epoch; the wall clock unless replaying
+		self.clock = time.time if clock is None else clock
  
 	def start(self):
 		# start the timer
-		self._start = datetime.datetime.now()
+		self._start = self.clock()
 		return self
  
 	def update(self):
@@ -71,49 +163,655 @@ class FrameCounter:
 	def elapsed(self):
 		# return the total number of seconds between the start and
 		# end interval
-		return (datetime.datetime.now() - self._start).total_seconds()
+		return self.clock() - self._start
  
 	def fps(self):
 		# compute the (approximate) frames per second
 		return self._numFrames / self.elapsed()
 
+# A directory of still images played back like a video file at 'fps'
+# frames a second, in name order. Every image is scaled to the size of
+# the first one.
+class ImageSequence:
+	EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+	def __init__(self, path, fps=20.0):
+		self.fps = fps
+		self.files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if os.path.splitext(name)[1].lower() in self.EXTENSIONS]
+		self.position = -1
+		self.size = None
+
+	def isOpened(self):
+		return len(self.files) > 0
+
+	def grab(self):
+		if self.position + 1 >= len(self.files):
+			return False
+
+		self.position += 1
+		return True
+
+	def retrieve(self, image=None):
+		frame = cv2.imread(self.files[self.position])
+		if frame is None:
+			return (False, None)
+
+		if self.size is None:
+			self.size = (frame.shape[1], frame.shape[0])
+		elif not (frame.shape[1], frame.shape[0]) == self.size:
+			frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+
+		if image is not None and image.shape == frame.shape:
+			image[...] = frame
+			return (True, image)
+
+		return (True, frame)
+
+	def read(self, image=None):
+		if not self.grab():
+			return (False, None)
+
+		return self.retrieve(image)
+
+	def get(self, prop):
+		if prop == cv2.CAP_PROP_POS_MSEC:
+			return max(self.position, 0) * 1000.0 / self.fps
+		if prop == cv2.CAP_PROP_POS_FRAMES:
+			return self.position + 1
+		if prop == cv2.CAP_PROP_FPS:
+			return self.fps
+		if prop == cv2.CAP_PROP_FRAME_COUNT:
+			return len(self.files)
+
+		return 0
+
+	def release(self):
+		self.files = []
+
+# A VideoCapture for a file or stream, or an ImageSequence for a directory
+def openCapture(video):
+	if video is not None and os.path.isdir(video):
+		return ImageSequence(video)
+
+	return cv2.VideoCapture(video)
+
+class FrameBuffer:
+	# Fixed-size ring of frame slots shared between the capture thread and
+	# the detector. Slots are allocated once, on the first captured frame,
+	# and VideoCapture.read() decodes straight into them afterwards.
+	DROP_OLDEST = "drop-oldest"
+	DROP_NEWEST = "drop-newest"
+	BLOCK = "block"
+
+	def __init__(self, size=4, policy="drop-oldest", on_frame=None):
+		if size < 1:
+			raise ValueError("Frame buffer size must be at least 1")
+
+		if policy not in (self.DROP_OLDEST, self.DROP_NEWEST, self.BLOCK):
+			raise ValueError("Unknown drop policy: " + str(policy))
+
+		self.size = size
+		self.policy = policy
+		self.on_frame = on_frame
+		self.condition = Condition()
+		self.closed = False
+
+		# Queued slots, plus one held by the consumer, one being written by
+		# the producer and one scratch slot for frames that get dropped.
+		self.slots = [None] * (size + 3)
+		self.sequences = [0] * len(self.slots)
+		self.timestamps = [0.0] * len(self.slots)
+		self.scratch = len(self.slots) - 1
+		self.free = deque(range(size + 2))
+		self.queued = deque()
+		self.held = None
+		self.sequence = 0
+
+		self.captured = 0
+		self.dropped = 0
+		self.consumed = 0
+
+	# Hand the producer a slot to decode the next frame into.
+	def acquire(self):
+		with self.condition:
+			while len(self.queued) >= self.size and not self.closed:
+				if self.policy == self.DROP_OLDEST:
+					self.free.append(self.queued.popleft())
+					self.dropped += 1
+					break
+
+				if self.policy == self.DROP_NEWEST:
+					return self.scratch
+
+				self.condition.wait()
+
+			if self.closed:
+				return None
+
+			return self.free.popleft()
+
+	def slot(self, index):
+		return self.slots[index]
+
+	# Publish a decoded frame. 'frame' is normally the slot itself, but
+	# VideoCapture allocates a new array for the first frame or whenever
+	# the stream geometry changes.
+	def commit(self, index, frame, timestamp):
+		with self.condition:
+			self.sequence += 1
+			self.captured += 1
+			if self.slots[index] is not frame:
+				self.slots[index] = frame
+				for i in range(len(self.slots)):
+					if self.slots[i] is None:
+						self.slots[i] = numpy.empty_like(frame)
+
+			if index == self.scratch:
+				self.dropped += 1
+				return
+
+			self.sequences[index] = self.sequence
+			self.timestamps[index] = timestamp
+			self.queued.append(index)
+			self.condition.notify_all()
+
+		if self.on_frame is not None:
+			self.on_frame()
+
+	# Return a slot the producer acquired but could not fill.
+	def cancel(self, index):
+		with self.condition:
+			if not index == self.scratch:
+				self.free.appendleft(index)
+			self.condition.notify_all()
+
+	# Wait for the next frame. The returned array stays valid until the
+	# following call to get(). Returns None once the buffer is closed and
+	# drained, or when the timeout expires. With 'latest', older queued
+	# frames are dropped in favour of the newest one.
+	def get(self, timeout=None, latest=False):
+		with self.condition:
+			if not self.queued and not self.closed:
+				self.condition.wait(timeout)
+
+			if not self.queued:
+				return None
+
+			while latest and len(self.queued) > 1:
+				self.free.append(self.queued.popleft())
+				self.dropped += 1
+
+			index = self.queued.popleft()
+			if self.held is not None:
+				self.free.append(self.held)
+
+			self.held = index
+			self.consumed += 1
+			self.condition.notify_all()
+			return (self.slots[index], self.sequences[index], self.timestamps[index])
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+		if self.on_frame is not None:
+			self.on_frame()
+
+	# True when get() would return without waiting
+	def ready(self):
+		with self.condition:
+			return len(self.queued) > 0 or self.closed
+
+	def pending(self):
+		with self.condition:
+			return len(self.queued)
+
+	# Capture time of the frame get() would return next, waiting up to
+	# 'timeout' for one. None once the buffer is closed and drained.
+	def nextTimestamp(self, timeout=None):
+		with self.condition:
+			if not self.queued and not self.closed and not timeout == 0:
+				self.condition.wait(timeout)
+
+			if not self.queued:
+				return None
+
+			return self.timestamps[self.queued[0]]
+
+	def stats(self):
+		with self.condition:
+			return {'captured': self.captured, 'dropped': self.dropped, 'consumed': self.consumed, 'queued': len(self.queued)}
+
 class ThreadedStream:
-	def __init__(self, video):
-		self.frame = False
+	def __init__(self, video, buffer_size=4, drop_policy="drop-oldest", on_frame=None, on_demand=False, replay=False, origin=None, decode_rate=0):
 		self.stopped = False
+		self.success = False
+		self.buffer = FrameBuffer(buffer_size, drop_policy, on_frame)
+
+		# With on_demand, frames are only decoded when the buffer is empty and
+		# at most once per decode_interval; the others are just grabbed.
+		# When replaying, only the interval counts, so the same frames are
+		# decoded on every run.
+		self.on_demand = on_demand
+		self.setDecodeRate(decode_rate)
+		self.last_decode = 0.0
+		self.grabbed = 0
+		self.decoded = 0
 
-		self.stream = cv2.VideoCapture(video)
-		(self.success, self.frame) = self.stream.read()
+		# When replaying, frames are stamped with their position in the file
+		self.replay = replay
+		self.origin = time.time() if origin is None else origin
+
+		self.stream = openCapture(video)
+		self.nominal_fps = self.stream.get(cv2.CAP_PROP_FPS)
+		self.capture()
 
 	def start(self):
 		Thread(target=self.update, args=()).start()
 		return self
- 
+
+	# Limit decoding to 'fps' frames a second in on-demand mode, 0 for no limit.
+	def setDecodeRate(self, fps):
+		self.decode_interval = 1.0 / fps if fps > 0 else 0.0
+
+	def wanted(self, timestamp):
+		# File positions are whole milliseconds, but are offset by the wall
+		# clock origin, which rounding shouldn't get a say in
+		if self.replay:
+			return timestamp - self.last_decode >= self.decode_interval - 0.0005
+
+		return self.buffer.pending() == 0 and timestamp - self.last_decode >= self.decode_interval
+
+	# Capture time of the frame just grabbed
+	def now(self):
+		if self.replay:
+			return self.origin + self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
+		return time.time()
+
+	# Decode one frame into the buffer.
+	def capture(self):
+		if self.on_demand and self.decoded > 0:
+			while True:
+				if self.stopped or not self.stream.grab():
+					self.success = False
+					return False
+
+				timestamp = self.now()
+				self.grabbed += 1
+				if self.wanted(timestamp):
+					break
+
+		index = self.buffer.acquire()
+		if index is None:
+			return False
+
+		if self.on_demand and self.decoded > 0:
+			(self.success, frame) = self.stream.retrieve(self.buffer.slot(index))
+		else:
+			(self.success, frame) = self.stream.read(self.buffer.slot(index))
+			timestamp = self.now()
+
+		if not self.success:
+			self.buffer.cancel(index)
+			return False
+
+		if not self.on_demand or self.decoded == 0:
+			self.grabbed += 1
+
+		self.decoded += 1
+		self.last_decode = timestamp
+		self.buffer.commit(index, frame, timestamp)
+		return True
+
+	def stats(self):
+		stats = self.buffer.stats()
+		stats.update({'grabbed': self.grabbed, 'decoded': self.decoded})
+		return stats
+
 	def update(self):
-		# keep looping infinitely until the thread is stopped
+		# keep capturing until the thread is stopped or the stream ends
+		while not self.stopped:
+			if not self.capture():
+				break
+
+		self.buffer.close()
+
+	# Returns (frame, sequence, timestamp), or None once the stream has ended.
+	def read(self, timeout=None, latest=False):
+		return self.buffer.get(timeout, latest)
+
+	def stop(self):
+		# indicate that the thread should be stopped
+		self.stopped = True
+		self.buffer.close()
+
+# The main stream in dual-stream mode. Every frame is grabbed so the
+# connection keeps up, but frames are only decoded while enabled. When
+# replaying, every frame is decoded and read in step with detection.
+class RecordingStream(ThreadedStream):
+	def __init__(self, video, buffer_size=4, replay=False, origin=None):
+		self.enabled = replay
+		policy = FrameBuffer.BLOCK if replay else FrameBuffer.DROP_OLDEST
+		ThreadedStream.__init__(self, video, buffer_size, policy, None, True, replay, origin)
+
+		# The first frame is always decoded and gives the geometry
+		(self.frame, sequence, self.timestamp) = self.read()
+		self.size = (self.frame.shape[1], self.frame.shape[0])
+
+	def wanted(self, timestamp):
+		return self.enabled
+
+	def setEnabled(self, enabled):
+		self.enabled = enabled or self.replay
+
+	# The decoded frame captured closest to 'timestamp', or None when none is
+	# within 'skew' seconds. The frame stays valid until the next call.
+	def frameAt(self, timestamp, skew):
 		while True:
-			# if the thread indicator variable is set, stop the thread
-			if self.stopped:
+			following = self.buffer.nextTimestamp(None if self.replay else 0)
+			if following is None:
+				break
+
+			if following > timestamp and abs(following - timestamp) >= abs(self.timestamp - timestamp):
+				break
+
+			(self.frame, sequence, self.timestamp) = self.read()
+
+		if abs(self.timestamp - timestamp) > skew:
+			return None
+
+		return self.frame
+
+class SharedFrameRing:
+	# The FrameBuffer ring laid out in a multiprocessing.shared_memory block,
+	# so a capture process can decode straight into slots that the detector
+	# reads as numpy views without pickling or copying. Slot ownership lives
+	# in the shared header and is guarded by a multiprocessing.Condition.
+	# The consumer's slot stays untouched until its next get(), and sequence
+	# numbers order the queued slots.
+	SEQUENCE = 0
+	CAPTURED = 1
+	DROPPED = 2
+	CONSUMED = 3
+	CLOSED = 4
+	GRABBED = 5
+	DECODED = 6
+	DECODE_INTERVAL = 7
+
+	FREE = 0
+	WRITING = 1
+	QUEUED = 2
+	HELD = 3
+
+	def __init__(self, memory, condition, size, shape, dtype, policy="drop-oldest"):
+		self.memory = memory
+		self.condition = condition
+		self.size = size
+		self.policy = policy
+		self.count = size + 3
+		self.scratch = self.count - 1
+
+		header = 8 + 3 * self.count
+		self.counters = numpy.ndarray((8,), numpy.int64, memory.buf, 0)
+		self.states = numpy.ndarray((self.count,), numpy.int64, memory.buf, 8 * 8)
+		self.sequences = numpy.ndarray((self.count,), numpy.int64, memory.buf, 8 * (8 + self.count))
+		self.timestamps = numpy.ndarray((self.count,), numpy.float64, memory.buf, 8 * (8 + 2 * self.count))
+
+		offset = (header * 8 + 63) // 64 * 64
+		self.slots = numpy.ndarray((self.count,) + tuple(shape), numpy.dtype(dtype), memory.buf, offset)
+
+	@staticmethod
+	def bytesNeeded(size, shape, dtype):
+		count = size + 3
+		offset = ((8 + 3 * count) * 8 + 63) // 64 * 64
+		return offset + count * int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+
+	def queuedSlots(self):
+		return [i for i in range(self.count) if self.states[i] == self.QUEUED]
+
+	# Producer side; mirrors FrameBuffer.acquire()
+	def acquire(self):
+		with self.condition:
+			while not self.counters[self.CLOSED]:
+				free = [i for i in range(self.count - 1) if self.states[i] == self.FREE]
+				queued = self.queuedSlots()
+				if len(queued) < self.size and free:
+					self.states[free[0]] = self.WRITING
+					return free[0]
+
+				if self.policy == FrameBuffer.DROP_OLDEST:
+					oldest = min(queued, key=lambda i: self.sequences[i])
+					self.states[oldest] = self.WRITING
+					self.counters[self.DROPPED] += 1
+					return oldest
+
+				if self.policy == FrameBuffer.DROP_NEWEST:
+					return self.scratch
+
+				self.condition.wait()
+
+			return None
+
+	def commit(self, index, timestamp):
+		with self.condition:
+			self.counters[self.CAPTURED] += 1
+			if index == self.scratch:
+				self.counters[self.DROPPED] += 1
 				return
- 
-			# otherwise, read the next frame from the stream
-			(self.success, self.frame) = self.stream.read()
- 
-	def read(self):
-		# return the frame most recently read
-		frame = self.frame
-		self.frame = False
-		return frame
- 
+
+			self.counters[self.SEQUENCE] += 1
+			self.sequences[index] = self.counters[self.SEQUENCE]
+			self.timestamps[index] = timestamp
+			self.states[index] = self.QUEUED
+			self.condition.notify_all()
+
+	# Consumer side; same contract as FrameBuffer.get()
+	def get(self, timeout=None, latest=False):
+		with self.condition:
+			if not self.queuedSlots() and not self.counters[self.CLOSED]:
+				self.condition.wait(timeout)
+
+			queued = sorted(self.queuedSlots(), key=lambda i: self.sequences[i])
+			if not queued:
+				return None
+
+			index = queued[-1] if latest else queued[0]
+			for i in range(self.count):
+				if self.states[i] == self.HELD:
+					self.states[i] = self.FREE
+
+			for i in queued[:-1] if latest else []:
+				self.states[i] = self.FREE
+				self.counters[self.DROPPED] += 1
+
+			self.states[index] = self.HELD
+			self.counters[self.CONSUMED] += 1
+			self.condition.notify_all()
+			return (self.slots[index], int(self.sequences[index]), float(self.timestamps[index]))
+
+	def close(self):
+		with self.condition:
+			self.counters[self.CLOSED] = 1
+			self.condition.notify_all()
+
+	def ready(self):
+		with self.condition:
+			return len(self.queuedSlots()) > 0 or bool(self.counters[self.CLOSED])
+
+	# Same test as ThreadedStream.wanted(); the interval is kept in microseconds
+	def wanted(self, timestamp, last_decode):
+		with self.condition:
+			return len(self.queuedSlots()) == 0 and (timestamp - last_decode) * 1000000 >= self.counters[self.DECODE_INTERVAL]
+
+	def setDecodeRate(self, fps):
+		with self.condition:
+			self.counters[self.DECODE_INTERVAL] = int(1000000 / fps) if fps > 0 else 0
+
+	def stats(self):
+		if self.memory is None:
+			return self.final_stats
+
+		with self.condition:
+			return {'captured': int(self.counters[self.CAPTURED]), 'dropped': int(self.counters[self.DROPPED]), 'consumed': int(self.counters[self.CONSUMED]), 'queued': len(self.queuedSlots()), 'grabbed': int(self.counters[self.GRABBED]), 'decoded': int(self.counters[self.DECODED])}
+
+	# Drop every view into the shared block so it can be closed, keeping the final counters.
+	def release(self):
+		self.final_stats = self.stats()
+		self.final_stats['queued'] = 0
+		self.counters = self.states = self.sequences = self.timestamps = self.slots = None
+		self.memory = None
+
+# Body of the capture process started by ProcessStream
+def captureProcess(video, connection, condition, size, policy, on_demand):
+	stream = openCapture(video)
+	(success, frame) = stream.read()
+	if not success:
+		connection.send(None)
+		return
+
+	connection.send((frame.shape, frame.dtype.str, stream.get(cv2.CAP_PROP_FPS)))
+	# The parent creates and unlinks the block; this process only attaches to it
+	memory = shared_memory.SharedMemory(name=connection.recv())
+	ring = SharedFrameRing(memory, condition, size, frame.shape, frame.dtype, policy)
+	timestamp = time.time()
+	last_decode = 0.0
+	while True:
+		if frame is None and on_demand:
+			# Keep the stream current, but only decode frames detection will use
+			if not stream.grab():
+				ring.close()
+				break
+
+			timestamp = time.time()
+			ring.counters[ring.GRABBED] += 1
+
+			if ring.counters[ring.CLOSED]:
+				break
+
+			if not ring.wanted(timestamp, last_decode):
+				continue
+
+		index = ring.acquire()
+		if index is None:
+			break
+
+		if frame is not None:
+			# The frame read during the handshake
+			ring.slots[index][...] = frame
+			ring.counters[ring.GRABBED] += 1
+			frame = None
+		else:
+			slot = ring.slots[index]
+			if on_demand:
+				(success, image) = stream.retrieve(slot)
+			else:
+				(success, image) = stream.read(slot)
+				timestamp = time.time()
+				if success:
+					ring.counters[ring.GRABBED] += 1
+
+			if not success:
+				ring.close()
+				break
+
+			if image is not slot:
+				if not image.shape == slot.shape:
+					print("Capture process: stream geometry changed, stopping")
+					ring.close()
+					break
+				slot[...] = image
+
+		ring.counters[ring.DECODED] += 1
+		last_decode = timestamp
+		ring.commit(index, timestamp)
+
+	stream.release()
+	ring.release()
+	memory.close()
+
+class ProcessStream:
+	# Drop-in replacement for ThreadedStream that decodes in its own process,
+	# so decoding and detection don't compete for the GIL.
+	def __init__(self, video, buffer_size=4, drop_policy="drop-oldest", on_frame=None, on_demand=False):
+		self.stopped = False
+		self.on_frame = on_frame
+		context = multiprocessing.get_context("spawn")
+		self.condition = context.Condition()
+		(connection, child) = context.Pipe()
+		self.process = context.Process(target=captureProcess, args=(video, child, self.condition, buffer_size, drop_policy, on_demand))
+		self.process.daemon = True
+		self.process.start()
+
+		geometry = connection.recv()
+		if geometry is None:
+			raise IOError("Could not read from " + str(video))
+
+		(shape, dtype, self.nominal_fps) = geometry
+		self.memory = shared_memory.SharedMemory(create=True, size=SharedFrameRing.bytesNeeded(buffer_size, shape, dtype))
+		self.buffer = SharedFrameRing(self.memory, self.condition, buffer_size, shape, dtype, drop_policy)
+		self.buffer.counters[:] = 0
+		self.buffer.states[:] = SharedFrameRing.FREE
+		connection.send(self.memory.name)
+
+	def start(self):
+		# Relay frame notifications from the capture process to this one
+		if self.on_frame is not None:
+			thread = Thread(target=self.relay, args=())
+			thread.daemon = True
+			thread.start()
+
+		return self
+
+	def relay(self):
+		captured = 0
+		while True:
+			with self.condition:
+				while self.buffer.counters[SharedFrameRing.CAPTURED] == captured and not self.buffer.counters[SharedFrameRing.CLOSED]:
+					self.condition.wait()
+
+				captured = self.buffer.counters[SharedFrameRing.CAPTURED]
+				closed = self.buffer.counters[SharedFrameRing.CLOSED]
+
+			self.on_frame()
+			if closed:
+				return
+
+	def read(self, timeout=None, latest=False):
+		return self.buffer.get(timeout, latest)
+
+	def setDecodeRate(self, fps):
+		if not self.stopped:
+			self.buffer.setDecodeRate(fps)
+
+	def stats(self):
+		return self.buffer.stats()
+
 	def stop(self):
-		# indicate that the thread should be stopped
+		if self.stopped:
+			return
+
 		self.stopped = True
+		self.buffer.close()
+		self.process.join(5)
+		if self.process.is_alive():
+			self.process.terminate()
+
+		# Views into the block must be gone before it can be closed
+		self.buffer.release()
+		self.memory.close()
+		self.memory.unlink()
 
 class ZoneState:
 	def __init__(self):
 		self.state = 0
 		self.count = ZoneCount()
 		self.changed_to_active = False
+		# Capture time of the hit that started MONITOR, and seconds of
+		# frames without a hit since the zone last went ACTIVE
+		self.since = 0.0
+		self.missed = 0.0
 
 class ZoneCount:
 	def __init__(self):
@@ -132,32 +830,47 @@ class Zone:
 	NONE = 0
 	HIT = 1
 
-	def __init__(self, zone_attrs, resolution):
+	# 'scale' is the (x, y) multiplier from the zone file's full frame
+	# pixels to working resolution
+	def __init__(self, zone_attrs, scale, tracker):
 		self.attrs = zone_attrs
+		self.tracker = tracker
 		points = []
 		for point in zone_attrs['points']:
-			points.append([point['x'] * resolution, point['y'] * resolution])
+			points.append([point['x'] * scale[0], point['y'] * scale[1]])
 
 		self.poly = numpy.array(points, dtype=numpy.int32)
+		# Minimum object size, like the points, in working resolution pixels
+		self.minimum_w = int(zone_attrs['minimum_x']) * scale[0]
+		self.minimum_h = int(zone_attrs['minimum_y']) * scale[1]
 		self.frame = self.NONE
 		self.changed_to_active = False
 		self.state = ZoneState()
+		self.last_frame = None
 	
+	# Carry on from the state of 'previous', the same zone before a reload
+	def inherit(self, previous):
+		if isinstance(previous.state, ZoneState):
+			self.state = previous.state
+
+		self.frame = previous.frame
+		self.changed_to_active = previous.changed_to_active
+		self.last_frame = previous.last_frame
+
 	# Test if a given point is within this zone.
 	def containsPoint(self, x, y):
-		return cv2.pointPolygonTest(self.poly, (x, y), False) < 0
+		return cv2.pointPolygonTest(self.poly, (x, y), False) >= 0
 
-	# Compare boundingRect(contour) + center(x, y) to zone requirements
-	def registerObject(self, x, y, w, h, cx, cy, cArea, fps):
+	# Compare boundingRect(contour) + center(x, y) to zone requirements. The
+	# caller has already established that the center lies within the zone.
+	# 'timestamp' is the capture time of the frame, in seconds; warmup and
+	# cooldown are measured with it rather than by counting frames.
+	def registerObject(self, x, y, w, h, cx, cy, cArea, timestamp):
 
 		self.changed_to_active = False
 
-		# Make sure the contour center is within the zone
-		if not self.containsPoint(cx, cy):
-			return False
-
 		# Make sure it meets the minimum size requirements
-		if w < int(self.attrs['minimum_x']) or h < int(self.attrs['minimum_y']):
+		if w < self.minimum_w or h < self.minimum_h:
 			#print("Saw something in zone [" + self.attrs['name'] + "], but it wasn't big enough (" + str(w) + " < " + str(self.attrs['minimum_x']) + " || " + str(h) + " < " + str(self.attrs['minimum_y']) + ")")
 			return False
 		
@@ -171,25 +884,22 @@ class Zone:
 		#print(self.attrs['name'] + " hit: " + str(self.state.count.hit))
 
 		if self.state.state is self.INACTIVE:
-			Notify().notifyMonitor(self)
+			Notify(self.tracker).notifyMonitor(self)
 			self.state.state = self.MONITOR
-			
-			# Set the FPS to avoid rehits:
-			self.state.fps = fps
+			self.state.since = timestamp
 
 			return self.state.state
 
 		if self.state.state is self.MONITOR:
-			if self.state.count.hit < int(self.attrs['warmup']) * int(self.state.fps):
-				#print(str(self.state.count.hit) + " < " + str(int(self.attrs['warmup']) * int(self.state.fps)))
+			if timestamp - self.state.since < float(self.attrs['warmup']):
 				if self.state.count.hit is 1:
-					Notify().notifyMonitor(self)
+					Notify(self.tracker).notifyMonitor(self)
 
 				self.state.state = self.MONITOR
 
-			if self.state.count.hit >= int(self.attrs['warmup']) * int(self.state.fps):
+			else:
 				self.state.count.hit = 0
-				Notify().notifyActive(self)
+				Notify(self.tracker).notifyActive(self)
 				self.state.changed_to_active = True
 				self.state.state = self.ACTIVE
 
@@ -199,11 +909,12 @@ class Zone:
 			if self.state.count.hit >= int(self.attrs['continuation']):
 				self.state.count.hit = 0
 				self.state.count.miss = 0
-				Notify().notifyActive(self)
+				self.state.missed = 0.0
+				Notify(self.tracker).notifyActive(self)
 				self.state.state = self.ACTIVE
 
 			else:
-				Notify().notifyContinue(self)
+				Notify(self.tracker).notifyContinue(self)
 				self.state.state = self.CONTINUATION
 
 			return self.state.state
@@ -212,15 +923,20 @@ class Zone:
 			if self.state.count.hit >= int(self.attrs['continuation']):
 				self.state.count.hit = 0
 				self.state.count.miss = 0
-				Notify().notifyActive(self)
+				self.state.missed = 0.0
+				Notify(self.tracker).notifyActive(self)
 				self.state.state = self.ACTIVE
 
 			return self.state.state
 
 		return "WTF?"
 
-	# What to do if not hit during a frame.
-	def endFrame(self):
+	# What to do if not hit during a frame. A miss counts for the time since
+	# the previous frame.
+	def endFrame(self, timestamp):
+		interval = 0.0 if self.last_frame is None else timestamp - self.last_frame
+		self.last_frame = timestamp
+
 		# Handle the changed_to_active variable
 		if self.state.changed_to_active is True:
 			self.changed_to_active = True
@@ -236,32 +952,36 @@ class Zone:
 			return self.state.state
 
 		self.state.count.miss += 1
+		self.state.missed += interval
 		if self.state.state is self.MONITOR:
 			self.state.count.hit = 0
 			self.state.count.miss = 0
-			Notify().notifyInactive(self)
+			self.state.missed = 0.0
+			Notify(self.tracker).notifyInactive(self)
 			self.state.state = self.INACTIVE
 
 			return self.state.state
 
 		if self.state.state is self.ACTIVE:
-			if self.state.count.miss >= int(self.attrs['cooldown']) * self.state.fps:
+			if self.state.missed >= float(self.attrs['cooldown']):
 				self.state.count.hit = 0
 				self.state.count.miss = 0
-				Notify().notifyInactive(self)
+				self.state.missed = 0.0
+				Notify(self.tracker).notifyInactive(self)
 				self.state.state = self.INACTIVE
 
 			else:
-				Notify().notifyCooldown(self)
+				Notify(self.tracker).notifyCooldown(self)
 				self.state.state = self.COOLDOWN
 
 			return self.state.state
 
 		if self.state.state is self.COOLDOWN:
-			if self.state.count.miss >= int(self.attrs['cooldown']) * self.state.fps:
+			if self.state.missed >= float(self.attrs['cooldown']):
 				self.state.count.hit = 0
 				self.state.count.miss = 0
-				Notify().notifyInactive(self)
+				self.state.missed = 0.0
+				Notify(self.tracker).notifyInactive(self)
 				self.state.state = self.INACTIVE
 
 			else:
@@ -270,339 +990,3744 @@ class Zone:
 			return self.state.state
 
 		if self.state.state is self.CONTINUATION:
-			if self.state.count.miss >= int(self.attrs['cooldown']) * self.state.fps:
+			if self.state.missed >= float(self.attrs['cooldown']):
 				self.state.count.hit = 0
 				self.state.count.miss = 0
-				Notify().notifyInactive(self)
+				self.state.missed = 0.0
+				Notify(self.tracker).notifyInactive(self)
 				self.state.state = self.INACTIVE
 
 			else:
-				Notify().notifyCooldown(self)
+				Notify(self.tracker).notifyCooldown(self)
 				self.state.state = self.COOLDOWN
 
 			return self.state.state
 
 		return "WTF2?"
 
-class Frame:
-	def __init__(self, video, resolution):
-		self.captureStream = ThreadedStream(video=video).start()
-		self.resolution = resolution
-		self.counter = FrameCounter()
-		self.fullWidth = 0
-		self.fullHeight = 0
+# Zone.state for a zone run by a ZoneEngine, read from the engine's arrays
+class ZoneEngineState:
+	def __init__(self, engine, index):
+		self.engine = engine
+		self.index = index
+		# Stands in for ZoneCount too
+		self.count = self
 
-		self.opencv_frame = None
-		self.frame = None
-		self.reduced = None
-		self.blur = None
+	@property
+	def state(self):
+		return int(self.engine.state[self.index])
 
-	def next(self):
-		self.opencv_frame = self.captureStream.read()
-		while not type(self.opencv_frame) is numpy.ndarray:
-			time.sleep(0.01)
-			self.opencv_frame = self.captureStream.read()
+	@property
+	def hit(self):
+		return int(self.engine.hits[self.index])
 
-		self.frame = self.opencv_frame
-		if self.fullHeight is 0 or self.fullWidth is 0:
-			(self.fullHeight, self.fullWidth) = self.frame.shape[:2]
-			self.counter.start()
-			print("Capture started")
+	@property
+	def miss(self):
+		return int(self.engine.misses[self.index])
 
-		self.reduced = None
-		self.blur = None
+	@property
+	def since(self):
+		return float(self.engine.since[self.index])
 
-		self.counter.update()
-		return self.frame
+	@property
+	def missed(self):
+		return float(self.engine.missed[self.index])
 
-	def fps(self):
-		return self.counter.fps()
+# The Zone state machine for all zones at once. Settings are compiled into
+# arrays when the zones are loaded, and step() updates every zone with a
+# handful of numpy operations per frame. Same semantics as
+# Zone.registerObject() followed by Zone.endFrame().
+class ZoneEngine:
+	def __init__(self, zones):
+		self.names = list(zones)
+		attrs = [zones[name].attrs for name in self.names]
+		self.warmup = numpy.array([float(zone['warmup']) for zone in attrs])
+		self.cooldown = numpy.array([float(zone['cooldown']) for zone in attrs])
+		self.continuation = numpy.array([int(zone['continuation']) for zone in attrs], numpy.int64)
+		self.minimum_w = numpy.array([zones[name].minimum_w for name in self.names])
+		self.minimum_h = numpy.array([zones[name].minimum_h for name in self.names])
+		self.upload = numpy.array([zone.get('upload_to_s3') is True for zone in attrs], bool)
 
-	def reduceFrame(self):
-		if self.reduced is None:
-			self.reduced = cv2.resize(self.opencv_frame, (int(math.floor(self.fullWidth * self.resolution)), int(math.floor(self.fullHeight * self.resolution))))
+		count = len(self.names)
+		self.state = numpy.zeros(count, numpy.int8)
+		self.hits = numpy.zeros(count, numpy.int64)
+		self.misses = numpy.zeros(count, numpy.int64)
+		self.since = numpy.zeros(count)
+		self.missed = numpy.zeros(count)
+		self.last_frame = None
 
-		return self.reduced
+		for (n, name) in enumerate(self.names):
+			zones[name].state = ZoneEngineState(self, n)
 
-	def blurFrame(self):
-		if self.blur is None:
-			self.blur = cv2.cvtColor(self.reduceFrame(), cv2.COLOR_BGR2GRAY)
-			self.blur = cv2.GaussianBlur(self.blur, (21, 21), 0)
-		
-		return self.blur
+	# Zones with at least one object of their minimum size centred in them.
+	# 'sizes' is (objects, 2) widths and heights, 'members' the matching
+	# ZoneRaster.members() result.
+	def hitsFor(self, sizes, members):
+		if len(sizes) == 0:
+			return numpy.zeros(len(self.names), bool)
 
-	# Convert a downsampled point to it's full resolution location
-	def pointToOriginalResolution(self, x, y):
-		return (int(math.floor(x * 1.0 / self.resolution)), int(math.floor(y *  1.0 / self.resolution)))
+		big = (sizes[:, 0:1] >= self.minimum_w) & (sizes[:, 1:2] >= self.minimum_h)
+		return (members & big).any(axis=0)
 
-	def getContoursDifferentTo(self, key_frame):	
-		diff = cv2.threshold(cv2.absdiff(key_frame, self.blurFrame()), 25, 255, cv2.THRESH_BINARY)[1]
-		diff = cv2.dilate(diff, None, iterations=2)
-		(_, contours, _) = cv2.findContours(diff.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-		return contours
+	def reset(self, zones):
+		self.hits[zones] = 0
+		self.misses[zones] = 0
+		self.missed[zones] = 0.0
 
-	def adaptToFrame(self, key_frame, blend_rate):
-		return cv2.addWeighted(key_frame, blend_rate, self.blurFrame(), 1.00 - blend_rate, 0)
+	# Advance every zone by one frame captured at 'timestamp'. 'hit' says
+	# which zones saw an object. Returns the state changes in the order
+	# Zone would have notified them, as (index, new state), and which
+	# zones went from MONITOR to ACTIVE.
+	def step(self, hit, timestamp):
+		state = self.state.copy()
+		changes = numpy.full(len(self.names), -1, numpy.int8)
 
-	def drawContourBox(self, x, y, w, h, cx, cy, cArea):
-		self.frame = cv2.circle(self.frame, self.pointToOriginalResolution(cx, cy), 1, (0, 0, 255), 1)
-		self.frame = cv2.rectangle(self.frame, self.pointToOriginalResolution(x, y), self.pointToOriginalResolution(x + w, y + h), (0, 255, 0), 1)
-		self.frame = cv2.putText(self.frame, str(cArea / self.resolution / self.resolution), self.pointToOriginalResolution(x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+		# Hits
+		self.hits[hit] += 1
+		started = hit & (state == Zone.INACTIVE)
+		self.since[started] = timestamp
+		changes[started] = Zone.MONITOR
 
-	def drawStatusLists(self, zones, fps):
-		y = self.fullHeight - (len(zones) * 32) - 20
-		for name in zones:
-			y += 32
-			if zones[name].state.state is 0:
-				self.frame = cv2.putText(self.frame, name + ": Inactive", (20, y), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (255, 0, 0), 2, 16)
+		monitor = hit & (state == Zone.MONITOR)
+		activated = monitor & (timestamp - self.since >= self.warmup)
+		changes[monitor & ~activated & (self.hits == 1)] = Zone.MONITOR
+		self.hits[activated] = 0
+		changes[activated] = Zone.ACTIVE
 
-			if zones[name].state.state is 1:
-				self.frame = cv2.putText(self.frame, name + ": Monitor", (20, y), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (0, 174, 255), 2, 16)
-				self.drawProgressBar(350, y, 300, 22, zones[name].state.count.hit, int(zones[name].attrs['warmup']) * int(math.floor(self.fps())), (0, 174, 255))
+		waiting = hit & ((state == Zone.COOLDOWN) | (state == Zone.CONTINUATION))
+		resumed = waiting & (self.hits >= self.continuation)
+		self.reset(resumed)
+		changes[resumed] = Zone.ACTIVE
+		changes[waiting & ~resumed & (state == Zone.COOLDOWN)] = Zone.CONTINUATION
 
-			if zones[name].state.state is 2:
-				self.frame = cv2.putText(self.frame, name + ": Active", (20, y), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (0, 0, 255), 2, 16)
+		self.state[changes >= 0] = changes[changes >= 0]
+		transitions = [(n, int(changes[n])) for n in numpy.flatnonzero(changes >= 0)]
 
-			if zones[name].state.state is 3:
-				self.frame = cv2.putText(self.frame, name + ": Cooldown", (20, y), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (127, 255, 0), 2, 16)
-				self.drawProgressBar(350, y, 300, 22, zones[name].state.count.miss, int(zones[name].attrs['cooldown']) * int(math.floor(self.fps())), (127, 255, 0))
+		# Misses, each counting for the time since the previous frame
+		interval = 0.0 if self.last_frame is None else timestamp - self.last_frame
+		self.last_frame = timestamp
+		miss = ~hit & (state != Zone.INACTIVE)
+		self.misses[miss] += 1
+		self.missed[miss] += interval
 
-			if zones[name].state.state is 4:
-				self.frame = cv2.putText(self.frame, name + ": Continuation", (20, y), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (195, 0, 255), 2, 16)
-				self.drawProgressBar(350, y, 300, 22, zones[name].state.count.hit, int(zones[name].attrs['continuation']), (195, 0, 255))
+		changes[:] = -1
+		expired = miss & ((state == Zone.MONITOR) | (self.missed >= self.cooldown))
+		self.reset(expired)
+		changes[expired] = Zone.INACTIVE
+		changes[miss & ~expired & ((state == Zone.ACTIVE) | (state == Zone.CONTINUATION))] = Zone.COOLDOWN
 
-	def drawProgressBar(self, x, y, w, h, current, maximum, color):
-		self.frame = cv2.rectangle(self.frame, (x, y - h), (x + w, y), (color), 1)
+		self.state[changes >= 0] = changes[changes >= 0]
+		transitions += [(n, int(changes[n])) for n in numpy.flatnonzero(changes >= 0)]
+		return (transitions, activated)
 
-		if current > maximum:
-			current = maximum
+	def active(self):
+		return bool((self.state >= Zone.ACTIVE).any())
 
-		w = int(math.floor(float(w) / float(maximum) * float(current)))
-		self.frame = cv2.rectangle(self.frame, (int(math.floor(x)), int(math.floor(y - h))), (int(math.floor(x + w)), int(math.floor(y + 2))), (color), -1)
+	# Carry on from the state of the zones in 'previous' with the same name
+	def inherit(self, previous):
+		for (n, name) in enumerate(self.names):
+			if name in previous.names:
+				m = previous.names.index(name)
+				self.state[n] = previous.state[m]
+				self.hits[n] = previous.hits[m]
+				self.misses[n] = previous.misses[m]
+				self.since[n] = previous.since[m]
+				self.missed[n] = previous.missed[m]
 
-	def putDateTime(self):
-		cv2.putText(self.frame, datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"), (20, 90), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (255, 255, 255), 2)
+		self.last_frame = previous.last_frame
 
-class MotionTracker:
-	def __init__(self, settings):
-		self.resolution = 1.0
-		self.settings = settings
-		if settings['resolution'] < 1.0:
-			self.resolution = settings['resolution']
+class ZoneRaster:
+	# All zone polygons rasterised once into a label image at working
+	# resolution. Bit n of a label is set when the pixel is inside the n-th
+	# zone, so overlapping zones are fine.
+	def __init__(self, zones, width, height):
+		self.names = list(zones)
+		if len(self.names) > 64:
+			raise ValueError("At most 64 zones are supported, got " + str(len(self.names)))
 
-		# Set the frame source and get the key_frame
-		self.frame = Frame(settings['video'], self.resolution)
-		self.frame.next()
-		self.key_frame = self.frame.blurFrame()
-		cv2.imwrite("/motiondata/last_keyframe.jpg", self.key_frame)
+		for dtype in (numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64):
+			if len(self.names) <= numpy.iinfo(dtype).bits:
+				break
 
-		self.to_original = 1.0 / self.resolution
-		self.blend_rate = 1.00 - (settings['blend_rate'] / float(100))
-		self.codec = cv2.VideoWriter_fourcc(*args["codec"])
+		self.width = width
+		self.height = height
+		self.bits = numpy.array([1 << n for n in range(len(self.names))], dtype=dtype)
+		self.labels = numpy.zeros((height, width), dtype=dtype)
+
+		mask = numpy.zeros((height, width), dtype=numpy.uint8)
+		for (n, name) in enumerate(self.names):
+			mask[:] = 0
+			cv2.fillPoly(mask, [zones[name].poly], 1)
+			self.labels[mask > 0] |= self.bits[n]
+
+	# Zone membership for a batch of points, as a (points x zones) bool array.
+	def members(self, xs, ys):
+		xs = numpy.clip(numpy.asarray(xs, dtype=numpy.intp), 0, self.width - 1)
+		ys = numpy.clip(numpy.asarray(ys, dtype=numpy.intp), 0, self.height - 1)
+		return (self.labels[ys, xs][:, None] & self.bits) != 0
+
+# Everything compiled from a zones file: the Zone objects, their raster,
+# the ZoneEngine and the crop region. Built in full before it replaces the
+# tracker's zones, so a file that does not load changes nothing.
+class ZoneSet:
+	def __init__(self, path, tracker):
+		config = json.loads(open(path, 'r').read())
+		if not isinstance(config.get('zones'), dict) or len(config['zones']) == 0:
+			raise ValueError(path + " has no zones")
 
-		self.fps = 20
 		self.zones = {}
-		self.lists = {}
-		self.has_active_zone = False
-		self.snapshot = False
-		self.upload_snapshot = False
-		self.last_snapshot = None
-		self.recording = False
-		self.recorded_frames = 0
-		self.output = None
+		for key in config['zones']:
+			attrs = config['zones'][key]
+			name = str(attrs['name'])
+			if name in self.zones:
+				raise ValueError("Zone name '" + name + "' is used more than once")
 
-		zones = json.loads(open(args['polygon_json'], 'r').read())
-		for zone in zones['zones']:
-			self.zones.update({str(zones['zones'][zone]['name']): Zone(zones['zones'][zone], self.resolution)})
+			if len(attrs['points']) < 3:
+				raise ValueError("Zone '" + name + "' needs at least 3 points")
 
-		if not zones['s3_bucket'] is None:
-			self.settings['s3_bucket'] = zones['s3_bucket']
+			float(attrs['warmup'])
+			float(attrs['cooldown'])
+			int(attrs['continuation'])
+			self.zones[name] = Zone(attrs, tracker.scale, tracker)
 
-	def resetZabbixItems(self):
-		for name in self.zones:
-			Notify().sendZabbixValue("mrec." + name.lower(), 0)
-			Notify().sendZabbixValue("mdect." + name.lower(), 0)
+		(width, height) = tracker.frame.workingSize()
+		self.raster = ZoneRaster(self.zones, width, height)
+		self.engine = None
+		if tracker.settings['zone_engine'] == "vector":
+			self.engine = ZoneEngine(self.zones)
 
-	# Get the next frame from the camera
-	def getNextFrame(self):
-		# Reset the lists and temporary variables;
-		self.has_active_zone = False
-		self.lists = {'inactive': [], 'monitor': [], 'active': [], 'cooldown': [], 'continuation': []}
+		self.region = None
+		if tracker.settings['crop_to_zones']:
+			self.region = tracker.zoneRegion(self.zones)
 
-		self.snapshot = False
-		self.frame.next()
+		self.s3_bucket = config.get('s3_bucket')
 
-		return True
+# Calls on_change(path) from a background thread whenever the file at
+# 'path' is replaced or written. Uses inotify on the directory, so editors
+# that save through a rename are seen too, and otherwise compares the
+# file's mtime every 'interval' seconds.
+class FileWatcher:
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	EVENT = struct.Struct("iIII")
 
-	# Returns the members of a list as a comma delimeted string
-	def getListString(list_name):
-		text = "";
-		for (name, value) in self.lists[list_name].iteritems():
-			text += name + ", "
+	def __init__(self, path, on_change, interval=1.0):
+		self.path = path
+		self.on_change = on_change
+		self.interval = interval
+		self.stopped = False
+		self.thread = None
 
-		return text[:-2];
+	def start(self):
+		self.thread = Thread(target=self.update, args=())
+		self.thread.daemon = True
+		self.thread.start()
+		return self
 
-	def processCurrentFrame(self):
-		contours = self.frame.getContoursDifferentTo(self.key_frame);
+	def stop(self):
+		self.stopped = True
+		if self.thread is not None:
+			self.thread.join(self.interval + 1)
 
-		for contour in contours:	
-			# Ignore small contours
-			cArea = cv2.contourArea(contour)
-			if cArea < self.settings["min_area"] * self.resolution * self.resolution:
-				continue
+	# An inotify descriptor watching the file's directory, or None
+	def inotify(self):
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		except (OSError, AttributeError):
+			return None
 
-			# Contour is big enough. Draw the boundingRect and calculate the center of motion.
-			(x, y, w, h) = cv2.boundingRect(contour)
-			cx = x + (w / 2)
-			cy = y + (h / 2)
+		if fd < 0:
+			return None
 
-			self.frame.drawContourBox(x, y, w, h, cx, cy, cArea)
-			for name in self.zones:
-				self.zones[name].registerObject(x, y, w, h, cx, cy, cArea, self.fps)
-				if self.zones[name].state.state >= 2:
-					self.has_active_zone = True
+		directory = os.path.dirname(os.path.abspath(self.path))
+		if libc.inotify_add_watch(fd, directory.encode(), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+			os.close(fd)
+			return None
 
-				if self.zones[name].state.changed_to_active is True:
-					if self.zones[name].attrs['upload_to_s3'] is True:
-						self.upload_snapshot = True
+		return fd
 
-					self.snapshot = True
+	def signature(self):
+		try:
+			status = os.stat(self.path)
+		except OSError:
+			return None
 
-	def endCurrentFrame(self):
-		for name in self.zones:
-			state = self.zones[name].endFrame()
-			if state >= 2:
-				self.has_active_zone = True
+		return (status.st_ino, status.st_size, status.st_mtime_ns)
 
-			'''
-			if state is 0:
-				self.lists['inactive'].append(name)
+	# True when the inotify events in 'data' are about our file
+	def matches(self, data):
+		name = os.path.basename(self.path).encode()
+		offset = 0
+		found = False
+		while offset + self.EVENT.size <= len(data):
+			length = self.EVENT.unpack_from(data, offset)[3]
+			offset += self.EVENT.size
+			if data[offset:offset + length].rstrip(b"\0") == name:
+				found = True
 
-			if state is 1:
-				self.lists['monitor'].append(name)
+			offset += length
 
-			if state is 2:
-				self.lists['active'].append(name)
+		return found
 
-			if state is 3:
-				self.lists['cooldown'].append(name)
+	def update(self):
+		fd = self.inotify()
+		signature = self.signature()
+		try:
+			while not self.stopped:
+				if fd is None:
+					time.sleep(self.interval)
+					current = self.signature()
+					changed = current is not None and not current == signature
+					signature = current
+				else:
+					changed = False
+					if select.select([fd], [], [], self.interval)[0]:
+						try:
+							changed = self.matches(os.read(fd, 65536))
+						except BlockingIOError:
+							pass
 
-			if state is 4:
-				self.lists['continuation'].append(name)
-			'''
+				if changed and not self.stopped:
+					self.on_change(self.path)
+		finally:
+			if fd is not None:
+				os.close(fd)
 
-	def run(self):
-		install_hard_ctrl_c()
-		while (self.getNextFrame()):
-			self.processCurrentFrame()
-			self.endCurrentFrame()
-			self.frame.drawStatusLists(self.zones, self.fps)
-			self.frame.putDateTime()
-			dt = datetime.datetime.now()
+# Latencies in fixed buckets two to an octave, from 1us to about 12s, so
+# recording is a bisect and an increment and quantiles are available at
+# any time. Quantiles are the upper bound of their bucket, within 41%.
+class LatencyHistogram:
+	BOUNDS = [0.000001 * 2 ** (n / 2.0) for n in range(48)]
 
-			if self.snapshot:
-				name = dt.strftime(self.settings["filename"])
-				if not self.last_snapshot == name:
-					if os.path.isdir(dt.strftime(self.settings["filepath"])) is False:
-						os.makedirs(dt.strftime(self.settings["filepath"]))
+	def __init__(self):
+		self.counts = [0] * (len(self.BOUNDS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		# Counts and max since the last window() call
+		self.window_counts = list(self.counts)
+		self.window_max = 0.0
 
-					path = dt.strftime(self.settings["filepath"])
-					cv2.imwrite(path + name + ".jpg", self.frame.frame)
+	def add(self, seconds):
+		self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+		if seconds > self.window_max:
+			self.window_max = seconds
 
-					if self.upload_snapshot:
-						#print("### Would have Uploaded to S3 @ " + self.settings['s3_bucket'])
-						p = subprocess.Popen("/motiondata/s3_upload.sh " + path + name + ".jpg s3://motion.aws.bradwoodward.io/", shell=True)
+	@staticmethod
+	def quantile(q, counts, maximum):
+		seen = 0
+		wanted = q * sum(counts)
+		bounds = LatencyHistogram.BOUNDS
+		for (n, count) in enumerate(counts):
+			seen += count
+			if count > 0 and seen >= wanted:
+				return min(bounds[n], maximum) if n < len(bounds) else maximum
 
-						self.upload_snapshot = False
+		return 0.0
 
-					Notify().sendZabbixValue('mz.latest_snapshot', name + ".jpg")
+	def summary(self, counts=None, maximum=None):
+		counts = self.counts if counts is None else counts
+		maximum = self.max if maximum is None else maximum
+		return {'count': sum(counts), 'p50': self.quantile(0.5, counts, maximum), 'p95': self.quantile(0.95, counts, maximum), 'p99': self.quantile(0.99, counts, maximum), 'max': maximum}
 
-					self.last_snapshot = name
-				self.snapshot = False
+	# Summary of what was added since the previous call
+	def window(self):
+		counts = [now - before for (now, before) in zip(self.counts, self.window_counts)]
+		summary = self.summary(counts, self.window_max)
+		self.window_counts = list(self.counts)
+		self.window_max = 0.0
+		return summary
 
-			if self.has_active_zone is True:
-				if self.recording is False:
-					if os.path.isdir(dt.strftime(self.settings["filepath"])) is False:
-						os.makedirs(dt.strftime(self.settings["filepath"]))
+# One LatencyHistogram per pipeline stage. Stages may be recorded from
+# several threads, e.g. the detector and the encoder.
+class LatencyMetrics:
+	def __init__(self):
+		self.lock = Lock()
+		self.histograms = {}
 
-					path = dt.strftime(self.settings["filepath"])
-					name = dt.strftime(self.settings["filename"])
-					Notify().sendZabbixValue('mz.latest_video', name + ".avi")
-					self.output = cv2.VideoWriter(path + name + ".avi", self.codec, math.floor(self.frame.fps()), (self.frame.fullWidth, self.frame.fullHeight))
-					self.fps = self.frame.fps()
-					self.recording = True
+	def add(self, stage, seconds):
+		with self.lock:
+			histogram = self.histograms.get(stage)
+			if histogram is None:
+				histogram = self.histograms[stage] = LatencyHistogram()
 
-				self.output.write(self.frame.frame)
-				self.recorded_frames += 1
-				if self.recorded_frames % math.floor(self.settings['max_hitseconds'] * self.frame.fps()) < 1:
-					Notify().notifyForceRekey()
-					self.key_frame = self.frame.blurFrame()
-				else:
-					self.key_frame = self.frame.adaptToFrame(self.key_frame, self.blend_rate)
+			histogram.add(seconds)
 
-			if self.has_active_zone is False:
-				if self.recording is True:
-					self.output.release()
-					self.output = None
-					self.recording = False
-					self.recorded_frames = 0
-					Notify().notifyStopRecording()
+	# Total seconds per stage
+	def totals(self):
+		with self.lock:
+			return dict((stage, histogram.total) for (stage, histogram) in self.histograms.items())
 
-			if int(dt.strftime("%S")) % 4 == 0:
-				self.key_frame = self.frame.adaptToFrame(self.key_frame, self.blend_rate)
+	def summary(self):
+		with self.lock:
+			return dict((stage, histogram.summary()) for (stage, histogram) in self.histograms.items())
 
+	def window(self):
+		with self.lock:
+			return dict((stage, histogram.window()) for (stage, histogram) in self.histograms.items())
 
-class Notify:
-	def __init__(self):
-		self.cmd = "/usr/bin/zabbix_sender -z " + mdect.settings['zabbix_server'] + " -s '" + mdect.settings['zabbix_name'] + "'"
-		self.dt = datetime.datetime.now()
+	def histogramsCopy(self):
+		with self.lock:
+			return dict((stage, (list(histogram.counts), histogram.total, histogram.count, histogram.max)) for (stage, histogram) in self.histograms.items())
 
-	def notifyForceRekey (self):
-		print(self.dt.strftime("[%H:%M:%S] Forcing rekey of master frame"))
-		return
+# Record the seconds since 'start' for 'stage' when 'timings' is a
+# LatencyMetrics, and return the time the next stage starts at. Without
+# metrics this is a single comparison.
+def lapTime(timings, stage, start):
+	if timings is None:
+		return start
 
-	def notifyActive (self, zone):
-		self.sendZabbixValue("mrec." + zone.attrs['name'].lower(), 1)
-		print(self.dt.strftime("[%H:%M:%S] -- -O [" + zone.attrs['name'] + "]"))
-		return
+	now = time.perf_counter()
+	timings.add(stage, now - start)
+	return now
 
-	def notifyMonitor (self, zone):
+# The chain that turns a captured frame into contours: grey conversion,
+# downscale, blur, threshold against the key frame, dilation and
+# findContours. The defaults are the original resize, 21x21 Gaussian and
+# two dilations at working resolution. blobs() goes on to measure and
+# filter the moving areas, with findContours or with
+# connectedComponentsWithStats as 'blobs' says.
+class Preprocessor:
+	STAGES = ("convert", "downscale", "blur", "background", "morphology", "contours")
+
+	def __init__(self, grey_first=False, downscale="linear", blur="gaussian", blur_size=21, mask_scale=1.0, dilate_iterations=2, blobs="contours"):
+		self.grey_first = grey_first
+		self.method = downscale
+		self.blur = blur if blur_size > 1 else "none"
+		# medianBlur and GaussianBlur want an odd kernel
+		self.blur_size = blur_size | 1
+		self.mask_scale = min(mask_scale, 1.0)
+		self.dilate_iterations = dilate_iterations
+		self.blob_backend = blobs
+
+		# Seconds spent in each stage, only collected when set to a dict
+		self.timings = None
+		# Output arrays reused from frame to frame. Everything returned is
+		# only valid until the next frame is processed.
+		self.buffers = {}
+
+	# The reusable output array 'name' of 'shape'. There is one per shape,
+	# so a crop and the whole frame processed alternately keep theirs.
+	def buffer(self, name, shape, dtype=numpy.uint8):
+		buffer = self.buffers.get((name, shape))
+		if buffer is None or not buffer.dtype == dtype:
+			buffer = numpy.empty(shape, dtype)
+			self.buffers[(name, shape)] = buffer
+
+		return buffer
+
+	def lap(self, stage, start):
+		return lapTime(self.timings, stage, start)
+
+	# The size of the square of working pixels that becomes one pixel of
+	# the shrunk mask, or None when an image of 'width' x 'height' does not
+	# divide into whole ones.
+	def cell(self, width, height):
+		if self.mask_scale >= 1.0:
+			return 1
+
+		cell = int(round(1.0 / self.mask_scale))
+		if not abs(cell * self.mask_scale - 1.0) < 1e-9:
+			return None
+
+		if not (int(width * self.mask_scale) * cell == width and int(height * self.mask_scale) * cell == height):
+			return None
+
+		return cell
+
+	# How far, in working resolution pixels, a pixel can affect the dilated
+	# mask: pyrDown's 5x5 kernel at every level, half the blur kernel, and
+	# the dilate iterations with their 3x3 kernel plus the shrink to
+	# mask_scale, both in mask pixels.
+	def reach(self):
+		reach = 4 if self.method == "pyramid" else 1
+		if not self.blur == "none":
+			reach += self.blur_size // 2
+
+		if self.mask_scale >= 1.0:
+			return reach + self.dilate_iterations
+
+		iterations = int(round(self.dilate_iterations * self.mask_scale)) if self.dilate_iterations > 0 else 0
+		if self.dilate_iterations > 0 and iterations == 0:
+			iterations = 1
+
+		return reach + int(math.ceil((iterations + 1) / self.mask_scale))
+
+	def downscale(self, image, size):
+		if (image.shape[1], image.shape[0]) == size:
+			return image
+
+		reduced = self.buffer("reduced", (size[1], size[0]) + image.shape[2:])
+		if self.method == "linear":
+			return cv2.resize(image, size, dst=reduced)
+
+		if self.method == "pyramid":
+			# Halve while still at least twice the target; each pyrDown also smooths
+			level = 0
+			while image.shape[1] >= size[0] * 2 and image.shape[0] >= size[1] * 2:
+				level += 1
+				image = cv2.pyrDown(image, dst=self.buffer("pyramid" + str(level), ((image.shape[0] + 1) // 2, (image.shape[1] + 1) // 2) + image.shape[2:]))
+
+			if (image.shape[1], image.shape[0]) == size:
+				return image
+
+		return cv2.resize(image, size, dst=reduced, interpolation=cv2.INTER_AREA)
+
+	# Working resolution copy of 'frame', cropped to 'region' (x, y, w, h)
+	# when given. Grey already when grey_first is set.
+	def reduce(self, frame, resolution, region=None):
+		start = time.perf_counter()
+		if self.grey_first:
+			frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.buffer("grey", frame.shape[:2]))
+			start = self.lap("convert", start)
+
+		size = (int(math.floor(frame.shape[1] * resolution)), int(math.floor(frame.shape[0] * resolution)))
+		if region is None:
+			reduced = self.downscale(frame, size)
+		else:
+			(x, y, w, h) = region
+			scale = 1.0 / resolution
+			if abs(scale - round(scale)) < 1e-9:
+				# Whole-number downscale: shrinking just the crop gives the same pixels
+				k = int(round(scale))
+				reduced = self.downscale(frame[y * k:(y + h) * k, x * k:(x + w) * k], (w, h))
+			else:
+				reduced = self.downscale(frame, size)[y:y + h, x:x + w]
+
+		self.lap("downscale", start)
+		return reduced
+
+	def smooth(self, reduced):
+		start = time.perf_counter()
+		if len(reduced.shape) > 2:
+			reduced = cv2.cvtColor(reduced, cv2.COLOR_BGR2GRAY, dst=self.buffer("grey", reduced.shape[:2]))
+			start = self.lap("convert", start)
+
+		size = (self.blur_size, self.blur_size)
+		if self.blur == "gaussian":
+			reduced = cv2.GaussianBlur(reduced, size, 0, dst=self.buffer("blur", reduced.shape))
+		elif self.blur == "box":
+			reduced = cv2.blur(reduced, size, dst=self.buffer("blur", reduced.shape))
+		elif self.blur == "median":
+			reduced = cv2.medianBlur(reduced, self.blur_size, dst=self.buffer("blur", reduced.shape))
+
+		self.lap("blur", start)
+		return reduced
+
+	# Returns (motion mask, dilated mask) of 'blurred' against the
+	# background model, updating the model with 'retention' when not None.
+	# The motion mask is at working resolution, the dilated mask at
+	# mask_scale of it. With 'region' (x, y, w, h), 'blurred' is that part
+	# of the frame and is only compared to the same part of the model.
+	def motionMask(self, background, blurred, retention=None, region=None):
+		start = time.perf_counter()
+		if region is None:
+			mask = background.apply(blurred, retention)
+		else:
+			mask = background.applyRegion(blurred, region)
+		start = self.lap("background", start)
+
+		small = mask
+		iterations = self.dilate_iterations
+		if self.mask_scale < 1.0:
+			(h, w) = mask.shape[:2]
+			size = (max(1, int(w * self.mask_scale)), max(1, int(h * self.mask_scale)))
+			small = cv2.resize(mask, size, dst=self.buffer("small", (size[1], size[0])), interpolation=cv2.INTER_AREA)
+			# A cell is set when any pixel in it moved
+			cv2.threshold(small, 0, 255, cv2.THRESH_BINARY, dst=small)
+			iterations = int(round(iterations * self.mask_scale)) if iterations > 0 else 0
+			if self.dilate_iterations > 0 and iterations == 0:
+				iterations = 1
+
+		if iterations > 0:
+			small = cv2.dilate(small, None, dst=self.buffer("dilated", small.shape), iterations=iterations)
+
+		self.lap("morphology", start)
+		return (mask, small)
+
+	# Outer contours of 'small', the dilated mask of 'mask', in 'mask' coordinates moved by 'offset'
+	def findContours(self, mask, small, offset=(0, 0)):
+		if small.shape == mask.shape:
+			# findContours leaves its input alone since OpenCV 3.2, so no copy is needed
+			return cv2.findContours(small, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=tuple(offset))[-2]
+
+		found = cv2.findContours(small, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+		factor = numpy.array([mask.shape[1] / float(small.shape[1]), mask.shape[0] / float(small.shape[0])])
+		return [(numpy.round(contour * factor) + offset).astype(numpy.int32) for contour in found]
+
+	# Returns (motion mask, contours) of 'blurred' against the background
+	# model, updating the model with 'retention' when not None. The mask is
+	# at working resolution, contours are in working resolution frame
+	# coordinates.
+	def contours(self, background, blurred, retention=None, offset=(0, 0)):
+		(mask, small) = self.motionMask(background, blurred, retention)
+		start = time.perf_counter()
+		contours = self.findContours(mask, small, offset)
+		self.lap("contours", start)
+		return (mask, contours)
+
+	# Like contours(), but returns (motion mask, blobs) with the blobs as
+	# (x, y, w, h, cx, cy, area) tuples: those of at least 'min_area', at
+	# most 'max_area' unless that is 0, and at least 'min_size' (w, h).
+	# With 'region' the model is only compared, see motionMask(), and the
+	# blobs are None when there is motion close to one of the 'edges' of
+	# the region, as the blob there may continue outside it.
+	def blobs(self, background, blurred, retention=None, offset=(0, 0), min_area=0, max_area=0, min_size=(0, 0), region=None, edges=(True, True, True, True)):
+		(mask, small) = self.motionMask(background, blurred, retention, region)
+		start = time.perf_counter()
+		if region is not None and self.touchesEdges(mask, small, edges):
+			blobs = None
+		else:
+			blobs = self.extractBlobs(mask, small, offset, min_area, max_area, min_size)
+		self.lap("contours", start)
+		return (mask, blobs)
+
+	# Whether the dilated mask 'small' of 'mask' has motion within reach()
+	# of one of the (left, top, right, bottom) 'edges' that are set. Closer
+	# to a crop edge than that, the mask can differ from the whole frame's.
+	def touchesEdges(self, mask, small, edges):
+		bx = int(math.ceil((self.reach() + 1) * small.shape[1] / float(mask.shape[1])))
+		by = int(math.ceil((self.reach() + 1) * small.shape[0] / float(mask.shape[0])))
+		strips = (small[:, :bx], small[:by], small[:, -bx:], small[-by:])
+		return any(edge and strip.any() for (edge, strip) in zip(edges, strips))
+
+	# The blobs of the dilated mask 'small', measured with 'backend' or the
+	# configured one. With "contours" the area is that of the outline
+	# polygon, with "components" the number of pixels, which is larger by
+	# about half the outline.
+	def extractBlobs(self, mask, small, offset=(0, 0), min_area=0, max_area=0, min_size=(0, 0), backend=None):
+		if (backend or self.blob_backend) == "contours":
+			blobs = []
+			for contour in self.findContours(mask, small, offset):
+				area = cv2.contourArea(contour)
+				if area < min_area or (max_area > 0 and area > max_area):
+					continue
+
+				(x, y, w, h) = cv2.boundingRect(contour)
+				if w < min_size[0] or h < min_size[1]:
+					continue
+
+				blobs.append((x, y, w, h, x + (w / 2), y + (h / 2), area))
+
+			return blobs
+
+		# Measure every component at once, label 0 being the background.
+		# Gathering the stats is most of the cost, and about twice as fast
+		# with the block based labelling (Grana, BBDT) as with the default.
+		stats = cv2.connectedComponentsWithStatsWithAlgorithm(small, 8, cv2.CV_32S, cv2.CCL_GRANA, self.buffer("labels", small.shape, numpy.int32))[2][1:]
+		(x, y, w, h) = (stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP], stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT])
+		area = stats[:, cv2.CC_STAT_AREA].astype(numpy.float64)
+		if not small.shape == mask.shape:
+			# Scale the first and last pixel like findContours() scales the outline
+			(fx, fy) = (mask.shape[1] / float(small.shape[1]), mask.shape[0] / float(small.shape[0]))
+			(x, right) = (numpy.round(x * fx), numpy.round((x + w - 1) * fx))
+			(y, bottom) = (numpy.round(y * fy), numpy.round((y + h - 1) * fy))
+			(x, y, w, h) = (x.astype(numpy.int32), y.astype(numpy.int32), (right - x + 1).astype(numpy.int32), (bottom - y + 1).astype(numpy.int32))
+			area *= fx * fy
+
+		keep = (area >= min_area) & (w >= min_size[0]) & (h >= min_size[1])
+		if max_area > 0:
+			keep &= area <= max_area
+
+		(x, y, w, h) = (x[keep] + offset[0], y[keep] + offset[1], w[keep], h[keep])
+		return list(zip(x.tolist(), y.tolist(), w.tolist(), h.tolist(), (x + w / 2.0).tolist(), (y + h / 2.0).tolist(), area[keep].tolist()))
+
+# Background models. Each keeps a picture of the scene without motion and
+# turns a blurred working frame into a binary motion mask with apply().
+# 'retention' is the share of the old background to keep when the frame
+# is blended in, or None to leave the model as it is.
+
+# The original model: uint8 addWeighted, which allocates a new key frame
+# on every update and rounds it each time.
+#
+# Models with 'regional' set model every pixel on its own and can compare
+# a crop of the frame to the same part of the model with applyRegion().
+class BlendBackground:
+	regional = True
+
+	def __init__(self):
+		self.key_frame = None
+
+	def reset(self, image):
+		self.key_frame = image.copy()
+
+	def apply(self, image, retention=None):
+		mask = cv2.threshold(cv2.absdiff(self.key_frame, image), 25, 255, cv2.THRESH_BINARY)[1]
+		if retention is not None:
+			self.key_frame = cv2.addWeighted(self.key_frame, retention, image, 1.00 - retention, 0)
+
+		return mask
+
+	def applyRegion(self, image, region):
+		(x, y, w, h) = region
+		return cv2.threshold(cv2.absdiff(self.key_frame[y:y + h, x:x + w], image), 25, 255, cv2.THRESH_BINARY)[1]
+
+	def image(self):
+		return self.key_frame
+
+# Running average kept in a float32 accumulator, updated in place
+class AccumulatedBackground:
+	regional = True
+
+	def __init__(self):
+		self.accumulator = None
+		self.key_frame = None
+		self.difference = None
+		self.mask = None
+		self.stale = True
+		# (difference, mask) buffers for applyRegion()
+		self.crop = None
+
+	def reset(self, image):
+		if self.accumulator is None or not self.accumulator.shape == image.shape:
+			self.accumulator = numpy.empty(image.shape, numpy.float32)
+			self.key_frame = numpy.empty(image.shape, numpy.uint8)
+			self.difference = numpy.empty(image.shape, numpy.uint8)
+			self.mask = numpy.empty(image.shape, numpy.uint8)
+
+		self.accumulator[...] = image
+		self.stale = True
+
+	def apply(self, image, retention=None):
+		cv2.absdiff(self.image(), image, dst=self.difference)
+		cv2.threshold(self.difference, 25, 255, cv2.THRESH_BINARY, dst=self.mask)
+		if retention is not None:
+			cv2.accumulateWeighted(image, self.accumulator, 1.00 - retention)
+			self.stale = True
+
+		return self.mask
+
+	def applyRegion(self, image, region):
+		(x, y, w, h) = region
+		if self.crop is None or not self.crop[0].shape == image.shape:
+			self.crop = (numpy.empty(image.shape, numpy.uint8), numpy.empty(image.shape, numpy.uint8))
+
+		cv2.absdiff(self.image()[y:y + h, x:x + w], image, dst=self.crop[0])
+		cv2.threshold(self.crop[0], 25, 255, cv2.THRESH_BINARY, dst=self.crop[1])
+		return self.crop[1]
+
+	def image(self):
+		if self.stale:
+			cv2.convertScaleAbs(self.accumulator, dst=self.key_frame)
+			self.stale = False
+
+		return self.key_frame
+
+# Per-pixel median of the last 'samples' blended frames. Ignores the
+# retention; every update replaces the oldest sample.
+class MedianBackground:
+	regional = True
+
+	def __init__(self, samples=9):
+		self.samples = max(samples, 1)
+		self.history = None
+		self.next = 0
+		self.key_frame = None
+		self.difference = None
+		self.mask = None
+		self.crop = None
+
+	# The samples of a pixel are kept next to each other, so the median is
+	# an in-place partition of a copy of the history rather than
+	# numpy.median(), which allocates several times the history per call.
+	def reset(self, image):
+		self.history = numpy.repeat(image[..., None], self.samples, axis=-1)
+		self.sorted = numpy.empty_like(self.history)
+		self.sum = numpy.empty(image.shape, numpy.uint16)
+		self.next = 0
+		self.key_frame = image.copy()
+		self.difference = numpy.empty(image.shape, numpy.uint8)
+		self.mask = numpy.empty(image.shape, numpy.uint8)
+
+	def apply(self, image, retention=None):
+		cv2.absdiff(self.key_frame, image, dst=self.difference)
+		cv2.threshold(self.difference, 25, 255, cv2.THRESH_BINARY, dst=self.mask)
+		if retention is not None:
+			self.history[..., self.next] = image
+			self.next = (self.next + 1) % self.samples
+			self.median()
+
+		return self.mask
+
+	# numpy.median(self.history, axis=-1).astype(numpy.uint8), into self.key_frame
+	def median(self):
+		middle = self.samples // 2
+		numpy.copyto(self.sorted, self.history)
+		if self.samples % 2:
+			self.sorted.partition(middle, axis=-1)
+			numpy.copyto(self.key_frame, self.sorted[..., middle])
+			return
+
+		self.sorted.partition((middle - 1, middle), axis=-1)
+		numpy.add(self.sorted[..., middle - 1], self.sorted[..., middle], out=self.sum, dtype=numpy.uint16)
+		numpy.right_shift(self.sum, 1, out=self.sum)
+		numpy.copyto(self.key_frame, self.sum, casting='unsafe')
+
+	def applyRegion(self, image, region):
+		(x, y, w, h) = region
+		if self.crop is None or not self.crop[0].shape == image.shape:
+			self.crop = (numpy.empty(image.shape, numpy.uint8), numpy.empty(image.shape, numpy.uint8))
+
+		cv2.absdiff(self.key_frame[y:y + h, x:x + w], image, dst=self.crop[0])
+		cv2.threshold(self.crop[0], 25, 255, cv2.THRESH_BINARY, dst=self.crop[1])
+		return self.crop[1]
+
+	def image(self):
+		return self.key_frame
+
+# OpenCV's MOG2 or KNN subtractors, learning at 1 - retention. They only
+# take whole frames.
+class SubtractorBackground:
+	regional = False
+
+	def __init__(self, method="mog2"):
+		self.method = method
+		self.subtractor = None
+		self.mask = None
+
+	def reset(self, image):
+		if self.method == "knn":
+			self.subtractor = cv2.createBackgroundSubtractorKNN(detectShadows=False)
+		else:
+			self.subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+
+		self.mask = numpy.empty(image.shape, numpy.uint8)
+		self.subtractor.apply(image, self.mask, 1.0)
+
+	def apply(self, image, retention=None):
+		return self.subtractor.apply(image, self.mask, 0.0 if retention is None else 1.00 - retention)
+
+	def image(self):
+		return self.subtractor.getBackgroundImage()
+
+def createBackground(model, samples=9):
+	if model == "blend":
+		return BlendBackground()
+	if model == "median":
+		return MedianBackground(samples)
+	if model in ("mog2", "knn"):
+		return SubtractorBackground(model)
+
+	return AccumulatedBackground()
+
+# Decides when to blend frames into the background, by capture time rather
+# than by frame count. 'blend_rate' is the share of the background kept per
+# 'interval' seconds; longer gaps blend in proportionally more.
+class BackgroundSchedule:
+	def __init__(self, interval, blend_rate):
+		self.interval = interval
+		self.blend_rate = blend_rate
+		self.last = None
+
+	def restart(self, timestamp):
+		self.last = timestamp
+
+	# Retention for a frame captured at 'timestamp', or None when no update is due
+	def due(self, timestamp):
+		if self.last is None:
+			self.last = timestamp
+			return None
+
+		elapsed = timestamp - self.last
+		if elapsed < self.interval:
+			return None
+
+		self.last = timestamp
+		if self.interval <= 0:
+			return self.blend_rate
+
+		return self.blend_rate ** (elapsed / self.interval)
+
+class TextSprite:
+	# A line of text rasterised once into a coverage mask, then copied onto
+	# frames with draw(). Without anti-aliasing the result is the same as
+	# cv2.putText(); with cv2.LINE_AA the mask is alpha blended in place by
+	# cv2.blendLinear(), which may round a pixel differently.
+	def __init__(self, text, font, scale, color, thickness, line_type=cv2.LINE_8):
+		((w, h), baseline) = cv2.getTextSize(text, font, scale, thickness)
+		pad = thickness + 2
+		# Position of the text origin within the sprite
+		self.origin = (pad, h + pad)
+		mask = numpy.zeros((h + baseline + 2 * pad, w + 2 * pad), numpy.uint8)
+		cv2.putText(mask, text, self.origin, font, scale, 255, thickness, line_type)
+
+		self.color = numpy.array(color, numpy.uint8)
+		self.blend = line_type == cv2.LINE_AA
+		if self.blend:
+			self.alpha = mask.astype(numpy.float32) / 255.0
+			self.inverse = 1.0 - self.alpha
+			self.fill = numpy.empty(mask.shape + (3,), numpy.uint8)
+			self.fill[:] = self.color
+		else:
+			self.mask = (mask > 0)[:, :, None]
+
+	# Draw with the text origin at 'origin', like cv2.putText()
+	def draw(self, image, origin):
+		(height, width) = image.shape[:2]
+		(h, w) = (self.mask if not self.blend else self.alpha).shape[:2]
+		x = origin[0] - self.origin[0]
+		y = origin[1] - self.origin[1]
+		(x0, y0, x1, y1) = (max(x, 0), max(y, 0), min(x + w, width), min(y + h, height))
+		if x0 >= x1 or y0 >= y1:
+			return
+
+		roi = image[y0:y1, x0:x1]
+		sprite = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+		if self.blend:
+			cv2.blendLinear(roi, self.fill[sprite], self.inverse[sprite], self.alpha[sprite], dst=roi)
+		else:
+			numpy.copyto(roi, self.color, where=self.mask[sprite])
+
+class Annotations:
+	# What is to be drawn on one frame, kept as a list of commands so the
+	# drawing only happens for frames that are written or snapshotted, and
+	# then preferably on an encoder thread. Points are in working resolution
+	# and mapped to the frame drawn on with point(), using 'ratio', the size
+	# of that frame relative to the detection frame, and 'resolution'. Fixed
+	# text is drawn from cached TextSprites, the date and time from one
+	# sprite per second. The caches are shared by every encoder thread.
+	MAX_SPRITES = 256
+	sprites = {}
+	clock = (None, None)
+	lock = Lock()
+
+	def __init__(self, ratio, resolution):
+		self.ratio = ratio
+		self.resolution = resolution
+		self.commands = []
+		self.rendered = False
+
+	def add(self, *command):
+		self.commands.append(command)
+
+	@classmethod
+	def sprite(cls, text, font, scale, color, thickness, line_type=cv2.LINE_8):
+		key = (text, font, scale, color, thickness, line_type)
+		with cls.lock:
+			sprite = cls.sprites.get(key)
+			if sprite is None:
+				if len(cls.sprites) >= cls.MAX_SPRITES:
+					cls.sprites.clear()
+				sprite = cls.sprites[key] = TextSprite(text, font, scale, color, thickness, line_type)
+
+		return sprite
+
+	@classmethod
+	def clockSprite(cls, timestamp):
+		second = int(math.floor(timestamp))
+		with cls.lock:
+			clock = cls.clock
+			if not clock[0] == second:
+				text = datetime.datetime.fromtimestamp(second).strftime("%m/%d/%Y %H:%M:%S")
+				clock = cls.clock = (second, TextSprite(text, cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, (255, 255, 255), 2))
+
+		return clock[1]
+
+	def point(self, x, y):
+		return (int(math.floor(x * self.ratio[0] / self.resolution)), int(math.floor(y * self.ratio[1] / self.resolution)))
+
+	# Draw the commands onto 'image', which must be the frame they were collected for or a copy of it
+	def render(self, image):
+		for command in self.commands:
+			if command[0] == "box":
+				(_, x, y, w, h, cx, cy, area) = command
+				cv2.circle(image, self.point(cx, cy), 1, (0, 0, 255), 1)
+				cv2.rectangle(image, self.point(x, y), self.point(x + w, y + h), (0, 255, 0), 1)
+				cv2.putText(image, str(area), self.point(x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+
+			elif command[0] == "text":
+				(_, text, origin, color) = command
+				self.sprite(text, cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, color, 2, cv2.LINE_AA).draw(image, origin)
+
+			elif command[0] == "bar":
+				(_, x, y, w, h, current, maximum, color) = command
+				cv2.rectangle(image, (x, y - h), (x + w, y), (color), 1)
+				if current > maximum or maximum <= 0:
+					current = maximum = 1
+
+				w = int(math.floor(float(w) / float(maximum) * float(current)))
+				cv2.rectangle(image, (int(math.floor(x)), int(math.floor(y - h))), (int(math.floor(x + w)), int(math.floor(y + 2))), (color), -1)
+
+			elif command[0] == "time":
+				self.clockSprite(command[1]).draw(image, (20, 90))
+
+		self.rendered = True
+		return image
+
+class Frame:
+	# With 'replay', time is taken from the position in the video rather
+	# than the wall clock, so a file can be processed as fast as possible.
+	# With 'record_video', 'video' is only used for detection. self.frame is
+	# then the frame of 'record_video' closest in time while recording is
+	# enabled, and the detection frame otherwise.
+	def __init__(self, video, resolution, buffer_size=4, drop_policy="drop-oldest", on_frame=None, capture_process=False, on_demand=False, preprocess=None, replay=False, record_video=None, stream_offset=0.0, max_skew=0.25, decode_rate=0):
+		if replay:
+			self.captureStream = ThreadedStream(video, buffer_size, drop_policy, on_frame, on_demand, replay, decode_rate=decode_rate).start()
+		else:
+			stream = ProcessStream if capture_process else ThreadedStream
+			self.captureStream = stream(video=video, buffer_size=buffer_size, drop_policy=drop_policy, on_frame=on_frame, on_demand=on_demand).start()
+
+		self.resolution = resolution
+		self.preprocess = Preprocessor() if preprocess is None else preprocess
+		self.counter = FrameCounter((lambda: self.timestamp) if replay else None)
+		self.fullWidth = 0
+		self.fullHeight = 0
+		self.detectWidth = 0
+		self.detectHeight = 0
+
+		self.recordStream = None
+		self.stream_offset = stream_offset
+		self.max_skew = max_skew
+		if record_video is not None:
+			self.recordStream = RecordingStream(record_video, buffer_size, replay, getattr(self.captureStream, 'origin', None)).start()
+			(self.fullWidth, self.fullHeight) = self.recordStream.size
+
+		# Size of self.frame relative to the detection frame
+		self.canvas_ratio = (1.0, 1.0)
+
+		self.opencv_frame = None
+		self.frame = None
+		# Annotations for self.frame, drawn by renderedFrame() or by whoever writes it
+		self.annotations = None
+		self.sequence = 0
+		self.timestamp = 0.0
+		self.region = None
+		# Reduced and blurred frames by region, None for the whole frame
+		self.reduced = {}
+		self.blur = {}
+		self.motion_mask = None
+
+		self.reported_drops = 0
+		self.last_drop_report = 0.0
+
+	# Blocks until the capture thread has a frame. Returns None when the stream has ended.
+	def next(self, latest=False):
+		captured = self.captureStream.read(latest=latest)
+		if captured is None:
+			return None
+
+		(self.opencv_frame, self.sequence, self.timestamp) = captured
+		self.frame = self.opencv_frame
+		if self.recordStream is not None and self.recordStream.enabled:
+			frame = self.recordStream.frameAt(self.timestamp + self.stream_offset, self.max_skew)
+			if frame is not None:
+				self.frame = frame
+
+		self.canvas_ratio = (self.frame.shape[1] / float(self.opencv_frame.shape[1]), self.frame.shape[0] / float(self.opencv_frame.shape[0]))
+		self.annotations = Annotations(self.canvas_ratio, self.resolution)
+		if self.detectHeight is 0 or self.detectWidth is 0:
+			(self.detectHeight, self.detectWidth) = self.opencv_frame.shape[:2]
+			if self.recordStream is None:
+				(self.fullHeight, self.fullWidth) = self.frame.shape[:2]
+
+			self.counter.start()
+			print("Capture started")
+
+		self.reduced.clear()
+		self.blur.clear()
+
+		self.counter.update()
+		self.reportDrops()
+		return self.frame
+
+	# Let the console know, at most once a minute, when detection can't keep up with the camera.
+	def reportDrops(self):
+		if self.timestamp - self.last_drop_report < 60:
+			return
+
+		self.last_drop_report = self.timestamp
+		stats = self.stats()
+		if stats['dropped'] > self.reported_drops:
+			print(datetime.datetime.now().strftime("[%H:%M:%S] Detection is behind capture: ") + str(stats['dropped'] - self.reported_drops) + " frames dropped (" + str(stats['captured']) + " captured, " + str(stats['consumed']) + " processed)")
+			self.reported_drops = stats['dropped']
+
+		if stats['grabbed'] > stats['decoded']:
+			print(datetime.datetime.now().strftime("[%H:%M:%S] Decode on demand: ") + str(stats['decoded']) + " of " + str(stats['grabbed']) + " grabbed frames decoded")
+
+	def stats(self):
+		stats = self.captureStream.stats()
+		if self.recordStream is not None:
+			record = self.recordStream.stats()
+			stats.update({'record_grabbed': record['grabbed'], 'record_decoded': record['decoded']})
+
+		return stats
+
+	# Decode the recording stream, when there is one, only while enabled
+	def setRecording(self, enabled):
+		if self.recordStream is not None:
+			self.recordStream.setEnabled(enabled)
+
+	def stop(self):
+		# Frames may be views into the capture buffer; let go of them first
+		self.opencv_frame = None
+		self.frame = None
+		self.captureStream.stop()
+		if self.recordStream is not None:
+			self.recordStream.frame = None
+			self.recordStream.stop()
+
+	def fps(self):
+		return self.counter.fps()
+
+	# Frame rate the capture stream says it runs at, or None when it doesn't
+	# say or says something no camera does (RTSP sources can report the
+	# 90 kHz clock rate)
+	def nominalFps(self):
+		fps = self.captureStream.nominal_fps
+		if fps is None or not 0 < fps <= 240:
+			return None
+
+		return fps
+
+	# (width, height) of the frames the detector works on
+	def workingSize(self):
+		return (int(math.floor(self.detectWidth * self.resolution)), int(math.floor(self.detectHeight * self.resolution)))
+
+	# (x, y) multipliers from full frame pixels, which zones are drawn in,
+	# to working resolution pixels
+	def zoneScale(self):
+		return (self.resolution * self.detectWidth / float(self.fullWidth), self.resolution * self.detectHeight / float(self.fullHeight))
+
+	# self.frame at full frame size, scaled up when it is a detection frame
+	# standing in for the recording stream
+	def fullFrame(self):
+		if (self.frame.shape[1], self.frame.shape[0]) == (self.fullWidth, self.fullHeight):
+			return self.frame
+
+		return cv2.resize(self.frame, (self.fullWidth, self.fullHeight))
+
+	# fullFrame() with the annotations drawn. Drawing is done on self.frame,
+	# once. While detection may still reduce the whole capture frame, as a
+	# cropped frame does when the background is reset, a copy of it is
+	# drawn on and becomes self.frame.
+	def renderedFrame(self):
+		if not self.annotations.rendered:
+			if self.frame is self.opencv_frame and not None in self.blur:
+				self.frame = self.frame.copy()
+			self.annotations.render(self.frame)
+
+		return self.fullFrame()
+
+	# (frame, annotations) to hand to another thread, which draws the
+	# annotations on its copy of the frame. The annotations are None when
+	# they are already drawn, and always are for a frame that needs scaling
+	# up to full frame size unless 'full_size' is False.
+	def annotatedFrame(self, full_size=True):
+		if full_size and not (self.frame.shape[1], self.frame.shape[0]) == (self.fullWidth, self.fullHeight):
+			return (self.renderedFrame(), None)
+
+		return (self.frame, None if self.annotations.rendered else self.annotations)
+
+	# Restrict detection to (x, y, w, h) at working resolution, or None for
+	# the whole frame. Everything from reduceFrame() on is then cropped,
+	# unless 'cropped' is False.
+	def setRegion(self, region):
+		self.region = region
+		self.reduced.clear()
+		self.blur.clear()
+
+	def reduceFrame(self, cropped=True):
+		region = self.region if cropped else None
+		if not region in self.reduced:
+			self.reduced[region] = self.preprocess.reduce(self.opencv_frame, self.resolution, region)
+
+		return self.reduced[region]
+
+	def blurFrame(self, cropped=True):
+		region = self.region if cropped else None
+		if not region in self.blur:
+			self.blur[region] = self.preprocess.smooth(self.reduceFrame(cropped))
+
+		return self.blur[region]
+
+	# Blobs are always in working resolution frame coordinates, also when
+	# cropped. See Preprocessor.blobs() for the filters.
+	#
+	# The background always covers the whole frame and is updated with
+	# whole frames, so that the crop can be compared to it in between
+	# updates. A frame with motion near the edge of the crop is processed
+	# whole after all, so blobs crossing the edge are not cut off.
+	def getBlobsDifferentTo(self, background, retention=None, min_area=0, max_area=0, min_size=(0, 0)):
+		if self.region is not None and retention is None and background.regional:
+			(x, y, w, h) = self.region
+			(width, height) = self.workingSize()
+			edges = (x > 0, y > 0, x + w < width, y + h < height)
+			(self.motion_mask, blobs) = self.preprocess.blobs(background, self.blurFrame(), None, (x, y), min_area, max_area, min_size, self.region, edges)
+			if blobs is not None:
+				return blobs
+
+		(self.motion_mask, blobs) = self.preprocess.blobs(background, self.blurFrame(False), retention, (0, 0), min_area, max_area, min_size)
+		return blobs
+
+	# The draw methods only collect commands in self.annotations
+	def drawContourBox(self, x, y, w, h, cx, cy, cArea):
+		self.annotations.add("box", x, y, w, h, cx, cy, cArea / self.zoneScale()[0] / self.zoneScale()[1])
+
+	def drawStatusLists(self, zones):
+		y = self.frame.shape[0] - (len(zones) * 32) - 20
+		for name in zones:
+			y += 32
+			if zones[name].state.state is 0:
+				self.annotations.add("text", name + ": Inactive", (20, y), (255, 0, 0))
+
+			if zones[name].state.state is 1:
+				self.annotations.add("text", name + ": Monitor", (20, y), (0, 174, 255))
+				self.drawProgressBar(350, y, 300, 22, self.timestamp - zones[name].state.since, float(zones[name].attrs['warmup']), (0, 174, 255))
+
+			if zones[name].state.state is 2:
+				self.annotations.add("text", name + ": Active", (20, y), (0, 0, 255))
+
+			if zones[name].state.state is 3:
+				self.annotations.add("text", name + ": Cooldown", (20, y), (127, 255, 0))
+				self.drawProgressBar(350, y, 300, 22, zones[name].state.missed, float(zones[name].attrs['cooldown']), (127, 255, 0))
+
+			if zones[name].state.state is 4:
+				self.annotations.add("text", name + ": Continuation", (20, y), (195, 0, 255))
+				self.drawProgressBar(350, y, 300, 22, zones[name].state.count.hit, int(zones[name].attrs['continuation']), (195, 0, 255))
+
+	def drawProgressBar(self, x, y, w, h, current, maximum, color):
+		self.annotations.add("bar", x, y, w, h, current, maximum, color)
+
+	def putDateTime(self):
+		self.annotations.add("time", self.timestamp)
+
+class PreRollBuffer:
+	# The last few seconds of footage, held as JPEG bytes so a pre-roll at
+	# 2560x1440 costs a few MB instead of hundreds. Frames can optionally be
+	# downscaled before compression; they are scaled back up when flushed.
+	def __init__(self, seconds, scale=1.0, quality=80, max_bytes=256 * 1024 * 1024):
+		self.seconds = seconds
+		self.scale = scale
+		self.quality = quality
+		self.max_bytes = max_bytes
+		self.lock = Lock()
+		self.frames = deque()
+		self.bytes = 0
+
+	def add(self, frame, timestamp):
+		if self.scale < 1.0:
+			frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+		(success, data) = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+		if not success:
+			return
+
+		with self.lock:
+			self.frames.append((timestamp, data))
+			self.bytes += len(data)
+			while self.frames and (self.frames[0][0] < timestamp - self.seconds or self.bytes > self.max_bytes):
+				self.bytes -= len(self.frames.popleft()[1])
+
+	# (timestamp, decoded frame) in capture order, emptying the buffer.
+	def drain(self, size):
+		with self.lock:
+			frames = list(self.frames)
+			self.frames.clear()
+			self.bytes = 0
+
+		for (timestamp, data) in frames:
+			frame = cv2.imdecode(data, cv2.IMREAD_COLOR)
+			if not (frame.shape[1], frame.shape[0]) == tuple(size):
+				frame = cv2.resize(frame, tuple(size))
+
+			yield (timestamp, frame)
+
+class EncoderWorker:
+	# Owns one cv2.VideoWriter at a time and runs the commands queued for it.
+	def __init__(self, writer):
+		self.writer = writer
+		self.queue = Queue()
+		self.output = None
+		self.path = None
+		self.clip = None
+		self.on_close = None
+		self.thread = Thread(target=self.update, args=())
+		self.thread.daemon = True
+		self.thread.start()
+
+	def update(self):
+		while True:
+			command = self.queue.get()
+			if command[0] == "frame":
+				(_, buf, queued_at, annotations, timestamp) = command
+				if self.output is not None:
+					if self.clip['start'] is None:
+						self.clip['start'] = timestamp
+					if annotations is not None:
+						annotations.render(buf)
+					started = time.time()
+					self.output.write(buf)
+					self.writer.encoded(buf, started - queued_at, time.time() - started)
+				else:
+					self.writer.encoded(buf, None, None)
+
+			elif command[0] == "preroll":
+				(_, buf, timestamp, annotations) = command
+				if annotations is not None:
+					annotations.render(buf)
+				self.writer.pre_roll.add(buf, timestamp)
+				self.writer.encoded(buf, None, None)
+
+			elif command[0] == "open":
+				self.release()
+				(_, self.path, fps, size, self.on_close, self.clip) = command
+				self.output = cv2.VideoWriter(self.path, self.writer.codec, fps, size)
+				if not self.output.isOpened():
+					print(datetime.datetime.now().strftime("[%H:%M:%S] Could not open ") + self.path + " for writing")
+
+				# Start the clip with the footage from before the event
+				if self.writer.pre_roll is not None:
+					for (timestamp, frame) in self.writer.pre_roll.drain(size):
+						if self.clip['start'] is None:
+							self.clip['start'] = timestamp
+						self.output.write(frame)
+
+			elif command[0] == "close":
+				self.release()
+
+			elif command[0] == "stop":
+				self.release()
+				return
+
+	def release(self):
+		if self.output is None:
+			return
+
+		self.output.release()
+		self.output = None
+		if self.on_close is not None:
+			self.on_close(self.path)
+
+class ClipWriter:
+	# Encodes recorded clips off the detection thread. Frames are copied into
+	# a bounded pool of reusable buffers and handed to encoder threads; when
+	# the pool is exhausted the frame is dropped rather than stalling
+	# detection. Each clip is encoded by one worker, and open() and rotate()
+	# hand the next clip to the next worker, so consecutive clips of a long
+	# recording can encode in parallel. Between recordings, frames passed to
+	# preroll() are compressed into a PreRollBuffer and written at the start
+	# of the next clip. With 'block', as when replaying a file, frames wait
+	# for a free buffer instead, so every clip is complete.
+	def __init__(self, codec, queue_size=64, workers=1, pre_roll=None, block=False):
+		self.codec = codec
+		self.queue_size = queue_size
+		self.pre_roll = pre_roll
+		self.block = block
+		self.condition = Condition()
+		self.buffers = 0
+		self.free = deque()
+		self.workers = [EncoderWorker(self) for i in range(max(1, workers))]
+		self.next_worker = 0
+		self.current = None
+		self.fps = None
+		self.size = None
+
+		self.written = 0
+		self.dropped = 0
+		self.pre_roll_dropped = 0
+		self.queued = 0
+		self.max_queued = 0
+		self.encode_time = 0.0
+		self.max_encode_time = 0.0
+		self.max_wait_time = 0.0
+		# LatencyMetrics for the encoder threads, when enabled
+		self.timings = None
+
+	# Start a new clip. on_close(path) is called from the encoder thread once
+	# the file is complete. Returns a record of the clip whose 'start' is
+	# set to the time of its first frame, pre-roll included, once written.
+	def open(self, path, fps, size, on_close=None):
+		self.close()
+		self.current = self.workers[self.next_worker]
+		self.next_worker = (self.next_worker + 1) % len(self.workers)
+		self.fps = fps
+		self.size = size
+		clip = {'path': path, 'start': None}
+		self.current.queue.put(("open", path, fps, size, on_close, clip))
+		return clip
+
+	# Finish the current clip and continue the recording in a new file.
+	def rotate(self, path, on_close=None):
+		return self.open(path, self.fps, self.size, on_close)
+
+	def close(self):
+		if self.current is not None:
+			self.current.queue.put(("close",))
+			self.current = None
+
+	# Copy a frame into a free buffer, or return None when all are in use
+	# and not blocking.
+	def acquire(self, frame):
+		with self.condition:
+			while not self.free and self.buffers >= self.queue_size:
+				if not self.block:
+					return None
+				self.condition.wait()
+
+			if self.free:
+				buf = self.free.popleft()
+			else:
+				buf = None
+				self.buffers += 1
+
+			self.queued += 1
+			self.max_queued = max(self.max_queued, self.queued)
+
+		if buf is None or not buf.shape == frame.shape:
+			buf = numpy.empty_like(frame)
+
+		numpy.copyto(buf, frame)
+		return buf
+
+	# 'annotations', when given, are drawn on the copy of the frame by the
+	# encoder thread. 'timestamp' is when the frame was captured.
+	def write(self, frame, annotations=None, timestamp=None):
+		if self.current is None:
+			return False
+
+		buf = self.acquire(frame)
+		if buf is None:
+			with self.condition:
+				self.dropped += 1
+			return False
+
+		self.current.queue.put(("frame", buf, time.time(), annotations, timestamp))
+		return True
+
+	# Offer a frame captured at 'timestamp' to the pre-roll while no clip is open.
+	def preroll(self, frame, timestamp, annotations=None):
+		if self.pre_roll is None or self.current is not None:
+			return False
+
+		buf = self.acquire(frame)
+		if buf is None:
+			with self.condition:
+				self.pre_roll_dropped += 1
+			return False
+
+		# Queue it on the worker that will receive the next clip, so it is compressed before that clip opens
+		self.workers[self.next_worker].queue.put(("preroll", buf, timestamp, annotations))
+		return True
+
+	# Called by the encoder workers when they're done with a buffer.
+	def encoded(self, buf, wait_time, encode_time):
+		with self.condition:
+			self.free.append(buf)
+			self.queued -= 1
+			self.condition.notify()
+			if encode_time is not None:
+				self.written += 1
+				self.encode_time += encode_time
+				self.max_encode_time = max(self.max_encode_time, encode_time)
+				self.max_wait_time = max(self.max_wait_time, wait_time)
+
+		if encode_time is not None and self.timings is not None:
+			self.timings.add("encode", encode_time)
+			self.timings.add("encode_wait", wait_time)
+
+	def stop(self):
+		self.close()
+		for worker in self.workers:
+			worker.queue.put(("stop",))
+
+		for worker in self.workers:
+			worker.thread.join()
+
+	def stats(self):
+		with self.condition:
+			average = self.encode_time / self.written if self.written > 0 else 0.0
+			return {'queue_depth': self.queued, 'max_queue_depth': self.max_queued, 'written': self.written, 'dropped': self.dropped, 'pre_roll_dropped': self.pre_roll_dropped, 'encode_ms': average * 1000, 'max_encode_ms': self.max_encode_time * 1000, 'max_wait_ms': self.max_wait_time * 1000}
+
+# Records clips by copying the compressed packets of a stream into MP4 or
+# MKV files through PyAV, without decoding or encoding. The last
+# 'seconds' of packets are kept as whole GOPs, so a clip starts on the
+# keyframe at or before its pre-roll. Has the ClipWriter interface; the
+# frames handed to preroll() are ignored.
+class PacketRecorder:
+	def __init__(self, video, container="mp4", seconds=3.0, sidecar=False, replay=False, origin=None, offset=0.0):
+		if av is None:
+			raise ValueError("--record-mode copy needs PyAV (pip install av)")
+
+		options = {'rtsp_transport': 'tcp'} if str(video).startswith("rtsp") else {}
+		self.input = av.open(video, options=options)
+		self.stream = self.input.streams.video[0]
+		self.packets = self.input.demux(self.stream)
+		self.container = container
+		self.seconds = seconds
+		self.sidecar = sidecar
+
+		# Live packets are stamped with the time they arrive. Replayed ones
+		# with their position after 'origin', and are only read as far as
+		# detection has got, so a replay gives the same clips every time.
+		self.replay = replay
+		self.origin = time.time() if origin is None else origin
+		self.offset = offset
+		self.waiting = None
+		self.ended = False
+
+		self.lock = Lock()
+		self.stopped = False
+		self.thread = None
+		self.gops = deque()
+		self.output = None
+		self.clip = None
+		self.next_clip = None
+
+		self.written = 0
+		self.clips = 0
+		# LatencyMetrics, when enabled
+		self.timings = None
+
+	def start(self):
+		if not self.replay:
+			self.thread = Thread(target=self.update, args=())
+			self.thread.daemon = True
+			self.thread.start()
+
+		return self
+
+	# The next packet as (timestamp, packet, pts, dts, time_base), or None
+	# at the end of the stream. Muxing rebases a packet in place, so its
+	# original timing is kept with it.
+	def demux(self):
+		try:
+			for packet in self.packets:
+				if packet.size == 0 or (packet.pts is None and packet.dts is None):
+					continue
+
+				if self.replay:
+					timestamp = self.origin + float((packet.pts if packet.pts is not None else packet.dts) * packet.time_base)
+				else:
+					timestamp = time.time()
+
+				return (timestamp - self.offset, packet, packet.pts, packet.dts, packet.time_base)
+		except av.FFmpegError as error:
+			print(datetime.datetime.now().strftime("[%H:%M:%S] ") + "Recording stream failed: " + str(error))
+
+		return None
+
+	def update(self):
+		while not self.stopped:
+			entry = self.demux()
+			if entry is None:
+				break
+
+			self.add(entry)
+
+	# When replaying, read packets up to 'timestamp'
+	def advance(self, timestamp):
+		while self.replay and not self.ended:
+			if self.waiting is None:
+				self.waiting = self.demux()
+				if self.waiting is None:
+					self.ended = True
+					break
+
+			if self.waiting[0] > timestamp:
+				break
+
+			self.add(self.waiting)
+			self.waiting = None
+
+	def add(self, entry):
+		(timestamp, packet) = entry[:2]
+		with self.lock:
+			if packet.is_keyframe:
+				self.gops.append([entry])
+				# Rotated clips start on a keyframe, without pre-roll
+				if self.next_clip is not None:
+					self.closeClip()
+					self.openClip(self.next_clip, False)
+					self.next_clip = None
+			elif self.gops:
+				self.gops[-1].append(entry)
+
+			while len(self.gops) >= 2 and self.gops[1][0][0] <= timestamp - self.seconds:
+				self.gops.popleft()
+
+			if self.output is not None:
+				self.mux(entry)
+
+	def mux(self, entry):
+		(timestamp, packet, pts, dts, time_base) = entry
+		if self.clip['start'] is None:
+			self.clip['start'] = timestamp
+			self.clip['base'] = dts if dts is not None else pts
+
+		packet.time_base = time_base
+		packet.pts = None if pts is None else pts - self.clip['base']
+		packet.dts = None if dts is None else dts - self.clip['base']
+		packet.stream = self.output.streams.video[0]
+		self.output.mux(packet)
+		self.written += 1
+
+	# Call with the lock held
+	def openClip(self, clip, pre_roll):
+		self.output = av.open(clip['path'], "w", format="matroska" if self.container == "mkv" else self.container)
+		self.output.add_stream_from_template(self.stream)
+		self.clip = clip
+		if self.sidecar:
+			self.clip['sidecar'] = open(os.path.splitext(clip['path'])[0] + ".jsonl", "w")
+
+		self.clips += 1
+		if pre_roll:
+			for gop in self.gops:
+				for entry in gop:
+					self.mux(entry)
+
+	# Call with the lock held
+	def closeClip(self):
+		if self.output is None:
+			return
+
+		self.output.close()
+		self.output = None
+		if 'sidecar' in self.clip:
+			self.clip['sidecar'].close()
+
+		if self.clip['on_close'] is not None:
+			self.clip['on_close'](self.clip['path'])
+
+		self.clip = None
+
+	# Start a new clip with the pre-roll. 'fps' and 'size' come from the
+	# stream. Returns the clip, whose 'start' is the time of its first
+	# packet, the keyframe at or before the pre-roll, once it is muxed.
+	def open(self, path, fps=None, size=None, on_close=None):
+		clip = {'path': path, 'on_close': on_close, 'start': None, 'base': 0}
+		with self.lock:
+			self.closeClip()
+			self.next_clip = None
+			self.openClip(clip, True)
+
+		return clip
+
+	# Continue the recording in a new file from the next keyframe
+	def rotate(self, path, on_close=None):
+		clip = {'path': path, 'on_close': on_close, 'start': None, 'base': 0}
+		with self.lock:
+			self.next_clip = clip
+
+		return clip
+
+	def close(self):
+		with self.lock:
+			self.next_clip = None
+			self.closeClip()
+
+	def preroll(self, frame, timestamp, annotations=None):
+		self.advance(timestamp)
+		return True
+
+	# Log what was drawn on the frame captured at 'timestamp' to the sidecar
+	def annotate(self, timestamp, overlay):
+		self.advance(timestamp)
+		with self.lock:
+			if self.clip is None or not 'sidecar' in self.clip:
+				return
+
+			start = timestamp if self.clip['start'] is None else self.clip['start']
+			self.clip['sidecar'].write(json.dumps(dict(overlay, time=timestamp, offset=round(timestamp - start, 3))) + "\n")
+
+	def stop(self):
+		self.stopped = True
+		self.close()
+		if self.thread is not None:
+			self.thread.join(5)
+
+		self.input.close()
+
+	def stats(self):
+		with self.lock:
+			return {'queue_depth': 0, 'max_queue_depth': 0, 'written': self.written, 'dropped': 0, 'pre_roll_dropped': 0, 'encode_ms': 0.0, 'max_encode_ms': 0.0, 'max_wait_ms': 0.0, 'clips': self.clips}
+
+# Continuous recording into fixed-length segments in 'path', as a ring
+# bounded by 'max_bytes' and 'max_age' seconds. The oldest segments are
+# deleted as new ones complete. Events are kept as time ranges, with the
+# segments and offsets they cover, so an event starting costs no file or
+# codec work and overlapping events share the same footage. Segments to
+# be uploaded are kept until handed to on_upload, and after that for as
+# long as pinned(path) is True, i.e. while the upload is pending.
+class SegmentStore:
+	def __init__(self, path, writer, extension, seconds=60.0, max_bytes=20 * 1024 ** 3, max_age=24 * 3600.0, on_upload=None, pinned=None):
+		self.path = path
+		self.writer = writer
+		self.extension = extension
+		self.seconds = seconds
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.on_upload = on_upload
+		self.pinned = pinned
+		self.lock = Lock()
+		self.current = None
+		self.last = None
+		self.evicted = 0
+		self.events = 0
+
+		# Segments left by an earlier run count towards the limits too
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		self.segments = deque()
+		for name in sorted(os.listdir(path)):
+			if name.startswith("segment_") and name.endswith(extension):
+				try:
+					start = time.mktime(time.strptime(name[:-len(extension)], "segment_%Y-%m-%d_%H-%M-%S"))
+				except ValueError:
+					continue
+
+				status = os.stat(os.path.join(path, name))
+				self.segments.append({'path': os.path.join(path, name), 'start': start, 'end': status.st_mtime, 'bytes': status.st_size, 'upload': False, 'queued': False})
+
+	# Start the next segment when the current one is full. 'fps' and 'size'
+	# are passed to the writer.
+	def update(self, timestamp, fps, size):
+		self.last = timestamp
+		if self.current is not None and timestamp - self.current['start'] < self.seconds:
+			return
+
+		name = datetime.datetime.fromtimestamp(timestamp).strftime("segment_%Y-%m-%d_%H-%M-%S") + self.extension
+		segment = {'path': os.path.join(self.path, name), 'start': timestamp, 'end': None, 'bytes': 0, 'upload': False, 'queued': False}
+		with self.lock:
+			if self.current is not None:
+				self.current['end'] = timestamp
+
+			self.segments.append(segment)
+
+		on_close = lambda path, segment=segment: self.segmentClosed(segment)
+		if self.current is None:
+			self.writer.open(segment['path'], fps, size, on_close)
+		else:
+			self.writer.rotate(segment['path'], on_close)
+
+		self.current = segment
+
+	# Called by the writer once a segment file is complete
+	def segmentClosed(self, segment):
+		with self.lock:
+			segment['bytes'] = os.path.getsize(segment['path']) if os.path.exists(segment['path']) else 0
+			if segment['end'] is None:
+				segment['end'] = self.last
+
+			upload = segment['upload']
+
+		if upload:
+			self.queue([segment])
+
+		with self.lock:
+			self.evict(segment['end'] if segment['end'] is not None else segment['start'])
+
+	# Hand 'segments' to on_upload. Until then eviction leaves them alone.
+	def queue(self, segments):
+		if self.on_upload is not None:
+			for segment in segments:
+				self.on_upload(segment['path'])
+
+		with self.lock:
+			for segment in segments:
+				segment['queued'] = True
+
+	# True while the file of 'segment' is still to be uploaded. Call with the lock held.
+	def keep(self, segment):
+		if segment['upload'] and not segment['queued']:
+			return True
+
+		return self.pinned is not None and self.pinned(segment['path'])
+
+	# Delete complete segments beyond the size or age limits, oldest first,
+	# skipping those still to be uploaded. Call with the lock held.
+	def evict(self, now):
+		total = sum(segment['bytes'] for segment in self.segments)
+		for oldest in list(self.segments):
+			if len(self.segments) <= 1 or oldest is self.current or oldest['end'] is None or (total <= self.max_bytes and oldest['end'] >= now - self.max_age):
+				break
+
+			if self.keep(oldest):
+				continue
+
+			self.segments.remove(oldest)
+			total -= oldest['bytes']
+			self.evicted += 1
+			try:
+				os.remove(oldest['path'])
+			except OSError:
+				pass
+
+	# A new event, 'pre_roll' seconds before 'timestamp'
+	def startEvent(self, timestamp, pre_roll=0.0):
+		return {'start': timestamp - pre_roll, 'end': None, 'zones': [], 'upload': False}
+
+	# Upload the footage of 'event' as its segments complete
+	def uploadEvent(self, event, timestamp):
+		event['upload'] = True
+		uploads = []
+		with self.lock:
+			for segment in self.covering(event['start'], timestamp):
+				if not segment['upload'] and segment['end'] is not None and not segment is self.current and segment['bytes'] > 0:
+					uploads.append(segment)
+
+				segment['upload'] = True
+
+		self.queue(uploads)
+
+	# The segments overlapping 'start' to 'end'. Call with the lock held.
+	def covering(self, start, end):
+		return [segment for segment in self.segments if segment['start'] < end and (segment['end'] is None or segment['end'] > start)]
+
+	# Close 'event' at 'timestamp' and append it to events.jsonl
+	def endEvent(self, event, timestamp):
+		event['end'] = timestamp
+		if event['upload']:
+			self.uploadEvent(event, timestamp)
+
+		with self.lock:
+			event['segments'] = []
+			for segment in self.covering(event['start'], event['end']):
+				offset = max(0.0, event['start'] - segment['start'])
+				end = min(event['end'], segment['end']) if segment['end'] is not None else event['end']
+				event['segments'].append({'path': os.path.basename(segment['path']), 'offset': round(offset, 3), 'duration': round(end - segment['start'] - offset, 3)})
+
+		with open(os.path.join(self.path, "events.jsonl"), "a") as log:
+			log.write(json.dumps(event) + "\n")
+
+		self.events += 1
+		return event
+
+	# Once the writer has stopped, forget segments that never got a file.
+	# A copied stream only switches segments on a keyframe.
+	def stop(self):
+		with self.lock:
+			for segment in list(self.segments):
+				if not os.path.exists(segment['path']):
+					self.segments.remove(segment)
+
+			if self.current is not None and self.segments:
+				self.segments[-1]['end'] = self.last
+
+			self.current = None
+
+	def stats(self):
+		with self.lock:
+			return {'segments': len(self.segments), 'bytes': sum(segment['bytes'] for segment in self.segments), 'evicted': self.evicted, 'events': self.events}
+
+class ScriptUploadBackend:
+	# Runs '<script> <source> <destination>', i.e. s3_upload.sh
+	def __init__(self, script, timeout=600):
+		self.script = script
+		self.timeout = timeout
+
+	def upload(self, source, destination):
+		subprocess.check_output([self.script, source, destination], stderr=subprocess.STDOUT, timeout=self.timeout)
+
+class DirectoryUploadBackend:
+	# Copies files into a local folder. Destinations are file:// URLs or plain paths.
+	def upload(self, source, destination):
+		if destination.startswith("file://"):
+			destination = destination[len("file://"):]
+
+		if os.path.isdir(destination) is False:
+			os.makedirs(destination)
+
+		target = os.path.join(destination, os.path.basename(source))
+		shutil.copyfile(source, target + ".part")
+		os.replace(target + ".part", target)
+
+class NullUploadBackend:
+	# Accepts every upload without sending anything, for replays
+	def __init__(self):
+		self.uploads = []
+
+	def upload(self, source, destination):
+		self.uploads.append((source, destination))
+
+class UploadSpool:
+	# Crash-safe upload queue. Every job is a small JSON file in the spool
+	# folder, written atomically: NAME.job while waiting and NAME.work while
+	# a worker is uploading it. On start-up .work files left behind by a
+	# crash go back to waiting. Failed uploads are retried with exponential
+	# backoff until max_attempts, after which the job is renamed NAME.failed.
+	# Backends are picked by the destination's URL scheme.
+	def __init__(self, path, backends, workers=2, per_destination=1, max_attempts=10, backoff=15.0, max_backoff=1800.0):
+		self.path = path
+		self.backends = backends
+		self.per_destination = per_destination
+		self.max_attempts = max_attempts
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+
+		self.condition = Condition()
+		self.jobs = {}
+		# Jobs being uploaded, by job id
+		self.working = {}
+		self.active = {}
+		self.counter = 0
+		self.stopped = False
+		self.threads = [Thread(target=self.update, args=()) for i in range(max(1, workers))]
+
+		self.uploaded = 0
+		self.retried = 0
+		self.failed = 0
+
+		if os.path.isdir(self.path) is False:
+			os.makedirs(self.path)
+
+		for name in sorted(os.listdir(self.path)):
+			(job_id, extension) = os.path.splitext(name)
+			if extension == ".work":
+				os.replace(os.path.join(self.path, name), os.path.join(self.path, job_id + ".job"))
+			elif not extension == ".job":
+				continue
+
+			try:
+				self.jobs[job_id] = json.loads(open(os.path.join(self.path, job_id + ".job"), "r").read())
+			except ValueError:
+				# Torn write from before the atomic rename was introduced; nothing to salvage
+				os.replace(os.path.join(self.path, job_id + ".job"), os.path.join(self.path, job_id + ".failed"))
+
+	def start(self):
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+		return self
+
+	def stop(self, timeout=None):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify_all()
+
+		for thread in self.threads:
+			thread.join(timeout)
+
+	def backend(self, destination):
+		scheme = destination.split("://", 1)[0] if "://" in destination else "file"
+		return self.backends[scheme]
+
+	# Uploads to the same bucket/folder share one concurrency limit
+	def destinationKey(self, destination):
+		if "://" in destination:
+			(scheme, rest) = destination.split("://", 1)
+			return scheme + "://" + rest.split("/", 1)[0]
+
+		return destination
+
+	def write(self, job_id, job, extension):
+		target = os.path.join(self.path, job_id + extension)
+		with open(target + ".tmp", "w") as handle:
+			handle.write(json.dumps(job))
+			handle.flush()
+			os.fsync(handle.fileno())
+
+		os.replace(target + ".tmp", target)
+
+	# Queue 'source' for upload to 'destination'. Returns once the job is on
+	# disk. The file is written without holding the lock, so the caller
+	# doesn't wait for the workers, nor they for the fsync.
+	def enqueue(self, source, destination):
+		now = time.time()
+		job = {'source': source, 'destination': destination, 'attempts': 0, 'created': now, 'next_attempt': now}
+		with self.condition:
+			self.counter += 1
+			job_id = "%d-%06d" % (int(now * 1000), self.counter)
+
+		self.write(job_id, job, ".job")
+		with self.condition:
+			self.jobs[job_id] = job
+			self.condition.notify()
+
+		return job_id
+
+	# Pick the oldest due job whose destination has a free slot.
+	def claim(self):
+		while not self.stopped:
+			now = time.time()
+			wake = None
+			for job_id in sorted(self.jobs):
+				job = self.jobs[job_id]
+				key = self.destinationKey(job['destination'])
+				if self.active.get(key, 0) >= self.per_destination:
+					continue
+
+				if job['next_attempt'] > now:
+					wake = job['next_attempt'] if wake is None else min(wake, job['next_attempt'])
+					continue
+
+				del self.jobs[job_id]
+				self.working[job_id] = job
+				self.active[key] = self.active.get(key, 0) + 1
+				os.replace(os.path.join(self.path, job_id + ".job"), os.path.join(self.path, job_id + ".work"))
+				return (job_id, job)
+
+			self.condition.wait(None if wake is None else wake - now)
+
+		return None
+
+	def update(self):
+		while True:
+			with self.condition:
+				claimed = self.claim()
+
+			if claimed is None:
+				return
+
+			(job_id, job) = claimed
+			try:
+				self.backend(job['destination']).upload(job['source'], job['destination'])
+				error = None
+			except Exception as e:
+				error = e
+
+			# The job is only back in self.jobs, where claim() can rename
+			# its file, once the file is written
+			retry = False
+			if error is not None:
+				job['attempts'] += 1
+				job['error'] = str(error)
+				print(datetime.datetime.now().strftime("[%H:%M:%S] Upload of ") + job['source'] + " failed (attempt " + str(job['attempts']) + "): " + str(error))
+				retry = job['attempts'] < self.max_attempts and os.path.exists(job['source'])
+				if retry:
+					job['next_attempt'] = time.time() + min(self.max_backoff, self.backoff * (2 ** (job['attempts'] - 1)))
+				self.write(job_id, job, ".job" if retry else ".failed")
+
+			os.remove(os.path.join(self.path, job_id + ".work"))
+
+			with self.condition:
+				del self.working[job_id]
+				self.active[self.destinationKey(job['destination'])] -= 1
+				if error is None:
+					self.uploaded += 1
+				elif retry:
+					self.retried += 1
+					self.jobs[job_id] = job
+				else:
+					self.failed += 1
+
+				self.condition.notify_all()
+
+	# True while 'source' is waiting to be uploaded or being uploaded, so
+	# whoever made it must not delete it yet
+	def pinned(self, source):
+		with self.condition:
+			return any(job['source'] == source for jobs in (self.jobs, self.working) for job in jobs.values())
+
+	def stats(self):
+		with self.condition:
+			return {'pending': len(self.jobs), 'active': sum(self.active.values()), 'uploaded': self.uploaded, 'retried': self.retried, 'failed': self.failed}
+
+class MotionTracker:
+	# 'zabbix' and 'uploads' may be shared between trackers; otherwise the tracker starts its own.
+	def __init__(self, settings, zabbix=None, uploads=None, on_frame=None, index=None):
+		self.resolution = 1.0
+		self.settings = settings
+		if settings['resolution'] < 1.0:
+			self.resolution = settings['resolution']
+
+		# Set the frame source and get the background
+		preprocess = Preprocessor(settings['grey_first'], settings['downscale'], settings['blur'], settings['blur_size'], settings['mask_scale'], settings['dilate_iterations'], settings['blobs'])
+		self.frame = Frame(settings['video'], self.resolution, settings['buffer_size'], settings['drop_policy'], on_frame, settings['capture_process'], settings['decode_on_demand'], preprocess, settings['replay'], settings['record_video'], settings['stream_offset'], settings['max_stream_skew'], settings['target_fps'] if settings['replay'] else 0)
+		self.frame.next()
+		self.scale = self.frame.zoneScale()
+
+		self.to_original = 1.0 / self.resolution
+		self.blend_rate = 1.00 - (settings['blend_rate'] / float(100))
+		self.schedule = BackgroundSchedule(settings['background_interval'], self.blend_rate)
+		self.last_rekey = 0.0
+		self.codec = cv2.VideoWriter_fourcc(*settings["codec"])
+
+		self.zones = {}
+		self.lists = {}
+		self.has_active_zone = False
+		self.snapshot = False
+		self.upload_snapshot = False
+		self.last_snapshot = None
+		self.recording = False
+		self.recorded_frames = 0
+		self.recording_started = None
+		pre_roll = None
+		if settings['motion_buffer'] > 0 and settings['dvr_dir'] is None:
+			pre_roll = PreRollBuffer(settings['motion_buffer'], settings['motion_buffer_scale'], settings['motion_buffer_quality'])
+
+		self.stream_copy = settings['record_mode'] == "copy"
+		self.extension = ".avi"
+		if self.stream_copy:
+			self.extension = "." + settings['copy_container']
+			source = settings['video'] if settings['record_video'] is None else settings['record_video']
+			self.output = PacketRecorder(source, settings['copy_container'], settings['motion_buffer'], settings['overlay_sidecar'], settings['replay'], getattr(self.frame.captureStream, 'origin', None), settings['stream_offset'] if settings['record_video'] else 0.0).start()
+		else:
+			self.output = ClipWriter(self.codec, settings['writer_queue'], settings['encoder_workers'], pre_roll, settings['replay'])
+
+		# With --dvr-dir everything is recorded, and self.event is the time
+		# range of the current event instead of a clip
+		self.dvr = None
+		self.event = None
+		if settings['dvr_dir'] is not None:
+			self.dvr = SegmentStore(settings['dvr_dir'], self.output, self.extension, settings['dvr_segment_seconds'], int(settings['dvr_max_gb'] * 1024 ** 3), settings['dvr_max_hours'] * 3600, lambda path: self.uploads.enqueue(path, self.settings['s3_bucket']), lambda path: self.uploads.pinned(path))
+		self.upload_clip = None
+		self.upload_active = False
+		self.objects = []
+		self.last_processed = 0.0
+		self.decode_rate = 0
+		self.skipped_frames = 0
+
+		# LatencyMetrics for every stage of the pipeline when enabled, and a
+		# list of every zone state change when replaying. zone_blobs, when a
+		# list, gets the (sequence, [(zone, box)]) of every processed frame.
+		self.timings = None
+		self.transitions = None
+		self.zone_blobs = None
+		self.last_metrics_push = self.frame.timestamp
+
+		self.owns_services = zabbix is None
+		if zabbix is None:
+			zabbix = ZabbixDispatcher(settings['zabbix_server'], settings['zabbix_name'], settings['zabbix_port']).start()
+
+		self.zabbix = zabbix
+
+		zones = ZoneSet(settings['polygon_json'], self)
+		self.zones = zones.zones
+		self.raster = zones.raster
+		self.zone_engine = zones.engine
+		self.frame.setRegion(zones.region)
+
+		self.background = createBackground(settings['background_model'], settings['background_samples'])
+		self.background.reset(self.frame.blurFrame(False))
+		if settings['crop_to_zones'] and not self.background.regional:
+			print("--crop-to-zones has no effect with the " + settings['background_model'] + " background model")
+		self.schedule.restart(self.frame.timestamp)
+		cv2.imwrite(settings['keyframe_image'], self.background.image())
+
+		if settings['metrics_port'] > 0 or settings['metrics_zabbix_interval'] > 0:
+			self.enableMetrics()
+
+		if not zones.s3_bucket is None:
+			self.settings['s3_bucket'] = zones.s3_bucket
+
+		if uploads is None:
+			uploads = UploadSpool(settings['upload_spool'], {'s3': ScriptUploadBackend(settings['upload_script']), 'file': DirectoryUploadBackend()}, settings['upload_workers'], settings['upload_concurrency']).start()
+
+		self.uploads = uploads
+
+		# The EventIndex, when there is one, and the clip being recorded
+		self.owns_index = index is None
+		if index is None and settings['event_db'] is not None:
+			index = EventIndex(settings['event_db']).start()
+
+		self.index = index
+		self.clip_file = None
+
+		# Edited zones are compiled on the watcher thread and wait here
+		# until the next frame
+		self.pending_zones = None
+		self.zones_lock = Lock()
+		self.zone_watcher = None
+		if settings['zone_reload_interval'] > 0 and not settings['replay']:
+			self.zone_watcher = FileWatcher(settings['polygon_json'], self.reloadZones, settings['zone_reload_interval']).start()
+
+	# The working resolution rectangle covering every zone, padded by the
+	# reach of the preprocessing so that pixels inside it get the same
+	# values as when the whole frame is processed, plus --crop-margin.
+	def zoneRegion(self, zones):
+		(width, height) = self.frame.workingSize()
+		(x, y, w, h) = cv2.boundingRect(numpy.concatenate([zone.poly for zone in zones.values()]))
+		pad = self.frame.preprocess.reach() + int(math.ceil(self.settings['crop_margin'] * self.resolution))
+		(left, top) = (max(0, x - pad), max(0, y - pad))
+		(right, bottom) = (min(width, x + w + pad), min(height, y + h + pad))
+
+		# With --mask-scale the crop has to start and end on the cells the
+		# whole mask is shrunk to
+		cell = self.frame.preprocess.cell(width, height)
+		if cell is None:
+			print("--crop-to-zones has no effect unless the working frame divides into whole --mask-scale cells")
+			return None
+
+		(left, top) = (left - left % cell, top - top % cell)
+		(right, bottom) = (min(width, right + (-right % cell)), min(height, bottom + (-bottom % cell)))
+		if not self.frame.preprocess.cell(right - left, bottom - top) == cell:
+			return None
+
+		return (left, top, right - left, bottom - top)
+
+	def resetZabbixItems(self):
+		for name in self.zones:
+			Notify(self).sendZabbixValue("mrec." + name.lower(), 0)
+			Notify(self).sendZabbixValue("mdect." + name.lower(), 0)
+
+	# Get the next frame from the camera
+	def getNextFrame(self, latest=False):
+		# Reset the lists and temporary variables;
+		self.has_active_zone = False
+		self.lists = {'inactive': [], 'monitor': [], 'active': [], 'cooldown': [], 'continuation': []}
+
+		self.snapshot = False
+		start = time.perf_counter()
+		captured = self.frame.next(latest) is not None
+		lapTime(self.timings, "capture", start)
+		return captured
+
+	# Returns the members of a list as a comma delimeted string
+	def getListString(list_name):
+		text = "";
+		for (name, value) in self.lists[list_name].iteritems():
+			text += name + ", "
+
+		return text[:-2];
+
+	# Called on the FileWatcher thread when the zones file changes. A file
+	# that does not load leaves the current zones in place.
+	def reloadZones(self, path):
+		try:
+			zones = ZoneSet(path, self)
+		except (OSError, ValueError, KeyError, TypeError) as error:
+			Notify(self).log("Keeping the current zones, " + path + " did not load: " + repr(error))
+			return
+
+		with self.zones_lock:
+			self.pending_zones = zones
+
+	# Switch to the zones of a ZoneSet between two frames. Zones that kept
+	# their name keep their state.
+	def swapZones(self, zones):
+		notify = Notify(self)
+		for name in self.zones:
+			if not name in zones.zones and not self.zones[name].state.state == Zone.INACTIVE:
+				notify.notifyInactive(self.zones[name])
+
+		for name in zones.zones:
+			if name in self.zones:
+				zones.zones[name].inherit(self.zones[name])
+			else:
+				notify.sendZabbixValue("mrec." + name.lower(), 0)
+				notify.sendZabbixValue("mdect." + name.lower(), 0)
+
+		if zones.engine is not None:
+			zones.engine.inherit(self.zone_engine)
+
+		self.frame.setRegion(zones.region)
+
+		if not zones.s3_bucket is None:
+			self.settings['s3_bucket'] = zones.s3_bucket
+
+		added = [name for name in zones.zones if not name in self.zones]
+		removed = [name for name in self.zones if not name in zones.zones]
+		(self.zones, self.raster, self.zone_engine) = (zones.zones, zones.raster, zones.engine)
+		notify.log("Reloaded " + str(len(self.zones)) + " zones, added [" + ", ".join(added) + "], removed [" + ", ".join(removed) + "]")
+
+	def processCurrentFrame(self):
+		# Ignore blobs too small or too big for --min-area and --max-area, or
+		# smaller than the minimum size of every zone
+		area = self.scale[0] * self.scale[1]
+		min_size = (min(zone.minimum_w for zone in self.zones.values()), min(zone.minimum_h for zone in self.zones.values()))
+		objects = self.frame.getBlobsDifferentTo(self.background, self.schedule.due(self.frame.timestamp), self.settings["min_area"] * area, self.settings["max_area"] * area, min_size)
+		start = time.perf_counter()
+
+		self.objects = objects
+		# Look up which zones every center falls in with one pass over the zone raster
+		members = None
+		if len(objects) > 0:
+			centers = numpy.array([(cx, cy) for (x, y, w, h, cx, cy, cArea) in objects])
+			members = self.raster.members(centers[:, 0], centers[:, 1])
+
+		if self.zone_blobs is not None:
+			boxes = [(name, list(objects[i][:4])) for i in range(len(objects)) for (n, name) in enumerate(self.raster.names) if members[i, n]]
+			self.zone_blobs.append((self.frame.sequence, sorted(boxes)))
+
+		if self.zone_engine is not None:
+			self.registerWithEngine(objects, members)
+		else:
+			for (i, (x, y, w, h, cx, cy, cArea)) in enumerate(objects):
+				self.frame.drawContourBox(x, y, w, h, cx, cy, cArea)
+				for (n, name) in enumerate(self.raster.names):
+					if members[i, n]:
+						self.zones[name].registerObject(x, y, w, h, cx, cy, cArea, self.frame.timestamp)
+
+					if self.zones[name].state.state >= 2:
+						self.has_active_zone = True
+
+					if self.zones[name].state.changed_to_active is True:
+						if self.zones[name].attrs['upload_to_s3'] is True:
+							self.upload_snapshot = True
+							self.upload_active = True
+
+						self.snapshot = True
+
+		lapTime(self.timings, "zones", start)
+
+	def endCurrentFrame(self):
+		start = time.perf_counter()
+		if self.zone_engine is not None:
+			# Misses were already handled by ZoneEngine.step()
+			self.has_active_zone = self.zone_engine.active()
+			lapTime(self.timings, "zones", start)
+			return
+
+		for name in self.zones:
+			state = self.zones[name].endFrame(self.frame.timestamp)
+			if state >= 2:
+				self.has_active_zone = True
+
+			'''
+			if state is 0:
+				self.lists['inactive'].append(name)
+
+			if state is 1:
+				self.lists['monitor'].append(name)
+
+			if state is 2:
+				self.lists['active'].append(name)
+
+			if state is 3:
+				self.lists['cooldown'].append(name)
+
+			if state is 4:
+				self.lists['continuation'].append(name)
+			'''
+
+		lapTime(self.timings, "zones", start)
+
+	def run(self):
+		while self.step():
+			pass
+
+		self.finish()
+
+	# Process one frame. Returns False once the stream has ended.
+	def step(self, latest=False):
+		if not self.getNextFrame(latest):
+			return False
+
+		if self.pending_zones is not None:
+			with self.zones_lock:
+				(zones, self.pending_zones) = (self.pending_zones, None)
+
+			self.swapZones(zones)
+
+		# Nothing is going on: only look at --idle-fps frames a second, but
+		# keep feeding the pre-roll. Any hit puts a zone in MONITOR, after
+		# which every frame is processed until all zones are inactive again.
+		if self.isIdle() and self.frame.timestamp - self.last_processed < 1.0 / self.settings['idle_fps']:
+			self.skipped_frames += 1
+			self.frame.drawStatusLists(self.zones)
+			self.frame.putDateTime()
+			if self.dvr is not None:
+				self.recordFrame()
+			else:
+				(frame, annotations) = self.frame.annotatedFrame(full_size=False)
+				self.output.preroll(frame, self.frame.timestamp, annotations)
+			return True
+
+		self.updateDecodeRate()
+		self.last_processed = self.frame.timestamp
+
+		self.processCurrentFrame()
+		self.endCurrentFrame()
+		start = time.perf_counter()
+		self.frame.drawStatusLists(self.zones)
+		self.frame.putDateTime()
+		lapTime(self.timings, "annotate", start)
+		dt = datetime.datetime.fromtimestamp(self.frame.timestamp)
+
+		if self.snapshot:
+			name = dt.strftime(self.settings["filename"])
+			if not self.last_snapshot == name:
+				if os.path.isdir(dt.strftime(self.settings["filepath"])) is False:
+					os.makedirs(dt.strftime(self.settings["filepath"]))
+
+				path = dt.strftime(self.settings["filepath"])
+				start = time.perf_counter()
+				cv2.imwrite(path + name + ".jpg", self.frame.renderedFrame())
+				lapTime(self.timings, "snapshot", start)
+
+				if self.upload_snapshot:
+					self.uploads.enqueue(path + name + ".jpg", self.settings['s3_bucket'])
+					self.upload_snapshot = False
+
+				if self.index is not None:
+					self.index.snapshot(self.settings['zabbix_name'], self.frame.timestamp, path + name + ".jpg")
+
+				Notify(self).sendZabbixValue('mz.latest_snapshot', name + ".jpg")
+
+				self.last_snapshot = name
+			self.snapshot = False
+
+		if self.has_active_zone is True:
+			if self.recording is False:
+				if self.dvr is not None:
+					self.event = self.dvr.startEvent(self.frame.timestamp, self.settings['motion_buffer'])
+				else:
+					self.event = {'start': self.frame.timestamp - self.settings['motion_buffer'], 'end': None, 'zones': [], 'upload': False, 'segments': []}
+					self.openClip(dt)
+				self.recording = True
+				self.last_rekey = self.frame.timestamp
+
+			elif self.dvr is None and self.settings['clip_seconds'] > 0 and (dt - self.recording_started).total_seconds() >= self.settings['clip_seconds']:
+				self.openClip(dt, True)
+
+			# Upload the clip if a zone that uploads to S3 went active during it
+			if self.upload_active:
+				if self.dvr is not None:
+					self.dvr.uploadEvent(self.event, self.frame.timestamp)
+				else:
+					self.upload_clip['upload'] = True
+					self.event['upload'] = True
+				self.upload_active = False
+
+			for name in self.zones:
+				if self.zones[name].state.state >= Zone.ACTIVE and not name in self.event['zones']:
+					self.event['zones'].append(name)
+
+			if self.dvr is None:
+				self.recordFrame()
+			self.recorded_frames += 1
+			if self.frame.timestamp - self.last_rekey >= self.settings['max_hitseconds']:
+				Notify(self).notifyForceRekey()
+				self.background.reset(self.frame.blurFrame(False))
+				self.schedule.restart(self.frame.timestamp)
+				self.last_rekey = self.frame.timestamp
+
+		if self.has_active_zone is False:
+			if self.recording is True:
+				if self.dvr is None:
+					self.output.close()
+				self.endEvent()
+				self.recording = False
+				self.recorded_frames = 0
+				Notify(self).notifyStopRecording(self.output.stats())
+
+		if self.dvr is not None:
+			self.recordFrame()
+		elif self.recording is False:
+			start = time.perf_counter()
+			(frame, annotations) = self.frame.annotatedFrame(full_size=False)
+			self.output.preroll(frame, self.frame.timestamp, annotations)
+			lapTime(self.timings, "preroll", start)
+
+		if self.settings['metrics_zabbix_interval'] > 0 and self.frame.timestamp - self.last_metrics_push >= self.settings['metrics_zabbix_interval']:
+			self.pushMetrics()
+
+		# Start decoding the recording stream as soon as a zone is monitored,
+		# so its frames are there once the zone goes active. Copied clips
+		# only need it for the snapshot taken when a zone goes active.
+		if self.stream_copy:
+			self.frame.setRecording(Zone.MONITOR in [zone.state.state for zone in self.zones.values()])
+		elif self.dvr is not None:
+			self.frame.setRecording(True)
+		else:
+			self.frame.setRecording(self.recording or not self.zonesInactive())
+		return True
+
+	# The stream has ended; close the clip and flush pending notifications
+	def finish(self):
+		if self.zone_watcher is not None:
+			self.zone_watcher.stop()
+
+		self.output.stop()
+		if self.dvr is not None:
+			self.dvr.stop()
+
+		if self.event is not None:
+			self.endEvent()
+
+		if self.index is not None and self.owns_index:
+			self.index.stop(10)
+
+		self.recording = False
+		self.frame.stop()
+		if self.owns_services:
+			self.zabbix.stop(10)
+			self.uploads.stop(1)
+
+	# The recording has stopped: finish the event and index it with its clips
+	# or segments
+	def endEvent(self):
+		if self.dvr is not None:
+			self.dvr.endEvent(self.event, self.frame.timestamp)
+			for segment in self.event['segments']:
+				segment['path'] = os.path.join(self.settings['dvr_dir'], segment['path'])
+		else:
+			self.endClip()
+			self.event['end'] = self.frame.timestamp
+
+		if self.index is not None:
+			self.index.event(self.settings['zabbix_name'], self.event)
+
+		self.event = None
+
+	# Index the clip being recorded, which ends now
+	def endClip(self):
+		if self.clip_file is None:
+			return
+
+		# Where the event starts in the file, as for SegmentStore. Until the
+		# output has written the first frame, assume it is the expected one.
+		(path, expected, clip) = self.clip_file
+		start = expected if clip['start'] is None else clip['start']
+		offset = max(0.0, self.event['start'] - start)
+		self.event['segments'].append({'path': path, 'offset': round(offset, 3), 'duration': round(self.frame.timestamp - start - offset, 3)})
+		if self.index is not None:
+			self.index.clip(self.settings['zabbix_name'], start, self.frame.timestamp, path)
+
+		self.clip_file = None
+
+	# Write the current frame to the open clip, or with --dvr-dir to the
+	# current segment
+	def recordFrame(self):
+		if self.dvr is not None:
+			if not self.stream_copy and self.frame.nominalFps() is None and self.frame.counter.elapsed() < 1.0:
+				# The frame rate for the segment is not known yet
+				return
+
+			self.dvr.update(self.frame.timestamp, self.recordFps(), (self.frame.fullWidth, self.frame.fullHeight))
+
+		start = time.perf_counter()
+		if self.stream_copy:
+			self.output.annotate(self.frame.timestamp, self.overlay())
+		else:
+			(frame, annotations) = self.frame.annotatedFrame()
+			self.output.write(frame, annotations, self.frame.timestamp)
+		lapTime(self.timings, "record", start)
+
+	# One ZoneEngine step for all zones. Unlike the Zone objects, a snapshot
+	# is only taken on the frame a zone goes from MONITOR to ACTIVE.
+	def registerWithEngine(self, objects, members):
+		for (x, y, w, h, cx, cy, cArea) in objects:
+			self.frame.drawContourBox(x, y, w, h, cx, cy, cArea)
+
+		sizes = numpy.array([(w, h) for (x, y, w, h, cx, cy, cArea) in objects]).reshape(-1, 2)
+		(transitions, activated) = self.zone_engine.step(self.zone_engine.hitsFor(sizes, members), self.frame.timestamp)
+		self.notifyTransitions(transitions)
+		if activated.any():
+			self.snapshot = True
+			if (activated & self.zone_engine.upload).any():
+				self.upload_snapshot = True
+				self.upload_active = True
+
+	# What is drawn on the current frame, for the --overlay-sidecar: object
+	# boxes in full frame pixels and the state of every zone
+	def overlay(self):
+		(sx, sy) = self.scale
+		boxes = [[int(x / sx), int(y / sy), int(w / sx), int(h / sy)] for (x, y, w, h, cx, cy, cArea) in self.objects]
+		return {'objects': boxes, 'zones': dict((name, zone.state.state) for (name, zone) in self.zones.items())}
+
+	# Tell Zabbix and the console about ZoneEngine state changes
+	def notifyTransitions(self, transitions):
+		if len(transitions) == 0:
+			return
+
+		notify = Notify(self)
+		methods = {Zone.INACTIVE: notify.notifyInactive, Zone.MONITOR: notify.notifyMonitor, Zone.ACTIVE: notify.notifyActive, Zone.COOLDOWN: notify.notifyCooldown, Zone.CONTINUATION: notify.notifyContinue}
+		for (n, state) in transitions:
+			methods[state](self.zones[self.zone_engine.names[n]])
+
+	# Time every stage of the pipeline from now on
+	def enableMetrics(self):
+		if self.timings is None:
+			self.timings = LatencyMetrics()
+			self.frame.preprocess.timings = self.timings
+			self.output.timings = self.timings
+
+	# Send the latency of every stage since the last push, in ms, as
+	# mz.latency.<stage>.<p50|p95|p99|max>
+	def pushMetrics(self):
+		self.last_metrics_push = self.frame.timestamp
+		notify = Notify(self)
+		for (stage, summary) in sorted(self.timings.window().items()):
+			if summary['count'] == 0:
+				continue
+
+			for quantile in ("p50", "p95", "p99", "max"):
+				notify.sendZabbixValue("mz.latency." + stage + "." + quantile, round(summary[quantile] * 1000, 3))
+
+	# With --decode-on-demand, have the capture side decode only as many
+	# frames as detection is going to look at.
+	# Not when replaying: the decode rate is then fixed to --target-fps when
+	# the file is opened, as the capture thread runs ahead of detection.
+	def updateDecodeRate(self):
+		if self.settings['replay']:
+			return
+
+		rate = self.settings['target_fps']
+		if self.isIdle() and (rate <= 0 or self.settings['idle_fps'] < rate):
+			rate = self.settings['idle_fps']
+
+		if not rate == self.decode_rate:
+			self.frame.captureStream.setDecodeRate(rate)
+			self.decode_rate = rate
+
+	# True when detection may run at the reduced --idle-fps rate
+	def isIdle(self):
+		if self.settings['idle_fps'] <= 0 or self.recording:
+			return False
+
+		return self.zonesInactive()
+
+	def zonesInactive(self):
+		for name in self.zones:
+			if not self.zones[name].state.state == Zone.INACTIVE:
+				return False
+
+		return True
+
+	# Frames a second for clips and segments: what the stream delivers,
+	# capped at --target-fps where that limits the frames detection gets.
+	# The average measured since the start is only used when the stream
+	# doesn't say, as it also counts the time spent at --idle-fps.
+	def recordFps(self):
+		fps = self.frame.nominalFps()
+		if fps is None:
+			fps = self.frame.fps()
+
+		if self.settings['target_fps'] > 0 and (self.settings['decode_on_demand'] or self.settings.get('cameras')):
+			fps = min(fps, self.settings['target_fps'])
+
+		return max(1, math.floor(fps))
+
+	# Start a new clip, or with 'rotate' continue the current recording in a new file
+	def openClip(self, dt, rotate=False):
+		if os.path.isdir(dt.strftime(self.settings["filepath"])) is False:
+			os.makedirs(dt.strftime(self.settings["filepath"]))
+
+		path = dt.strftime(self.settings["filepath"])
+		name = dt.strftime(self.settings["filename"])
+		Notify(self).sendZabbixValue('mz.latest_video', name + self.extension)
+
+		upload = self.upload_clip['upload'] if rotate else False
+		self.upload_clip = {'upload': upload}
+		if rotate:
+			self.endClip()
+
+		on_close = lambda clip_path, clip=self.upload_clip: self.clipClosed(clip_path, clip)
+		if rotate:
+			clip = self.output.rotate(path + name + self.extension, on_close)
+		else:
+			clip = self.output.open(path + name + self.extension, self.recordFps(), (self.frame.fullWidth, self.frame.fullHeight), on_close)
+
+		# For the index: the first clip of an event is expected to start with the pre-roll
+		self.clip_file = (path + name + self.extension, self.frame.timestamp if rotate else self.event['start'], clip)
+
+		self.recording_started = dt
+
+	# Called from the encoder thread once a clip file is complete
+	def clipClosed(self, path, clip):
+		if clip['upload']:
+			self.uploads.enqueue(path, self.settings['s3_bucket'])
+
+
+class ZabbixDispatcher:
+	# Delivers item values to the Zabbix trapper from a background thread so
+	# a slow or unreachable server never stalls the frame loop. Values are
+	# batched over the native sender protocol, falling back to a single
+	# 'zabbix_sender -i' batch file when the server can't be reached directly.
+	# Each key has at most one value waiting, the latest, and a value is
+	# left out when it is what the server last accepted for its key.
+	HEADER = b"ZBXD\x01"
+
+	def __init__(self, server, host, port=10051, max_pending=1000, batch_size=250, timeout=5.0, retry_interval=30.0, sender="/usr/bin/zabbix_sender"):
+		self.server = server
+		self.host = host
+		self.port = port
+		self.max_pending = max_pending
+		self.batch_size = batch_size
+		self.timeout = timeout
+		self.retry_interval = retry_interval
+		self.sender = sender
+
+		self.condition = Condition()
+		self.pending = deque()
+		# (host, key) to its entry in pending, and to the last value delivered
+		self.waiting = {}
+		self.last_value = {}
+		self.stopped = False
+		self.thread = None
+		self.native_failed_at = None
+
+		self.queued = 0
+		self.sent = 0
+		self.coalesced = 0
+		self.dropped = 0
+		self.failed = 0
+		self.fallbacks = 0
+
+	def start(self):
+		self.thread = Thread(target=self.update, args=())
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	# Queue a value. Never blocks. A value for a key that already has one
+	# waiting replaces it, and a value equal to the one waiting, or with
+	# none waiting to the last one delivered, is redundant and gets dropped
+	# here. 'host' defaults to the one given to the constructor.
+	def send(self, key, value, clock=None, host=None):
+		value = str(value)
+		if clock is None:
+			clock = time.time()
+
+		if host is None:
+			host = self.host
+
+		with self.condition:
+			entry = self.waiting.get((host, key))
+			if entry is not None:
+				self.coalesced += 1
+				if entry[2] == value:
+					return False
+
+				entry[2:] = [value, clock]
+				return True
+
+			if self.last_value.get((host, key)) == value:
+				self.coalesced += 1
+				return False
+
+			if len(self.pending) >= self.max_pending:
+				dropped = self.pending.popleft()
+				del self.waiting[tuple(dropped[:2])]
+				self.dropped += 1
+
+			entry = [host, key, value, clock]
+			self.waiting[(host, key)] = entry
+			self.pending.append(entry)
+			self.queued += 1
+			self.condition.notify()
+			return True
+
+	# Flush what is queued and stop the thread.
+	def stop(self, timeout=None):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify()
+
+		if self.thread is not None:
+			self.thread.join(timeout)
+
+	def stats(self):
+		with self.condition:
+			return {'pending': len(self.pending), 'queued': self.queued, 'sent': self.sent, 'coalesced': self.coalesced, 'dropped': self.dropped, 'failed': self.failed, 'fallbacks': self.fallbacks}
+
+	def update(self):
+		while True:
+			with self.condition:
+				while not self.pending and not self.stopped:
+					self.condition.wait()
+
+				if not self.pending:
+					break
+
+				batch = []
+				while self.pending and len(batch) < self.batch_size:
+					entry = self.pending.popleft()
+					del self.waiting[tuple(entry[:2])]
+					batch.append(entry)
+
+			# Only values the server took count as delivered. When it
+			# refused some it doesn't say which, so none of them do.
+			if self.deliver(batch):
+				with self.condition:
+					for (host, key, value, clock) in batch:
+						self.last_value[(host, key)] = value
+
+	# True when every value of 'batch' was delivered
+	def deliver(self, batch):
+		# Don't wait out a connect timeout on every batch while the server is down
+		if self.native_failed_at is None or time.time() - self.native_failed_at > self.retry_interval:
+			try:
+				failed = self.sendNative(batch)
+				self.native_failed_at = None
+				if failed is None:
+					failed = len(batch)
+
+				with self.condition:
+					self.sent += len(batch) - failed
+					self.failed += failed
+				return failed == 0
+
+			except (socket.error, ValueError) as e:
+				print(datetime.datetime.now().strftime("[%H:%M:%S] Zabbix trapper unreachable: ") + str(e))
+				self.native_failed_at = time.time()
+
+		with self.condition:
+			self.fallbacks += 1
+
+		if self.sendFile(batch):
+			with self.condition:
+				self.sent += len(batch)
+			return True
+
+		with self.condition:
+			self.failed += len(batch)
+		return False
+
+	def packet(self, batch):
+		data = []
+		for (host, key, value, clock) in batch:
+			data.append({'host': host, 'key': key, 'value': value, 'clock': int(clock), 'ns': int((clock % 1) * 1000000000)})
+
+		body = json.dumps({'request': 'sender data', 'data': data, 'clock': int(time.time())}).encode("utf-8")
+		return self.HEADER + struct.pack("<Q", len(body)) + body
+
+	def receive(self, connection, size):
+		data = b""
+		while len(data) < size:
+			chunk = connection.recv(size - len(data))
+			if not chunk:
+				raise ValueError("connection closed by the server")
+			data += chunk
+
+		return data
+
+	# Returns the number of values the server refused, or None when there
+	# was no proper answer once the whole request was written. The server
+	# may have taken the values by then, so they are neither sent again nor
+	# handed to zabbix_sender. The trapper closes the connection after each
+	# response, so every batch gets a new one.
+	def sendNative(self, batch):
+		packet = self.packet(batch)
+		connection = socket.create_connection((self.server, self.port), self.timeout)
+		try:
+			connection.sendall(packet)
+			try:
+				header = self.receive(connection, 13)
+				if not header[:5] == self.HEADER:
+					raise ValueError("unexpected response header")
+
+				response = json.loads(self.receive(connection, struct.unpack("<Q", header[5:])[0]).decode("utf-8"))
+				if not response.get('response') == "success":
+					raise ValueError("server answered " + str(response.get('response')))
+
+				info = dict(part.strip().split(": ", 1) for part in response.get('info', "").split(";") if ": " in part)
+				return int(info.get('failed', 0))
+			except (socket.error, ValueError) as e:
+				print(datetime.datetime.now().strftime("[%H:%M:%S] No usable answer from the Zabbix trapper, not sending again: ") + str(e))
+				return None
+		finally:
+			connection.close()
+
+	def quote(self, text):
+		return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+	def sendFile(self, batch):
+		handle = tempfile.NamedTemporaryFile(mode="w", prefix="zabbix_", suffix=".txt", delete=False)
+		try:
+			with handle:
+				for (host, key, value, clock) in batch:
+					handle.write(" ".join([self.quote(host), self.quote(key), str(int(clock)), self.quote(value)]) + "\n")
+
+			subprocess.check_output([self.sender, "-z", self.server, "-p", str(self.port), "-T", "-i", handle.name], stderr=subprocess.STDOUT, timeout=self.timeout * 2)
+			return True
+
+		except (OSError, subprocess.SubprocessError) as e:
+			print(datetime.datetime.now().strftime("[%H:%M:%S] zabbix_sender failed: ") + str(e))
+			return False
+
+		finally:
+			os.remove(handle.name)
+
+# Indexes zone state changes, events, snapshots and clips in a SQLite
+# database. Rows are queued without blocking and written in batches, one
+# transaction each, from a background thread; the database is in WAL mode
+# so --query-events can read it while the detector writes.
+class EventIndex:
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS transitions (camera TEXT, zone TEXT, state TEXT, time REAL, sequence INTEGER)",
+		"CREATE INDEX IF NOT EXISTS transitions_zone ON transitions (zone, time)",
+		"CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, camera TEXT, start_time REAL, end_time REAL, duration REAL, upload INTEGER)",
+		"CREATE INDEX IF NOT EXISTS events_start ON events (start_time)",
+		"CREATE TABLE IF NOT EXISTS event_zones (event INTEGER, zone TEXT)",
+		"CREATE INDEX IF NOT EXISTS event_zones_zone ON event_zones (zone, event)",
+		"CREATE TABLE IF NOT EXISTS event_files (event INTEGER, path TEXT, offset REAL, duration REAL)",
+		"CREATE INDEX IF NOT EXISTS event_files_event ON event_files (event)",
+		"CREATE TABLE IF NOT EXISTS snapshots (camera TEXT, time REAL, path TEXT)",
+		"CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (camera, time)",
+		"CREATE TABLE IF NOT EXISTS clips (camera TEXT, start_time REAL, end_time REAL, path TEXT)",
+		"CREATE INDEX IF NOT EXISTS clips_start ON clips (camera, start_time)"]
+
+	def __init__(self, path, max_pending=10000, batch_size=500, interval=1.0):
+		self.path = path
+		self.max_pending = max_pending
+		self.batch_size = batch_size
+		self.interval = interval
+
+		self.condition = Condition()
+		self.pending = deque()
+		self.stopped = False
+		self.thread = None
+
+		self.written = 0
+		self.dropped = 0
+		self.failed = 0
+
+	def start(self):
+		self.thread = Thread(target=self.update, args=())
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def put(self, kind, *values):
+		with self.condition:
+			if len(self.pending) >= self.max_pending:
+				self.pending.popleft()
+				self.dropped += 1
+
+			self.pending.append((kind,) + values)
+			if len(self.pending) >= self.batch_size:
+				self.condition.notify()
+
+	def transition(self, camera, zone, state, timestamp, sequence):
+		self.put("transition", camera, zone, state, timestamp, sequence)
+
+	def snapshot(self, camera, timestamp, path):
+		self.put("snapshot", camera, timestamp, path)
+
+	def clip(self, camera, start, end, path):
+		self.put("clip", camera, start, end, path)
+
+	# 'event' has start, end, zones, upload and segments, a list of
+	# {path, offset, duration} pointing into clips or DVR segments
+	def event(self, camera, event):
+		self.put("event", camera, event['start'], event['end'], list(event['zones']), event['upload'], [dict(segment) for segment in event['segments']])
+
+	# Write what is queued and stop the thread.
+	def stop(self, timeout=None):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify()
+
+		if self.thread is not None:
+			self.thread.join(timeout)
+
+	def stats(self):
+		with self.condition:
+			return {'pending': len(self.pending), 'written': self.written, 'dropped': self.dropped, 'failed': self.failed}
+
+	@staticmethod
+	def connect(path):
+		connection = sqlite3.connect(path, timeout=30)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		for statement in EventIndex.SCHEMA:
+			connection.execute(statement)
+
+		connection.commit()
+		return connection
+
+	def update(self):
+		connection = self.connect(self.path)
+		while True:
+			with self.condition:
+				if len(self.pending) < self.batch_size and not self.stopped:
+					self.condition.wait(self.interval)
+
+				if not self.pending and self.stopped:
+					break
+
+				batch = []
+				while self.pending and len(batch) < self.batch_size:
+					batch.append(self.pending.popleft())
+
+			if batch:
+				self.write(connection, batch)
+
+		connection.close()
+
+	def write(self, connection, batch):
+		try:
+			with connection:
+				for row in batch:
+					self.insert(connection, row)
+		except sqlite3.Error as error:
+			print(datetime.datetime.now().strftime("[%H:%M:%S] ") + "Event index: " + str(len(batch)) + " rows not written: " + str(error))
+			self.failed += len(batch)
+			return
+
+		self.written += len(batch)
+
+	def insert(self, connection, row):
+		kind = row[0]
+		if kind == "transition":
+			connection.execute("INSERT INTO transitions VALUES (?, ?, ?, ?, ?)", row[1:])
+		elif kind == "snapshot":
+			connection.execute("INSERT INTO snapshots VALUES (?, ?, ?)", row[1:])
+		elif kind == "clip":
+			connection.execute("INSERT INTO clips VALUES (?, ?, ?, ?)", row[1:])
+		elif kind == "event":
+			(camera, start, end, zones, upload, segments) = row[1:]
+			event = connection.execute("INSERT INTO events (camera, start_time, end_time, duration, upload) VALUES (?, ?, ?, ?, ?)", (camera, start, end, end - start, int(upload))).lastrowid
+			connection.executemany("INSERT INTO event_zones VALUES (?, ?)", [(event, zone) for zone in zones])
+			connection.executemany("INSERT INTO event_files VALUES (?, ?, ?, ?)", [(event, segment['path'], segment['offset'], segment['duration']) for segment in segments])
+
+# A time for --query-since and --query-until: a date with an optional time
+# of day, or an amount of time ago like 30s, 90m, 12h or 7d
+def parseQueryTime(text, now=None):
+	now = time.time() if now is None else now
+	units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+	if text[-1:] in units:
+		try:
+			return now - float(text[:-1]) * units[text[-1]]
+		except ValueError:
+			pass
+
+	for layout in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+		try:
+			return time.mktime(time.strptime(text, layout))
+		except ValueError:
+			pass
+
+	raise ValueError("Can't read '" + text + "' as a time")
+
+# Events in the index at 'path' matching every filter given, oldest first,
+# each with its zones, files and the snapshots taken during it
+def queryEvents(path, zone=None, camera=None, since=None, until=None, min_duration=None, max_duration=None):
+	connection = sqlite3.connect(path, timeout=30)
+	conditions = []
+	values = []
+	for (condition, value) in (("id IN (SELECT event FROM event_zones WHERE zone = ?)", zone), ("camera = ?", camera), ("start_time >= ?", since), ("start_time < ?", until), ("duration >= ?", min_duration), ("duration <= ?", max_duration)):
+		if value is not None:
+			conditions.append(condition)
+			values.append(value)
+
+	query = "SELECT id, camera, start_time, end_time, duration FROM events"
+	if conditions:
+		query += " WHERE " + " AND ".join(conditions)
+
+	events = []
+	for (event, name, start, end, duration) in connection.execute(query + " ORDER BY start_time", values).fetchall():
+		zones = [row[0] for row in connection.execute("SELECT zone FROM event_zones WHERE event = ?", (event,))]
+		files = [{'path': row[0], 'offset': row[1], 'duration': row[2]} for row in connection.execute("SELECT path, offset, duration FROM event_files WHERE event = ? ORDER BY rowid", (event,))]
+		snapshots = [row[0] for row in connection.execute("SELECT path FROM snapshots WHERE camera = ? AND time >= ? AND time <= ? ORDER BY time", (name, start, end))]
+		events.append({'camera': name, 'start': start, 'end': end, 'duration': duration, 'zones': zones, 'files': files, 'snapshots': snapshots})
+
+	connection.close()
+	return events
+
+def printEvents(settings):
+	since = parseQueryTime(settings['query_since']) if settings['query_since'] else None
+	until = parseQueryTime(settings['query_until']) if settings['query_until'] else None
+	events = queryEvents(settings['event_db'], settings['query_zone'], settings['query_camera'], since, until, settings['query_min_duration'], settings['query_max_duration'])
+	for event in events:
+		print(datetime.datetime.fromtimestamp(event['start']).strftime("%Y-%m-%d %H:%M:%S") + "  {duration:7.1f}s  {camera}  [{zones}]".format(duration=event['duration'], camera=event['camera'], zones=", ".join(event['zones'])))
+		for segment in event['files']:
+			print("    {path} +{offset:.3f}s for {duration:.3f}s".format(**segment))
+		for path in event['snapshots']:
+			print("    " + path)
+
+	print(str(len(events)) + " events")
+
+class NullDispatcher:
+	# Stands in for ZabbixDispatcher when nothing should leave the machine.
+	# Keeps the values instead of sending them.
+	def __init__(self):
+		self.values = []
+
+	def send(self, key, value, clock=None, host=None):
+		self.values.append((host, key, value))
+
+	def start(self):
+		return self
+
+	def stop(self, timeout=None):
+		return
+
+	def stats(self):
+		return {'pending': 0, 'queued': len(self.values), 'sent': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0, 'fallbacks': 0}
+
+class Notify:
+	def __init__(self, tracker):
+		self.tracker = tracker
+		self.dt = datetime.datetime.now()
+
+		# Say which camera this is about when several share the console
+		self.camera = ""
+		if tracker.settings.get('cameras'):
+			self.camera = tracker.settings['zabbix_name'] + ": "
+
+	def log(self, text):
+		print(self.dt.strftime("[%H:%M:%S] ") + self.camera + text)
+
+	def notifyForceRekey (self):
+		self.log("Forcing rekey of master frame")
+		return
+
+	def notifyActive (self, zone):
+		self.transition(zone, "active")
+		self.sendZabbixValue("mrec." + zone.attrs['name'].lower(), 1)
+		self.log("-- -O [" + zone.attrs['name'] + "]")
+		return
+
+	def notifyMonitor (self, zone):
+		self.transition(zone, "monitor")
 		self.sendZabbixValue("mdect." + zone.attrs['name'].lower(), 1)
-		print(self.dt.strftime("[%H:%M:%S] ->    [" + zone.attrs['name'] + "]"))
+		self.log("->    [" + zone.attrs['name'] + "]")
 		return
 
 	def notifyCooldown (self, zone):
+		self.transition(zone, "cooldown")
 		self.sendZabbixValue("mdect." + zone.attrs['name'].lower(), 0)
-		print(self.dt.strftime("[%H:%M:%S] -- -- [" + zone.attrs['name'] + "]"))
+		self.log("-- -- [" + zone.attrs['name'] + "]")
 		return
 
 	def notifyInactive (self, zone):
+		self.transition(zone, "inactive")
 		self.sendZabbixValue("mdect." + zone.attrs['name'].lower(), 0)
 		self.sendZabbixValue("mrec." + zone.attrs['name'].lower(), 0)
-		print(self.dt.strftime("[%H:%M:%S] -X    [" + zone.attrs['name'] + "]"))
+		self.log("-X    [" + zone.attrs['name'] + "]")
 		return
 
 	def notifyContinue(self, zone):
-		print(self.dt.strftime("[%H:%M:%S] -- -> [" + zone.attrs['name'] + "]"))
+		self.transition(zone, "continuation")
+		self.log("-- -> [" + zone.attrs['name'] + "]")
 		return
 
-	def notifyStopRecording(self):
-		print(self.dt.strftime("[%H:%M:%S] -X XX"))
+	def notifyStopRecording(self, stats):
+		self.log("-X XX")
+		print("           Encoder: {written} frames, {dropped} dropped, queue depth {queue_depth} (max {max_queue_depth}), {encode_ms:.1f}ms per frame (max {max_encode_ms:.1f}ms)".format(**stats))
 		print("")
 		return
 
+	# Keep the state change when the tracker collects them
+	def transition(self, zone, state):
+		if self.tracker.transitions is not None:
+			self.tracker.transitions.append({'time': self.tracker.frame.timestamp, 'sequence': self.tracker.frame.sequence, 'zone': zone.attrs['name'], 'state': state})
+
+		if self.tracker.index is not None:
+			self.tracker.index.transition(self.tracker.settings['zabbix_name'], zone.attrs['name'], state, self.tracker.frame.timestamp, self.tracker.frame.sequence)
+
 	def sendZabbixValue(self, key, value):
-		subprocess.check_output(self.cmd + " -k " + key + " -o " + str(value), shell=True)
+		start = time.perf_counter()
+		self.tracker.zabbix.send(key, value, host=self.tracker.settings['zabbix_name'])
+		lapTime(self.tracker.timings, "notify", start)
 		return
 
 	def sendZabbixBoolFlip(self, key, new_value):
-		old_value = math.fabs(new_value - 1)
-		sendZabbixValue(key, old_value)
-		sendZabbixValue(key, new_value)	
+		old_value = int(math.fabs(new_value - 1))
+		self.sendZabbixValue(key, old_value)
+		self.sendZabbixValue(key, new_value)	
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if not self.path.split("?", 1)[0] == "/metrics":
+			self.send_error(404)
+			return
+
+		body = self.server.metrics.render().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		return
+
+class MetricsServer:
+	# Serves the stage latencies and capture counters of every tracker in
+	# Prometheus text format on http://address:port/metrics
+	def __init__(self, address, port, trackers):
+		self.trackers = trackers
+		self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+		self.server.daemon_threads = True
+		self.server.metrics = self
+
+	def start(self):
+		thread = Thread(target=self.server.serve_forever, args=())
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	@staticmethod
+	def label(value):
+		return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+	def render(self):
+		stages = ["# HELP motion_stage_seconds Time spent in each stage of the detection pipeline", "# TYPE motion_stage_seconds histogram"]
+		quantiles = ["# HELP motion_stage_quantile_seconds Latency quantiles of each stage since startup", "# TYPE motion_stage_quantile_seconds gauge"]
+		maximums = ["# HELP motion_stage_max_seconds Longest time spent in each stage since startup", "# TYPE motion_stage_max_seconds gauge"]
+		frames = ["# HELP motion_frames_total Frames handled by the capture side", "# TYPE motion_frames_total counter"]
+		for tracker in self.trackers:
+			camera = 'camera="' + self.label(tracker.settings['zabbix_name']) + '"'
+			for (name, value) in sorted(tracker.frame.stats().items()):
+				if not name == "queued":
+					frames.append("motion_frames_total{" + camera + ',kind="' + name + '"} ' + str(value))
+
+			if tracker.timings is None:
+				continue
+
+			for (stage, (counts, total, count, maximum)) in sorted(tracker.timings.histogramsCopy().items()):
+				labels = camera + ',stage="' + stage + '"'
+				seen = 0
+				for (bound, bucket) in zip(LatencyHistogram.BOUNDS, counts):
+					seen += bucket
+					stages.append("motion_stage_seconds_bucket{" + labels + ',le="' + "{:.6g}".format(bound) + '"} ' + str(seen))
+
+				stages.append("motion_stage_seconds_bucket{" + labels + ',le="+Inf"} ' + str(count))
+				stages.append("motion_stage_seconds_sum{" + labels + "} " + repr(total))
+				stages.append("motion_stage_seconds_count{" + labels + "} " + str(count))
+
+				for (quantile, q) in (("0.5", 0.5), ("0.95", 0.95), ("0.99", 0.99)):
+					quantiles.append("motion_stage_quantile_seconds{" + labels + ',quantile="' + quantile + '"} ' + repr(LatencyHistogram.quantile(q, counts, maximum)))
+
+				maximums.append("motion_stage_max_seconds{" + labels + "} " + repr(maximum))
+
+		return "\n".join(stages + quantiles + maximums + frames) + "\n"
+
+class CameraSupervisor:
+	# Runs several MotionTrackers in one process on a shared pool of
+	# detection threads. Every camera has its own capture thread and ring
+	# buffer, but is processed by at most one worker at a time, one frame
+	# per turn. Workers always take the ready camera that has been due the
+	# longest, and a camera with a target fps is not due again until its
+	# frame interval has passed, so a camera that can't keep up only drops
+	# its own frames and never starves the others.
+	def __init__(self, camera_settings, workers=0):
+		self.condition = Condition()
+		self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+		self.cameras = []
+
+		base = camera_settings[0]
+		self.zabbix = ZabbixDispatcher(base['zabbix_server'], base['zabbix_name'], base['zabbix_port']).start()
+		self.uploads = UploadSpool(base['upload_spool'], {'s3': ScriptUploadBackend(base['upload_script']), 'file': DirectoryUploadBackend()}, base['upload_workers'], base['upload_concurrency']).start()
+		self.index = None
+		if base['event_db'] is not None:
+			self.index = EventIndex(base['event_db']).start()
+
+		for settings in camera_settings:
+			tracker = MotionTracker(settings, self.zabbix, self.uploads, self.frameReady, self.index)
+			interval = 1.0 / settings['target_fps'] if settings['target_fps'] > 0 else 0.0
+			self.cameras.append({'name': settings['zabbix_name'], 'tracker': tracker, 'interval': interval, 'due': 0.0, 'busy': False, 'ended': False, 'processed': 0})
+
+	# Called from the capture threads whenever a frame is queued
+	def frameReady(self):
+		with self.condition:
+			self.condition.notify_all()
+
+	# The idle camera with a frame waiting that has been due the longest,
+	# or the time until the next camera becomes due.
+	def pick(self, now):
+		chosen = None
+		wake = None
+		for camera in self.cameras:
+			if camera['busy'] or camera['ended']:
+				continue
+
+			if camera['due'] > now:
+				wake = camera['due'] if wake is None else min(wake, camera['due'])
+				continue
+
+			if not camera['tracker'].frame.captureStream.buffer.ready():
+				continue
+
+			if chosen is None or camera['due'] < chosen['due']:
+				chosen = camera
+
+		return (chosen, wake)
+
+	def worker(self):
+		while True:
+			with self.condition:
+				while True:
+					if all(camera['ended'] for camera in self.cameras):
+						return
+
+					now = time.time()
+					(camera, wake) = self.pick(now)
+					if camera is not None:
+						camera['busy'] = True
+						camera['due'] = max(camera['due'] + camera['interval'], now)
+						break
+
+					self.condition.wait(None if wake is None else wake - now)
+
+			# Rate limited cameras only look at the newest frame
+			alive = camera['tracker'].step(camera['interval'] > 0)
+
+			with self.condition:
+				camera['busy'] = False
+				camera['processed'] += 1
+				if not alive:
+					camera['ended'] = True
+
+				self.condition.notify_all()
+
+			# Waits for the camera's writer and index threads, which must not hold up the other cameras
+			if not alive:
+				camera['tracker'].finish()
+
+	def run(self):
+		for camera in self.cameras:
+			camera['tracker'].resetZabbixItems()
+
+		threads = [Thread(target=self.worker, args=()) for i in range(self.workers)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.zabbix.stop(10)
+		self.uploads.stop(1)
+		if self.index is not None:
+			self.index.stop(10)
+
+# Per-camera settings from a --cameras file. Top level keys override the
+# command line for every camera, and each entry in "cameras" overrides
+# those for that camera. Keys use the long option names with underscores:
+#
+# {"zabbix_server": "192.168.6.6", "resolution": 0.5, "cameras": [
+#   {"zabbix_name": "Front Camera", "video": "rtsp://...", "polygon_json": "front.json", "filepath": "/motiondata/motioneye/Camera1/%Y-%m-%d/", "target_fps": 10},
+#   {"zabbix_name": "Back Camera", "video": "rtsp://...", "polygon_json": "back.json", "filepath": "/motiondata/motioneye/Camera2/%Y-%m-%d/", "target_fps": 5}]}
+def loadCameraSettings(args):
+	config = json.loads(open(args['cameras'], 'r').read())
+	base = dict(args)
+	for key in config:
+		if not key == "cameras":
+			if not key in args:
+				raise ValueError("Unknown setting '" + key + "' in " + args['cameras'])
+			base[key] = config[key]
+
+	cameras = []
+	for (n, camera) in enumerate(config['cameras']):
+		settings = dict(base)
+		settings.update(camera)
+		if not 'keyframe_image' in camera:
+			(root, extension) = os.path.splitext(base['keyframe_image'])
+			settings['keyframe_image'] = root + "_" + str(n + 1) + extension
+
+		for key in camera:
+			if not key in args:
+				raise ValueError("Unknown setting '" + key + "' for camera " + str(n + 1))
+
+		cameras.append(settings)
+
+	return cameras
+
+# Timestamps for benchmarks, taken from the frame rate of the video file
+# rather than the wall clock
+def videoClock(stream):
+	fps = stream.get(cv2.CAP_PROP_FPS)
+	if not fps > 0:
+		fps = 20.0
+
+	return lambda frames: frames / fps
+
+# Run the video through the original and the configured preprocessing side
+# by side, then print what each stage costs and how often both chains find
+# motion in the same places. Objects are the contours at least --min-area big.
+# Both chains use the configured background model.
+def benchmarkPreprocessing(settings):
+	resolution = min(settings['resolution'], 1.0)
+	min_area = settings['min_area'] * resolution * resolution
+	chains = [("original", Preprocessor()), ("configured", Preprocessor(settings['grey_first'], settings['downscale'], settings['blur'], settings['blur_size'], settings['mask_scale'], settings['dilate_iterations']))]
+	for (name, chain) in chains:
+		chain.timings = LatencyMetrics()
+
+	blend_rate = 1.00 - (settings['blend_rate'] / float(100))
+	backgrounds = [createBackground(settings['background_model'], settings['background_samples']) for chain in chains]
+	schedule = BackgroundSchedule(settings['background_interval'], blend_rate)
+	stream = openCapture(settings['video'])
+	clock = videoClock(stream)
+	frames = 0
+	agreed = 0
+	moving = 0
+	overlap = 0.0
+	while True:
+		(success, image) = stream.read()
+		if not success:
+			break
+
+		areas = []
+		retention = schedule.due(clock(frames))
+		for (n, (name, chain)) in enumerate(chains):
+			blurred = chain.smooth(chain.reduce(image, resolution))
+			if frames == 0:
+				backgrounds[n].reset(blurred)
+
+			(mask, contours) = chain.contours(backgrounds[n], blurred, retention)
+			area = numpy.zeros(mask.shape, numpy.uint8)
+			cv2.drawContours(area, [contour for contour in contours if cv2.contourArea(contour) >= min_area], -1, 255, -1)
+			areas.append(area > 0)
+
+		frames += 1
+		found = [area.any() for area in areas]
+		if found[0] == found[1]:
+			agreed += 1
+
+		if found[0] or found[1]:
+			moving += 1
+			overlap += numpy.count_nonzero(areas[0] & areas[1]) / float(numpy.count_nonzero(areas[0] | areas[1]))
+
+	stream.release()
+	if frames == 0:
+		print("No frames read from " + str(settings['video']))
+		return
+
+	print("Preprocessing cost over " + str(frames) + " frames, ms per frame:")
+	print("  {:<12}".format("stage") + "".join("{:>12}".format(name) for (name, chain) in chains))
+	totals = [chain.timings.totals() for (name, chain) in chains]
+	for stage in Preprocessor.STAGES + ("total",):
+		row = "  {:<12}".format(stage)
+		for timings in totals:
+			seconds = sum(timings.values()) if stage == "total" else timings.get(stage, 0.0)
+			row += "{:>12.3f}".format(seconds * 1000 / frames)
+
+		print(row)
+
+	print("Frames where both chains agree on motion: {:.1f}%".format(agreed * 100.0 / frames))
+	if moving > 0:
+		print("Mean overlap of detected areas on frames with motion: {:.1f}%".format(overlap * 100.0 / moving))
+
+# Run the video through each background model with the configured
+# preprocessing and print what updating the model costs and how many
+# contours of at least --min-area it produces. On footage without real
+# motion every contour is a false one.
+def benchmarkBackgrounds(settings):
+	resolution = min(settings['resolution'], 1.0)
+	min_area = settings['min_area'] * resolution * resolution
+	preprocess = Preprocessor(settings['grey_first'], settings['downscale'], settings['blur'], settings['blur_size'], settings['mask_scale'], settings['dilate_iterations'])
+	models = []
+	for name in ("blend", "accumulate", "median", "mog2", "knn"):
+		chain = Preprocessor(settings['grey_first'], settings['downscale'], settings['blur'], settings['blur_size'], settings['mask_scale'], settings['dilate_iterations'])
+		chain.timings = LatencyMetrics()
+		models.append({'name': name, 'chain': chain, 'background': createBackground(name, settings['background_samples']), 'contours': 0, 'frames': 0})
+
+	schedule = BackgroundSchedule(settings['background_interval'], 1.00 - (settings['blend_rate'] / float(100)))
+	stream = openCapture(settings['video'])
+	clock = videoClock(stream)
+	frames = 0
+	while True:
+		(success, image) = stream.read()
+		if not success:
+			break
+
+		blurred = preprocess.smooth(preprocess.reduce(image, resolution))
+		retention = schedule.due(clock(frames))
+		for model in models:
+			if frames == 0:
+				model['background'].reset(blurred)
+
+			contours = model['chain'].contours(model['background'], blurred, retention)[1]
+			found = len([contour for contour in contours if cv2.contourArea(contour) >= min_area])
+			model['contours'] += found
+			if found > 0:
+				model['frames'] += 1
+
+		frames += 1
+
+	stream.release()
+	if frames == 0:
+		print("No frames read from " + str(settings['video']))
+		return
+
+	print("Background models over " + str(frames) + " frames:")
+	print("  {:<12}{:>14}{:>14}{:>18}{:>20}".format("model", "model ms", "total ms", "contours/frame", "frames w/ contours"))
+	for model in models:
+		timings = model['chain'].timings.totals()
+		print("  {:<12}{:>14.3f}{:>14.3f}{:>18.3f}{:>19.1f}%".format(model['name'], timings.get("background", 0.0) * 1000 / frames, sum(timings.values()) * 1000 / frames, model['contours'] / float(frames), model['frames'] * 100.0 / frames))
+
+# Find the blobs of every frame with both --blobs methods on the same
+# dilated mask and print what each costs. Blobs match when their bounding
+# boxes are the same. Blobs of the mask that only one method keeps are
+# fine when the other method finds the same box but its area falls on the
+# other side of --min-area or --max-area; anything else fails the check.
+def benchmarkBlobs(settings):
+	resolution = min(settings['resolution'], 1.0)
+	min_area = settings['min_area'] * resolution * resolution
+	max_area = settings['max_area'] * resolution * resolution
+	preprocess = Preprocessor(settings['grey_first'], settings['downscale'], settings['blur'], settings['blur_size'], settings['mask_scale'], settings['dilate_iterations'])
+	background = createBackground(settings['background_model'], settings['background_samples'])
+	schedule = BackgroundSchedule(settings['background_interval'], 1.00 - (settings['blend_rate'] / float(100)))
+	backends = ("contours", "components")
+	seconds = dict((backend, 0.0) for backend in backends)
+	found = dict((backend, 0) for backend in backends)
+	ratios = []
+	matched = 0
+	explained = 0
+	unexplained = 0
+	stream = openCapture(settings['video'])
+	clock = videoClock(stream)
+	frames = 0
+	while True:
+		(success, image) = stream.read()
+		if not success:
+			break
+
+		blurred = preprocess.smooth(preprocess.reduce(image, resolution))
+		if frames == 0:
+			background.reset(blurred)
+
+		(mask, small) = preprocess.motionMask(background, blurred, schedule.due(clock(frames)))
+		kept = {}
+		every = {}
+		for backend in backends:
+			start = time.perf_counter()
+			blobs = preprocess.extractBlobs(mask, small, min_area=min_area, max_area=max_area, backend=backend)
+			seconds[backend] += time.perf_counter() - start
+			found[backend] += len(blobs)
+			kept[backend] = dict((blob[:4], blob[6]) for blob in blobs)
+			every[backend] = dict((blob[:4], blob[6]) for blob in preprocess.extractBlobs(mask, small, backend=backend))
+
+		for box in set(kept["contours"]) | set(kept["components"]):
+			if box in kept["contours"] and box in kept["components"]:
+				matched += 1
+				if kept["contours"][box] > 0:
+					ratios.append(kept["components"][box] / kept["contours"][box])
+			elif box in every["contours"] and box in every["components"]:
+				explained += 1
+			else:
+				unexplained += 1
+
+		frames += 1
+
+	stream.release()
+	if frames == 0:
+		print("No frames read from " + str(settings['video']))
+		return False
+
+	print("Blob extraction over " + str(frames) + " frames:")
+	print("  {:<12}{:>14}{:>16}".format("blobs", "ms per frame", "blobs per frame"))
+	for backend in backends:
+		print("  {:<12}{:>14.3f}{:>16.3f}".format(backend, seconds[backend] * 1000 / frames, found[backend] / float(frames)))
+
+	print("Same bounding box: " + str(matched) + ", kept by one only because of the area measure: " + str(explained) + ", other differences: " + str(unexplained))
+	if len(ratios) > 0:
+		print("Component area / contour area of matching blobs: {:.3f} median, {:.3f} max".format(float(numpy.median(ratios)), max(ratios)))
+
+	if unexplained > 0:
+		print("FAIL: the blob methods disagree")
+		return False
+
+	print("PASS")
+	return True
+
+# Check that the pipeline reuses its buffers. --video is replayed through a
+# MotionTracker and, after a warm-up, each step() is traced end to end,
+# together with what the encoder threads do with the frame it hands them.
+# Steady state is the median frame, which must stay within
+# --allocation-budget kB; the worst frame is shown but is expected to be
+# larger when a clip opens, a buffer pool grows, a label is first drawn or
+# the clock moves on to the next second.
+# The pre-roll is left out: the JPEG bytes it keeps of each frame are the
+# buffer itself.
+def benchmarkAllocations(settings, warmup=10):
+	output = tempfile.mkdtemp(prefix="motion_allocations_")
+	settings = redirectOutput(dict(settings, motion_buffer=0), output)
+	backend = NullUploadBackend()
+	uploads = UploadSpool(settings['upload_spool'], {'s3': backend, 'file': backend}, 1, 1).start()
+	sizes = []
+	try:
+		tracker = MotionTracker(settings, NullDispatcher(), uploads)
+		tracemalloc.start()
+		frames = 0
+		while True:
+			tracemalloc.reset_peak()
+			before = tracemalloc.get_traced_memory()[0]
+			if not tracker.step():
+				break
+
+			# Wait for the encoder threads to be done with the frame
+			while tracker.output.stats().get('queue_depth', 0) > 0:
+				time.sleep(0.001)
+
+			if frames >= warmup:
+				sizes.append(tracemalloc.get_traced_memory()[1] - before)
+			frames += 1
+
+		tracker.finish()
+	finally:
+		if tracemalloc.is_tracing():
+			tracemalloc.stop()
+		uploads.stop(1)
+		shutil.rmtree(output, ignore_errors=True)
+
+	if not sizes:
+		print("Not enough frames in " + str(settings['video']) + " to measure after " + str(warmup) + " warm-up frames")
+		return False
+
+	budget = settings['allocation_budget'] * 1024
+	median = sorted(sizes)[len(sizes) // 2]
+	print("Allocated per frame over " + str(len(sizes)) + " frames: {:.1f} kB median, {:.1f} kB mean, {:.1f} kB max (budget {:.1f} kB)".format(median / 1024.0, sum(sizes) / 1024.0 / len(sizes), max(sizes) / 1024.0, budget / 1024.0))
+	if median > budget:
+		print("FAIL: a frame allocates more than the budget")
+		return False
+
+	print("PASS")
+	return True
+
+# Replay settings for 'settings' that keep every file under 'output'
+def redirectOutput(settings, output):
+	settings = dict(settings)
+	settings['filepath'] = output + "/"
+	settings['keyframe_image'] = os.path.join(output, "keyframe.jpg")
+	settings['upload_spool'] = os.path.join(output, "spool")
+	if settings['dvr_dir'] is not None:
+		settings['dvr_dir'] = os.path.join(output, "dvr")
+	if settings['event_db'] is not None:
+		settings['event_db'] = os.path.join(output, "events.db")
+	settings['drop_policy'] = "block"
+	settings['replay'] = True
+	return settings
+
+# Run the whole pipeline over --video, a file or a directory of images, as
+# fast as detection allows. Time comes from the position in the video, so
+# warmups, cooldowns and background updates behave as they would live.
+# Nothing is sent to Zabbix or uploaded, and snapshots and clips go to a
+# temporary folder. Returns a report that is comparable between runs.
+def replay(settings, zone_blobs=False):
+	output = tempfile.mkdtemp(prefix="motion_replay_")
+	settings = redirectOutput(settings, output)
+
+	zabbix = NullDispatcher()
+	backend = NullUploadBackend()
+	uploads = UploadSpool(settings['upload_spool'], {'s3': backend, 'file': backend}, 1, 1).start()
+	try:
+		started = time.perf_counter()
+		tracker = MotionTracker(settings, zabbix, uploads)
+		tracker.enableMetrics()
+		tracker.transitions = []
+		if zone_blobs:
+			tracker.zone_blobs = []
+		origin = tracker.frame.timestamp
+		tracker.run()
+		uploads.stop(5)
+		elapsed = time.perf_counter() - started
+
+		stats = tracker.frame.stats()
+		processed = stats['consumed'] - tracker.skipped_frames
+		files = [name for (root, folders, names) in os.walk(output) for name in names]
+		video_seconds = tracker.frame.timestamp - origin
+		return {
+			'video': settings['video'],
+			'frames': stats['consumed'],
+			'processed': processed,
+			'skipped': tracker.skipped_frames,
+			'seconds': elapsed,
+			'video_seconds': video_seconds,
+			'fps': stats['consumed'] / elapsed if elapsed > 0 else 0.0,
+			'speed': video_seconds / elapsed if elapsed > 0 else 0.0,
+			'stages_ms': dict((stage, seconds * 1000 / max(processed, 1)) for (stage, seconds) in tracker.timings.totals().items()),
+			'latency': tracker.timings.summary(),
+			'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			'encoder': tracker.output.stats(),
+			'dvr': tracker.dvr.stats() if tracker.dvr is not None else None,
+			'snapshots': len([name for name in files if name.endswith(".jpg") and not name == "keyframe.jpg"]),
+			'clips': len([name for name in files if name.endswith(tracker.extension)]),
+			'uploads': len(backend.uploads),
+			'zabbix_values': len(zabbix.values),
+			'transitions': [dict(change, time=round(change['time'] - origin, 3)) for change in tracker.transitions],
+			'zone_blobs': tracker.zone_blobs,
+			'settings': settings
+		}
+	finally:
+		uploads.stop(1)
+		shutil.rmtree(output, ignore_errors=True)
+
+# Replay --video once with the Zone objects and once with the ZoneEngine
+# and compare the state changes of every frame. Within a frame the order
+# may differ between zones, so changes are compared per frame and zone.
+def checkZoneEngine(settings):
+	runs = []
+	for engine in ("objects", "vector"):
+		changes = {}
+		for change in replay(dict(settings, zone_engine=engine))['transitions']:
+			changes.setdefault(change['sequence'], []).append((change['zone'], change['state']))
+
+		runs.append(dict((sequence, sorted(frame)) for (sequence, frame) in changes.items()))
+
+	(objects, vector) = runs
+	states = sorted(set(state for frame in objects.values() for (zone, state) in frame))
+	print("Zone objects: " + str(sum(len(frame) for frame in objects.values())) + " state changes over " + str(len(objects)) + " frames (" + ", ".join(states) + ")")
+	for sequence in sorted(set(objects) | set(vector)):
+		if not objects.get(sequence) == vector.get(sequence):
+			print("FAIL: frame " + str(sequence) + ": objects " + str(objects.get(sequence, [])) + ", vector " + str(vector.get(sequence, [])))
+			return False
+
+	print("PASS: the zone engines agree")
+	return True
+
+# Replay --video once on the whole frame and once cropped to the zones,
+# and compare the blobs each zone sees on every frame.
+def checkCropping(settings):
+	runs = [replay(dict(settings, crop_to_zones=crop), zone_blobs=True)['zone_blobs'] for crop in (False, True)]
+	(whole, cropped) = [dict(run) for run in runs]
+	print("Whole frame: " + str(sum(len(boxes) for boxes in whole.values())) + " zone blobs over " + str(len(whole)) + " processed frames")
+	for sequence in sorted(set(whole) | set(cropped)):
+		if not whole.get(sequence) == cropped.get(sequence):
+			print("FAIL: frame " + str(sequence) + ": whole " + str(whole.get(sequence)) + ", cropped " + str(cropped.get(sequence)))
+			return False
+
+	print("PASS: cropping to the zones finds the same blobs")
+	return True
+
+def main():
+	args = parseArguments()
+	install_hard_ctrl_c()
+
+	if args['query_events']:
+		printEvents(args)
+		return
+
+	if args['benchmark_preprocess']:
+		benchmarkPreprocessing(args)
+		return
+
+	if args['benchmark_background']:
+		benchmarkBackgrounds(args)
+		return
+
+	if args['replay']:
+		report = json.dumps(replay(args), indent=2, sort_keys=True)
+		if args['replay_report'] == "-":
+			print(report)
+		else:
+			with open(args['replay_report'], "w") as handle:
+				handle.write(report + "\n")
+		return
+
+	if args['zone_conformance']:
+		if not checkZoneEngine(args):
+			sys.exit(1)
+		return
+
+	if args['crop_conformance']:
+		if not checkCropping(args):
+			sys.exit(1)
+		return
+
+	if args['benchmark_blobs']:
+		if not benchmarkBlobs(args):
+			sys.exit(1)
+		return
+
+	if args['benchmark_allocations']:
+		if not benchmarkAllocations(args):
+			sys.exit(1)
+		return
+
+	if args['cameras']:
+		supervisor = CameraSupervisor(loadCameraSettings(args), args['workers'])
+		if args['metrics_port'] > 0:
+			MetricsServer(args['metrics_address'], args['metrics_port'], [camera['tracker'] for camera in supervisor.cameras]).start()
+
+		supervisor.run()
+		return
+
+	mdect = MotionTracker(args)
+	if args['metrics_port'] > 0:
+		MetricsServer(args['metrics_address'], args['metrics_port'], [mdect]).start()
+
+	mdect.resetZabbixItems()
+	mdect.run()
 
-mdect = MotionTracker(args)
-mdect.resetZabbixItems()
-mdect.run()
+if __name__ == "__main__":
+	main()
 
 '''
 # loop over the frames of the video
@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+import cv2
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def writeVideo(path, frames, size=(640, 360), fps=20):
+	output = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+	for frame in frames:
+		output.write(frame)
+	output.release()
+	return path
+
+
+def writeZones(path, zones):
+	config = {'zones': {}}
+	for (n, (name, (x, y, w, h))) in enumerate(zones):
+		points = [{'x': x, 'y': y}, {'x': x + w, 'y': y}, {'x': x + w, 'y': y + h}, {'x': x, 'y': y + h}]
+		config['zones'][str(n + 1)] = {'name': name, 'points': points, 'warmup': "1", 'cooldown': "1", 'continuation': 3, 'minimum_x': 10, 'minimum_y': 10, 'upload_to_s3': False}
+
+	with open(path, "w") as handle:
+		json.dump(config, handle)
+	return path
+
+
+# 160 frames of a noisy still scene with a 220 pixel wide object moving
+# across a small zone, so that it sticks out of the crop around the zone,
+# and a second object that appears inside the zone for a while.
+@pytest.fixture
+def crossing(tmp_path):
+	rng = numpy.random.default_rng(0)
+	background = (rng.random((360, 640, 3)) * 60 + 80).astype(numpy.uint8)
+	frames = []
+	for i in range(160):
+		frame = background.copy()
+		if 30 <= i < 130:
+			x = 100 + (i - 30) * 4
+			cv2.rectangle(frame, (x, 165), (x + 220, 236), (20, 20, 220), -1)
+		if 60 <= i < 100:
+			cv2.rectangle(frame, (340, 150), (380, 200), (220, 220, 20), -1)
+		frames.append(frame)
+
+	video = writeVideo(str(tmp_path / "crossing.avi"), frames)
+	zones = writeZones(str(tmp_path / "zones.json"), [("Door", (300, 120, 120, 120))])
+	return (video, zones)
+
+
+# The crossing scene as H.264 with a keyframe every half second and no
+# B-frames, as most cameras send it
+@pytest.fixture
+def h264(crossing, tmp_path):
+	av = pytest.importorskip("av")
+	(video, zones) = crossing
+	path = str(tmp_path / "crossing.mp4")
+	capture = cv2.VideoCapture(video)
+	with av.open(path, "w") as output:
+		stream = output.add_stream("libx264", rate=20)
+		(stream.width, stream.height, stream.pix_fmt) = (640, 360, "yuv420p")
+		stream.codec_context.gop_size = 10
+		stream.codec_context.options = {'keyint_min': "10", 'sc_threshold': "0", 'bf': "0"}
+		while True:
+			(success, frame) = capture.read()
+			if not success:
+				break
+			for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format="bgr24")):
+				output.mux(packet)
+		for packet in stream.encode():
+			output.mux(packet)
+
+	return (path, zones)
@@ -0,0 +1,28 @@
+import numpy
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+@pytest.mark.parametrize("samples", [9, 4])
+def test_median_background_matches_numpy(samples):
+	rng = numpy.random.default_rng(1)
+	frames = [(rng.random((36, 64)) * 255).astype(numpy.uint8) for i in range(samples + 3)]
+	background = mdr.MedianBackground(samples)
+	background.reset(frames[0])
+	history = [frames[0]] * samples
+	for (n, frame) in enumerate(frames[1:]):
+		background.apply(frame, 0.9)
+		history[n % samples] = frame
+		assert (background.image() == numpy.median(history, axis=0).astype(numpy.uint8)).all()
+
+
+@pytest.mark.parametrize("options", [
+	[],
+	["--background-model", "median", "-r", "0.5"],
+])
+def test_steady_state_frames_stay_within_the_budget(crossing, options, capsys):
+	(video, zones) = crossing
+	settings = mdr.parseArguments(["--video", video, "-j", zones, "-a", "100", "--allocation-budget", "16"] + options)
+	assert mdr.benchmarkAllocations(settings)
+	assert "PASS" in capsys.readouterr().out
@@ -0,0 +1,38 @@
+import cv2
+import numpy
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+def boxes(blobs):
+	return sorted(blob[:4] for blob in blobs)
+
+
+@pytest.mark.parametrize("mask_scale", [1.0, 0.5])
+def test_blob_methods_find_the_same_boxes(mask_scale):
+	rng = numpy.random.default_rng(3)
+	preprocess = mdr.Preprocessor(mask_scale=mask_scale)
+	for i in range(20):
+		mask = numpy.zeros((180, 320), numpy.uint8)
+		for n in range(8):
+			(x, y) = (int(rng.integers(0, 300)), int(rng.integers(0, 160)))
+			(w, h) = (int(rng.integers(1, 40)), int(rng.integers(1, 30)))
+			if n % 2:
+				cv2.ellipse(mask, (x, y), (w, h), int(rng.integers(0, 180)), 0, 360, 255, -1)
+			else:
+				cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+
+		small = mask if mask_scale == 1.0 else cv2.resize(mask, None, fx=mask_scale, fy=mask_scale, interpolation=cv2.INTER_NEAREST)
+		contours = preprocess.extractBlobs(mask, small, (5, 7), backend="contours")
+		components = preprocess.extractBlobs(mask, small, (5, 7), backend="components")
+		assert len(contours) > 0
+		assert boxes(components) == boxes(contours)
+
+
+def test_benchmark_blobs_passes(crossing, capsys):
+	(video, zones) = crossing
+	for options in ([], ["--mask-scale", "0.5", "-r", "0.5"]):
+		settings = mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"] + options)
+		assert mdr.benchmarkBlobs(settings)
+		assert "PASS" in capsys.readouterr().out
@@ -0,0 +1,75 @@
+import numpy
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+def replaySettings(video, zones, *options):
+	return mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"] + list(options))
+
+
+@pytest.mark.parametrize("options", [
+	[],
+	["-r", "0.5"],
+	["--blur-size", "61", "--dilate-iterations", "8"],
+	["--mask-scale", "0.5"],
+	["--downscale", "pyramid", "-r", "0.5"],
+	["--background-model", "median"],
+	["--background-model", "blend"],
+	["--blobs", "components"],
+])
+def test_cropped_detection_matches_the_whole_frame(crossing, options):
+	settings = replaySettings(*crossing, *options)
+	whole = mdr.replay(dict(settings, crop_to_zones=False), zone_blobs=True)
+	cropped = mdr.replay(dict(settings, crop_to_zones=True), zone_blobs=True)
+
+	assert sum(len(boxes) for (sequence, boxes) in whole['zone_blobs']) > 0
+	assert cropped['zone_blobs'] == whole['zone_blobs']
+	assert cropped['transitions'] == whole['transitions']
+
+
+def test_motion_near_an_inner_crop_edge_is_detected():
+	preprocess = mdr.Preprocessor()
+	mask = numpy.zeros((100, 200), numpy.uint8)
+	mask[40:60, 90:110] = 255
+	assert not preprocess.touchesEdges(mask, mask, (True, True, True, True))
+
+	reach = preprocess.reach()
+	mask[40:60, reach:reach + 10] = 255
+	assert preprocess.touchesEdges(mask, mask, (True, False, False, False))
+	assert not preprocess.touchesEdges(mask, mask, (False, True, True, True))
+
+	mask[:, :reach + 1] = 0
+	mask[:, reach + 1:] = 0
+	mask[40:60, reach + 1:reach + 10] = 255
+	assert not preprocess.touchesEdges(mask, mask, (True, True, True, True))
+
+
+def test_check_cropping_passes(crossing, capsys):
+	assert mdr.checkCropping(replaySettings(*crossing))
+	assert "PASS" in capsys.readouterr().out
+
+
+# With --crop-to-zones the whole frame is only reduced when the background
+# is reset, which can come after the frame was snapshotted or recorded
+def test_drawing_leaves_the_cropped_detection_frame_alone(crossing):
+	(video, zones) = crossing
+	frame = mdr.Frame(video, 0.5, drop_policy="block", replay=True)
+	try:
+		for i in range(40):
+			frame.next()
+		frame.setRegion((150, 60, 60, 60))
+		frame.blurFrame()
+		captured = frame.opencv_frame.copy()
+
+		frame.drawContourBox(160, 70, 40, 30, 180, 85, 1200)
+		frame.putDateTime()
+		rendered = frame.renderedFrame()
+
+		assert not numpy.array_equal(rendered, captured)
+		assert numpy.array_equal(frame.opencv_frame, captured)
+		assert numpy.array_equal(frame.blurFrame(False), mdr.Preprocessor().smooth(mdr.Preprocessor().reduce(captured, 0.5)))
+		(image, annotations) = frame.annotatedFrame()
+		assert image is rendered and annotations is None
+	finally:
+		frame.stop()
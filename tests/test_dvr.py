@@ -0,0 +1,63 @@
+import os
+import time
+
+import motion_detector_refactor as mdr
+
+
+# Stands in for ClipWriter: every segment is 100 bytes, complete once the
+# next one starts
+class FakeWriter:
+	def __init__(self):
+		self.current = None
+
+	def open(self, path, fps, size, on_close=None):
+		self.close()
+		self.start(path, on_close)
+
+	def rotate(self, path, on_close=None):
+		self.close()
+		self.start(path, on_close)
+
+	def start(self, path, on_close):
+		with open(path, "wb") as handle:
+			handle.write(b"x" * 100)
+		self.current = (path, on_close)
+
+	def close(self):
+		if self.current is not None:
+			(path, on_close) = self.current
+			self.current = None
+			on_close(path)
+
+
+def waitFor(condition, timeout=5.0):
+	deadline = time.time() + timeout
+	while not condition():
+		assert time.time() < deadline
+		time.sleep(0.01)
+
+
+def test_segments_waiting_for_upload_are_not_evicted(tmp_path):
+	uploads = mdr.UploadSpool(str(tmp_path / "spool"), {'file': mdr.DirectoryUploadBackend()})
+	destination = str(tmp_path / "uploaded")
+	store = mdr.SegmentStore(str(tmp_path / "dvr"), FakeWriter(), ".avi", 10, 250, 3600, lambda path: uploads.enqueue(path, destination), uploads.pinned)
+
+	start = time.mktime((2024, 5, 1, 12, 0, 0, 0, 0, -1))
+	store.update(start, 20, (640, 360))
+	event = store.startEvent(start + 2)
+	store.uploadEvent(event, start + 5)
+	for n in range(1, 6):
+		store.update(start + n * 10, 20, (640, 360))
+
+	names = sorted(os.listdir(str(tmp_path / "dvr")))
+	assert names == ["segment_2024-05-01_12-00-00.avi", "segment_2024-05-01_12-00-40.avi", "segment_2024-05-01_12-00-50.avi"]
+	assert store.stats()['evicted'] == 3
+
+	# Once uploaded, it goes the way of the others
+	uploads.start()
+	waitFor(lambda: uploads.stats()['uploaded'] == 1)
+	uploads.stop(5)
+	store.update(start + 60, 20, (640, 360))
+
+	assert os.listdir(destination) == ["segment_2024-05-01_12-00-00.avi"]
+	assert sorted(os.listdir(str(tmp_path / "dvr"))) == ["segment_2024-05-01_12-00-40.avi", "segment_2024-05-01_12-00-50.avi", "segment_2024-05-01_12-01-00.avi"]
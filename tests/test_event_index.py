@@ -0,0 +1,50 @@
+import os
+
+import cv2
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+def replaySettings(video, zones, *options):
+	return mdr.parseArguments(["--video", video, "-j", zones, "-a", "100", "-l", "1"] + list(options))
+
+
+# Run the whole file through a tracker writing into 'output' and return
+# the indexed events
+def record(settings, output):
+	settings = mdr.redirectOutput(dict(settings, event_db="events.db"), output)
+	tracker = mdr.MotionTracker(settings, mdr.NullDispatcher(), mdr.UploadSpool(settings['upload_spool'], {}))
+	tracker.run()
+	return mdr.queryEvents(settings['event_db'])
+
+
+def frameCount(path):
+	return cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT)
+
+
+# The event starts 'offset' seconds into its first clip, and every clip is
+# covered from its offset to its end
+@pytest.mark.parametrize("options", [[], ["--clip-seconds", "1"]])
+def test_clip_offsets_match_the_files(crossing, tmp_path, options):
+	events = record(replaySettings(*crossing, *options), str(tmp_path / "output"))
+	assert len(events) == 1
+	files = events[0]['files']
+	assert len(files) == (1 if options == [] else 3)
+
+	assert 0.0 <= files[0]['offset'] <= 0.05
+	assert [clip['offset'] for clip in files[1:]] == [0.0] * (len(files) - 1)
+	assert sum(clip['duration'] for clip in files) == pytest.approx(events[0]['duration'], abs=0.01)
+	for clip in files:
+		assert clip['offset'] + clip['duration'] == pytest.approx(frameCount(clip['path']) / 20.0, abs=0.051)
+
+
+# A copied clip starts on the keyframe at or before the start of the event,
+# pre-roll included, so the event starts up to a keyframe interval in
+def test_copied_clips_start_on_a_keyframe(h264, tmp_path):
+	events = record(replaySettings(*h264, "--record-mode", "copy"), str(tmp_path / "output"))
+	assert len(events) == 1
+	[clip] = events[0]['files']
+
+	assert 0.0 <= clip['offset'] < 0.5
+	assert clip['offset'] + clip['duration'] == pytest.approx(frameCount(clip['path']) / 20.0, abs=0.051)
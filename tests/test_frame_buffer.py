@@ -0,0 +1,107 @@
+import threading
+
+import numpy
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+# Decode 'value' into the next slot, as the capture thread does
+def produce(buffer, value):
+	index = buffer.acquire()
+	if index is None:
+		return False
+
+	frame = buffer.slot(index)
+	if frame is None:
+		frame = numpy.empty((4, 4, 3), numpy.uint8)
+	frame[...] = value
+	buffer.commit(index, frame, float(value))
+	return True
+
+
+def drain(buffer):
+	values = []
+	while buffer.pending():
+		(frame, sequence, timestamp) = buffer.get()
+		values.append(int(frame[0, 0, 0]))
+	return values
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+	buffer = mdr.FrameBuffer(2, "drop-oldest")
+	for value in range(1, 6):
+		produce(buffer, value)
+
+	assert drain(buffer) == [4, 5]
+	assert buffer.stats() == {'captured': 5, 'dropped': 3, 'consumed': 2, 'queued': 0}
+
+
+def test_drop_newest_keeps_the_queued_frames():
+	buffer = mdr.FrameBuffer(2, "drop-newest")
+	for value in range(1, 6):
+		produce(buffer, value)
+
+	assert drain(buffer) == [1, 2]
+	assert buffer.stats() == {'captured': 5, 'dropped': 3, 'consumed': 2, 'queued': 0}
+
+
+def test_block_waits_for_the_consumer():
+	buffer = mdr.FrameBuffer(2, "block")
+	producer = threading.Thread(target=lambda: [produce(buffer, value) for value in range(1, 21)])
+	producer.start()
+
+	values = []
+	while len(values) < 20:
+		(frame, sequence, timestamp) = buffer.get(5)
+		assert buffer.pending() <= 2
+		values.append(int(frame[0, 0, 0]))
+
+	producer.join(5)
+	assert values == list(range(1, 21))
+	assert buffer.stats()['dropped'] == 0
+
+
+# A frame handed to the consumer is not written over until the next get(),
+# however far the producer runs ahead
+@pytest.mark.parametrize("policy", ["drop-oldest", "drop-newest"])
+def test_the_held_frame_stays_valid(policy):
+	buffer = mdr.FrameBuffer(1, policy)
+	produce(buffer, 1)
+	(held, sequence, timestamp) = buffer.get()
+	for value in range(2, 10):
+		produce(buffer, value)
+
+	assert (held == 1).all()
+	assert sequence == 1
+
+
+def test_latest_skips_to_the_newest_frame():
+	buffer = mdr.FrameBuffer(4, "block")
+	for value in range(1, 4):
+		produce(buffer, value)
+
+	(frame, sequence, timestamp) = buffer.get(latest=True)
+	assert (int(frame[0, 0, 0]), sequence, timestamp) == (3, 3, 3.0)
+	assert buffer.stats()['dropped'] == 2
+
+
+def test_closing_wakes_both_sides():
+	buffer = mdr.FrameBuffer(1, "block")
+	produce(buffer, 1)
+	blocked = []
+	producer = threading.Thread(target=lambda: blocked.append(produce(buffer, 2)))
+	producer.start()
+	buffer.close()
+	producer.join(5)
+
+	assert blocked == [False]
+	assert drain(buffer) == [1]
+	assert buffer.get() is None
+
+
+def test_bad_settings_are_refused():
+	with pytest.raises(ValueError):
+		mdr.FrameBuffer(0)
+	with pytest.raises(ValueError):
+		mdr.FrameBuffer(2, "drop-some")
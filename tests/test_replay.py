@@ -0,0 +1,39 @@
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+def replaySettings(video, zones, *options):
+	return mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"] + list(options))
+
+
+def test_decode_on_demand_replays_the_same_frames(crossing):
+	settings = replaySettings(*crossing, "--decode-on-demand", "--target-fps", "10", "--idle-fps", "4")
+	runs = [mdr.replay(settings, zone_blobs=True) for i in range(3)]
+
+	for report in runs[1:]:
+		assert report['frames'] == runs[0]['frames']
+		assert report['skipped'] == runs[0]['skipped']
+		assert report['zone_blobs'] == runs[0]['zone_blobs']
+		assert report['transitions'] == runs[0]['transitions']
+
+	# --target-fps 10 on a 20 fps file
+	assert runs[0]['frames'] == 80
+
+
+# The average rate since the start includes the stretches decoded at
+# --idle-fps, so it must not end up as the frame rate of the clips
+@pytest.mark.parametrize("options, expected", [([], 20), (["--target-fps", "10"], 10)])
+def test_clips_get_the_stream_frame_rate(crossing, tmp_path, monkeypatch, options, expected):
+	rates = []
+	openClip = mdr.ClipWriter.open
+	monkeypatch.setattr(mdr.ClipWriter, "open", lambda self, path, fps, *args: rates.append(fps) or openClip(self, path, fps, *args))
+	monkeypatch.setattr(mdr.SegmentStore, "update", lambda self, timestamp, fps, size: rates.append(fps))
+	monkeypatch.setattr(mdr.Frame, "fps", lambda self: 3.0)
+
+	report = mdr.replay(replaySettings(*crossing, "--decode-on-demand", "--idle-fps", "2", *options))
+	assert report['clips'] == 1
+	mdr.replay(replaySettings(*crossing, "--decode-on-demand", "--idle-fps", "2", "--dvr-dir", str(tmp_path), *options))
+
+	assert len(rates) > 1
+	assert set(rates) == {expected}
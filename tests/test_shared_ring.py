@@ -0,0 +1,109 @@
+import threading
+from multiprocessing import shared_memory
+
+import cv2
+import numpy
+import pytest
+
+import motion_detector_refactor as mdr
+
+
+@pytest.fixture
+def ring():
+	shape = (4, 4, 3)
+	memory = shared_memory.SharedMemory(create=True, size=mdr.SharedFrameRing.bytesNeeded(2, shape, "|u1"))
+	rings = []
+
+	def create(policy):
+		ring = mdr.SharedFrameRing(memory, threading.Condition(), 2, shape, "|u1", policy)
+		ring.counters[:] = 0
+		ring.states[:] = mdr.SharedFrameRing.FREE
+		rings.append(ring)
+		return ring
+
+	yield create
+	for ring in rings:
+		ring.release()
+	memory.close()
+	memory.unlink()
+
+
+def produce(ring, value):
+	index = ring.acquire()
+	ring.slots[index][...] = value
+	ring.commit(index, float(value))
+	return index
+
+
+def test_drop_oldest_reuses_the_oldest_queued_slot(ring):
+	ring = ring("drop-oldest")
+	first = produce(ring, 1)
+	produce(ring, 2)
+	assert produce(ring, 3) == first
+
+	values = [int(ring.get()[0][0, 0, 0]) for i in range(2)]
+	assert values == [2, 3]
+	assert ring.stats()['dropped'] == 1
+
+
+def test_drop_newest_decodes_into_the_scratch_slot(ring):
+	ring = ring("drop-newest")
+	produce(ring, 1)
+	produce(ring, 2)
+	assert produce(ring, 3) == ring.scratch
+
+	values = [int(ring.get()[0][0, 0, 0]) for i in range(2)]
+	assert values == [1, 2]
+	assert ring.stats()['dropped'] == 1
+
+
+# The slot handed out by get() is left alone until the next get(), and
+# queued slots come out in sequence order whatever slot they are in
+def test_the_held_slot_is_not_reused(ring):
+	ring = ring("drop-oldest")
+	produce(ring, 1)
+	(held, sequence, timestamp) = ring.get()
+	for value in range(2, 12):
+		produce(ring, value)
+
+	assert (held == 1).all()
+	(frame, sequence, timestamp) = ring.get()
+	assert (int(frame[0, 0, 0]), sequence, timestamp) == (10, 10, 10.0)
+	assert ring.get()[1] == 11
+
+
+def test_process_stream_frames_match_the_file(crossing):
+	(video, zones) = crossing
+	stream = mdr.ProcessStream(video, 4, "block").start()
+	capture = cv2.VideoCapture(video)
+	count = 0
+	while True:
+		captured = stream.read(5)
+		if captured is None:
+			break
+
+		(frame, sequence, timestamp) = captured
+		(success, expected) = capture.read()
+		assert success and numpy.array_equal(frame, expected)
+		count += 1
+		assert sequence == count
+
+	# Views into the block must be gone before it can be closed
+	frame = None
+	stream.stop()
+	assert count == 160
+	assert stream.stats()['consumed'] == 160
+
+
+# The shared block goes away with the stream, also when it is stopped
+# with frames still queued
+def test_process_stream_removes_its_segment(crossing):
+	(video, zones) = crossing
+	stream = mdr.ProcessStream(video, 4, "block").start()
+	name = stream.memory.name
+	stream.read(5)
+	stream.stop()
+	stream.stop()
+
+	with pytest.raises(FileNotFoundError):
+		shared_memory.SharedMemory(name=name)
@@ -0,0 +1,78 @@
+import json
+import os
+from fractions import Fraction
+
+import pytest
+
+import motion_detector_refactor as mdr
+
+av = pytest.importorskip("av")
+
+
+def replaySettings(video, zones, *options):
+	return mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"] + list(options))
+
+
+# (seconds from the start of the file, is keyframe) of every packet in 'path'
+def packets(path):
+	with av.open(path) as clip:
+		stream = clip.streams.video[0]
+		return [(float(packet.pts * packet.time_base), packet.is_keyframe) for packet in clip.demux(stream) if packet.size > 0]
+
+
+def test_clips_start_on_the_keyframe_before_the_pre_roll(h264, tmp_path):
+	(video, zones) = h264
+	recorder = mdr.PacketRecorder(video, seconds=1.0, replay=True, origin=0.0).start()
+	recorder.advance(3.2)
+	clip = recorder.open(str(tmp_path / "clip.mp4"))
+	recorder.advance(5.0)
+	recorder.stop()
+
+	assert clip['start'] == 2.0
+	found = packets(clip['path'])
+	assert found[0] == (0.0, True)
+	assert len(found) == recorder.written == 61
+	assert [offset for (offset, keyframe) in found if keyframe] == [0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0]
+
+
+def test_rotated_clips_continue_from_the_next_keyframe(h264, tmp_path):
+	(video, zones) = h264
+	recorder = mdr.PacketRecorder(video, seconds=0.0, replay=True, origin=0.0).start()
+	recorder.advance(1.0)
+	first = recorder.open(str(tmp_path / "first.mp4"))
+	recorder.advance(2.2)
+	second = recorder.rotate(str(tmp_path / "second.mp4"))
+	recorder.advance(4.0)
+	recorder.stop()
+
+	assert (first['start'], second['start']) == (1.0, 2.5)
+	assert len(packets(first['path'])) == 30
+	assert packets(second['path'])[0] == (0.0, True)
+	assert len(packets(second['path'])) == 31
+
+
+# The whole pipeline copies the event into one clip, with the overlays
+# written next to it instead of drawn on the frames
+def test_events_are_recorded_without_reencoding(h264, tmp_path):
+	(video, zones) = h264
+	settings = mdr.redirectOutput(replaySettings(video, zones, "--record-mode", "copy", "--overlay-sidecar", "-l", "1"), str(tmp_path / "output"))
+	tracker = mdr.MotionTracker(settings, mdr.NullDispatcher(), mdr.UploadSpool(settings['upload_spool'], {}))
+	tracker.run()
+
+	names = sorted(name for name in os.listdir(str(tmp_path / "output")) if not name.startswith(("spool", "keyframe")))
+	clips = [name for name in names if name.endswith(".mp4")]
+	assert len(clips) == 1
+	assert names.count(clips[0][:-4] + ".jsonl") == 1
+
+	found = packets(str(tmp_path / "output" / clips[0]))
+	assert found[0][1]
+	with av.open(str(tmp_path / "output" / clips[0])) as clip:
+		stream = clip.streams.video[0]
+		assert stream.codec_context.name == "h264"
+		assert stream.average_rate == Fraction(20)
+
+	with open(str(tmp_path / "output" / (clips[0][:-4] + ".jsonl"))) as sidecar:
+		lines = [json.loads(line) for line in sidecar]
+	assert len(lines) > 0
+	assert any(line['objects'] for line in lines)
+	assert all(line['offset'] >= 0 for line in lines)
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+import motion_detector_refactor as mdr
+
+
+def waitFor(condition, timeout=5.0):
+	deadline = time.time() + timeout
+	while not condition():
+		assert time.time() < deadline
+		time.sleep(0.01)
+
+
+def spool(path, **options):
+	return mdr.UploadSpool(str(path), {'file': mdr.DirectoryUploadBackend()}, 1, 1, **options)
+
+
+def clip(tmp_path, name="clip.avi"):
+	source = tmp_path / name
+	source.write_bytes(b"frames")
+	return str(source)
+
+
+def test_failed_uploads_are_retried(tmp_path):
+	destination = tmp_path / "uploaded"
+	destination.write_bytes(b"not a folder")
+	uploads = spool(tmp_path / "spool", backoff=0.2).start()
+	uploads.enqueue(clip(tmp_path), str(destination))
+	waitFor(lambda: uploads.stats()['retried'] == 1)
+
+	destination.unlink()
+	waitFor(lambda: uploads.stats()['uploaded'] == 1)
+	uploads.stop(5)
+
+	assert (destination / "clip.avi").read_bytes() == b"frames"
+	assert os.listdir(str(tmp_path / "spool")) == []
+
+
+def test_missing_files_are_given_up_on(tmp_path):
+	uploads = spool(tmp_path / "spool").start()
+	job_id = uploads.enqueue(str(tmp_path / "gone.avi"), str(tmp_path / "uploaded"))
+	waitFor(lambda: uploads.stats()['failed'] == 1)
+	uploads.stop(5)
+
+	assert os.listdir(str(tmp_path / "spool")) == [job_id + ".failed"]
+
+
+# Jobs queued, or being uploaded, when the process went away are picked
+# up by the next spool on the same folder
+def test_jobs_survive_a_restart(tmp_path):
+	spooled = spool(tmp_path / "spool")
+	spooled.enqueue(clip(tmp_path, "first.avi"), str(tmp_path / "uploaded"))
+	second = spooled.enqueue(clip(tmp_path, "second.avi"), str(tmp_path / "uploaded"))
+	os.replace(str(tmp_path / "spool" / (second + ".job")), str(tmp_path / "spool" / (second + ".work")))
+
+	uploads = spool(tmp_path / "spool").start()
+	waitFor(lambda: uploads.stats()['uploaded'] == 2)
+	uploads.stop(5)
+
+	assert sorted(os.listdir(str(tmp_path / "uploaded"))) == ["first.avi", "second.avi"]
+
+
+# Whether another thread can take 'lock' right now
+def lockIsFree(lock):
+	free = []
+
+	def probe():
+		if lock.acquire(timeout=0.1):
+			lock.release()
+			free.append(True)
+
+	thread = threading.Thread(target=probe)
+	thread.start()
+	thread.join()
+	return free == [True]
+
+
+# Job files are fsynced, which can take a while; neither the thread queuing
+# a job nor a worker putting a failed one back holds the lock meanwhile
+def test_job_files_are_written_without_the_lock(tmp_path, monkeypatch):
+	uploads = spool(tmp_path / "spool", backoff=60)
+	writes = []
+	write = uploads.write
+	monkeypatch.setattr(uploads, "write", lambda *args: writes.append((args[2], lockIsFree(uploads.condition))) or write(*args))
+
+	destination = tmp_path / "uploaded"
+	destination.write_bytes(b"not a folder")
+	uploads.enqueue(clip(tmp_path), str(destination))
+	uploads.start()
+	waitFor(lambda: uploads.stats()['retried'] == 1)
+	uploads.stop(5)
+
+	assert writes == [(".job", True), (".job", True)]
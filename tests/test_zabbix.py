@@ -0,0 +1,228 @@
+import json
+import socket
+import stat
+import struct
+import threading
+import time
+
+import motion_detector_refactor as mdr
+
+
+# A Zabbix trapper that answers every sender request and closes the
+# connection, like the real server. 'failed' values of each request are
+# reported as refused. Without 'answer' it reads requests and hangs up.
+class FakeTrapper:
+	def __init__(self, failed=0, answer=True):
+		self.failed = failed
+		self.answer = answer
+		self.requests = []
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(("127.0.0.1", 0))
+		self.server.listen(5)
+		self.port = self.server.getsockname()[1]
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def receive(self, connection, size):
+		data = b""
+		while len(data) < size:
+			chunk = connection.recv(size - len(data))
+			if not chunk:
+				raise EOFError()
+			data += chunk
+
+		return data
+
+	def serve(self):
+		while True:
+			try:
+				(connection, address) = self.server.accept()
+			except OSError:
+				return
+
+			with connection:
+				try:
+					header = self.receive(connection, 13)
+					request = json.loads(self.receive(connection, struct.unpack("<Q", header[5:])[0]).decode("utf-8"))
+				except EOFError:
+					continue
+
+				self.requests.append(request)
+				if not self.answer:
+					continue
+
+				count = len(request['data'])
+				info = "processed: %d; failed: %d; total: %d; seconds spent: 0.000100" % (count - self.failed, self.failed, count)
+				body = json.dumps({'response': "success", 'info': info}).encode("utf-8")
+				connection.sendall(mdr.ZabbixDispatcher.HEADER + struct.pack("<Q", len(body)) + body)
+
+	def values(self):
+		return [(item['host'], item['key'], item['value']) for request in self.requests for item in request['data']]
+
+	def close(self):
+		self.server.close()
+
+
+def waitFor(condition, timeout=5.0):
+	deadline = time.time() + timeout
+	while not condition():
+		assert time.time() < deadline
+		time.sleep(0.01)
+
+
+def closedPort():
+	probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	probe.bind(("127.0.0.1", 0))
+	port = probe.getsockname()[1]
+	probe.close()
+	return port
+
+
+def test_values_reach_the_trapper_in_order():
+	trapper = FakeTrapper()
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port).start()
+	dispatcher.send("mdect.yard", 1, clock=100.5)
+	dispatcher.send("mdect.band", 1, clock=101.0)
+	dispatcher.send("mrec.yard", 0, clock=102.0)
+	dispatcher.send("mrec.yard", 1, clock=103.0, host="other")
+	dispatcher.stop(5)
+	trapper.close()
+
+	assert trapper.values() == [("camera", "mdect.yard", "1"), ("camera", "mdect.band", "1"), ("camera", "mrec.yard", "0"), ("other", "mrec.yard", "1")]
+	first = trapper.requests[0]['data'][0]
+	assert (first['clock'], first['ns']) == (100, 500000000)
+	stats = dispatcher.stats()
+	assert (stats['sent'], stats['failed'], stats['fallbacks'], stats['pending']) == (4, 0, 0, 0)
+
+
+def test_repeated_values_are_coalesced():
+	trapper = FakeTrapper()
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port)
+	assert dispatcher.send("mdect.yard", 1)
+	assert not dispatcher.send("mdect.yard", 1)
+	assert dispatcher.send("mdect.yard", 1, host="other")
+	dispatcher.start().stop(5)
+	trapper.close()
+
+	assert trapper.values() == [("camera", "mdect.yard", "1"), ("other", "mdect.yard", "1")]
+	assert dispatcher.stats()['coalesced'] == 1
+
+
+def test_flips_of_a_waiting_value_collapse_to_the_latest():
+	trapper = FakeTrapper()
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port)
+	assert dispatcher.send("mdect.yard", 1, clock=100.0)
+	assert dispatcher.send("mdect.band", 1, clock=100.5)
+	assert dispatcher.send("mdect.yard", 0, clock=101.0)
+	assert dispatcher.send("mdect.yard", 1, clock=102.0)
+	dispatcher.start().stop(5)
+	trapper.close()
+
+	assert trapper.values() == [("camera", "mdect.yard", "1"), ("camera", "mdect.band", "1")]
+	assert trapper.requests[0]['data'][0]['clock'] == 102
+	assert dispatcher.stats()['coalesced'] == 2
+
+
+def test_delivered_values_are_coalesced():
+	trapper = FakeTrapper()
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port).start()
+	dispatcher.send("mdect.yard", 1)
+	waitFor(lambda: dispatcher.stats()['sent'] == 1)
+	assert not dispatcher.send("mdect.yard", 1)
+	assert dispatcher.send("mdect.yard", 0)
+	dispatcher.stop(5)
+	trapper.close()
+
+	assert trapper.values() == [("camera", "mdect.yard", "1"), ("camera", "mdect.yard", "0")]
+
+
+def test_dropped_values_are_not_coalesced():
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", closedPort(), max_pending=2)
+	dispatcher.send("mrec.yard", 1)
+	dispatcher.send("a", 1)
+	dispatcher.send("b", 1)
+	assert dispatcher.send("mrec.yard", 1)
+	assert dispatcher.stats()['coalesced'] == 0
+
+
+def test_undelivered_values_are_not_coalesced(tmp_path):
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", closedPort(), timeout=1.0, sender=str(tmp_path / "missing")).start()
+	dispatcher.send("mrec.yard", 1)
+	waitFor(lambda: dispatcher.stats()['failed'] == 1)
+	assert dispatcher.send("mrec.yard", 1)
+	dispatcher.stop(10)
+	assert dispatcher.stats()['failed'] == 2
+
+
+def test_a_written_batch_is_not_sent_again(tmp_path):
+	trapper = FakeTrapper(answer=False)
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port, sender=str(tmp_path / "missing")).start()
+	dispatcher.send("mdect.yard", 1)
+	dispatcher.send("mdect.band", 1)
+	dispatcher.stop(5)
+	trapper.close()
+
+	assert len(trapper.requests) == 1
+	stats = dispatcher.stats()
+	assert (stats['sent'], stats['failed'], stats['fallbacks']) == (0, 2, 0)
+
+
+def test_values_are_sent_in_batches():
+	trapper = FakeTrapper()
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port, batch_size=4)
+	for n in range(10):
+		dispatcher.send("item" + str(n), n)
+	dispatcher.start().stop(5)
+	trapper.close()
+
+	assert [len(request['data']) for request in trapper.requests] == [4, 4, 2]
+	assert dispatcher.stats()['sent'] == 10
+
+
+def test_queue_is_bounded():
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", closedPort(), max_pending=3)
+	for n in range(5):
+		dispatcher.send("item" + str(n), n)
+
+	stats = dispatcher.stats()
+	assert (stats['pending'], stats['queued'], stats['dropped']) == (3, 5, 2)
+	assert [item[1] for item in dispatcher.pending] == ["item2", "item3", "item4"]
+
+
+def test_refused_values_are_counted():
+	trapper = FakeTrapper(failed=1)
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", trapper.port).start()
+	dispatcher.send("mdect.yard", 1)
+	dispatcher.send("mdect.band", 1)
+	dispatcher.stop(5)
+	trapper.close()
+
+	stats = dispatcher.stats()
+	assert (stats['sent'], stats['failed']) == (1, 1)
+
+
+def test_unreachable_trapper_falls_back_to_zabbix_sender(tmp_path):
+	# A zabbix_sender stand-in that keeps a copy of its batch file
+	copy = tmp_path / "batch.txt"
+	sender = tmp_path / "zabbix_sender"
+	sender.write_text("#!/bin/sh\nwhile [ $# -gt 0 ]; do if [ \"$1\" = -i ]; then cp \"$2\" " + str(copy) + "; fi; shift; done\n")
+	sender.chmod(sender.stat().st_mode | stat.S_IEXEC)
+
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", closedPort(), timeout=1.0, sender=str(sender)).start()
+	dispatcher.send("mdect.yard", 1, clock=100.0)
+	dispatcher.send("mdect.band", 'say "hi"', clock=101.0)
+	dispatcher.stop(10)
+
+	assert copy.read_text().splitlines() == ['"camera" "mdect.yard" 100 "1"', '"camera" "mdect.band" 101 "say \\"hi\\""']
+	stats = dispatcher.stats()
+	assert (stats['sent'], stats['fallbacks'], stats['failed']) == (2, 1, 0)
+
+
+def test_failed_fallback_is_counted(tmp_path):
+	dispatcher = mdr.ZabbixDispatcher("127.0.0.1", "camera", closedPort(), timeout=1.0, sender=str(tmp_path / "missing")).start()
+	dispatcher.send("mdect.yard", 1)
+	dispatcher.stop(10)
+
+	stats = dispatcher.stats()
+	assert (stats['sent'], stats['failed'], stats['fallbacks']) == (0, 1, 1)
@@ -0,0 +1,40 @@
+import cv2
+import numpy
+import pytest
+
+import motion_detector_refactor as mdr
+from conftest import writeVideo, writeZones
+
+
+# An object that visits the first zone for a moment, stays, leaves for
+# less than the cooldown and comes back, then leaves for good, while
+# something passes through the second zone. Everything keeps moving so the
+# background never takes it in.
+@pytest.fixture
+def visits(tmp_path):
+	rng = numpy.random.default_rng(2)
+	background = (rng.random((360, 640, 3)) * 60 + 80).astype(numpy.uint8)
+	frames = []
+	for i in range(220):
+		frame = background.copy()
+		if 20 <= i < 25 or 40 <= i < 90 or 100 <= i < 125:
+			x = 120 + (i % 10) * 4
+			cv2.rectangle(frame, (x, 130), (x + 40, 180), (20, 20, 220), -1)
+		if 60 <= i < 160:
+			x = 360 + (i - 60) * 2
+			cv2.rectangle(frame, (x, 230), (x + 30, 270), (220, 220, 20), -1)
+		frames.append(frame)
+
+	video = writeVideo(str(tmp_path / "visits.avi"), frames)
+	zones = writeZones(str(tmp_path / "zones.json"), [("Porch", (100, 100, 150, 150)), ("Drive", (350, 200, 250, 100))])
+	return (video, zones)
+
+
+def test_zone_engines_agree(visits, capsys):
+	(video, zones) = visits
+	settings = mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"])
+	assert mdr.checkZoneEngine(settings)
+
+	output = capsys.readouterr().out
+	assert "PASS" in output
+	assert "(active, continuation, cooldown, inactive, monitor)" in output
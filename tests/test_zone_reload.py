@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+
+import pytest
+
+import motion_detector_refactor as mdr
+from conftest import writeZones
+
+
+def replaySettings(video, zones, *options):
+	return mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"] + list(options))
+
+
+# Save 'zones' the way editors do: write a new file and rename it over the old one
+def saveZones(path, zones):
+	writeZones(path + ".tmp", zones)
+	os.replace(path + ".tmp", path)
+
+
+@pytest.fixture(params=["inotify", "mtime"])
+def watch(request, tmp_path, monkeypatch):
+	if request.param == "mtime":
+		monkeypatch.setattr(mdr.FileWatcher, "inotify", lambda self: None)
+
+	path = str(tmp_path / "zones.json")
+	writeZones(path, [("Door", (300, 120, 120, 120))])
+	changed = threading.Event()
+	watcher = mdr.FileWatcher(path, lambda path: changed.set(), 0.05).start()
+	yield (path, changed)
+	watcher.stop()
+
+
+def test_saving_the_zones_file_is_noticed(watch, tmp_path):
+	(path, changed) = watch
+	# Give the watcher the time to take its first look
+	assert not changed.wait(0.2)
+	(tmp_path / "other.json").write_text("{}")
+	assert not changed.wait(0.2)
+
+	saveZones(path, [("Door", (300, 120, 100, 100))])
+	assert changed.wait(2)
+
+
+@pytest.fixture
+def tracker(crossing, tmp_path):
+	(video, zones) = crossing
+	settings = mdr.redirectOutput(replaySettings(video, zones, "--crop-to-zones"), str(tmp_path / "output"))
+	tracker = mdr.MotionTracker(settings, mdr.NullDispatcher(), mdr.UploadSpool(settings['upload_spool'], {}))
+	tracker.transitions = []
+	yield tracker
+	tracker.finish()
+
+
+def stepUntil(tracker, name, state):
+	while not tracker.zones[name].state.state == state:
+		assert tracker.step()
+
+
+# Zones that keep their name keep their state and the background stays as
+# it is; new zones start inactive and removed ones are let go of
+def test_reloading_keeps_the_state_of_unchanged_zones(tracker, monkeypatch):
+	path = tracker.settings['polygon_json']
+	stepUntil(tracker, "Door", mdr.Zone.ACTIVE)
+	state = tracker.zones["Door"].state
+	region = tracker.frame.region
+	resets = []
+	monkeypatch.setattr(tracker.background, "reset", lambda frame: resets.append(frame))
+
+	saveZones(path, [("Door", (300, 120, 120, 120)), ("Gate", (20, 20, 80, 80))])
+	tracker.reloadZones(path)
+	assert tracker.step()
+
+	assert sorted(tracker.zones) == ["Door", "Gate"]
+	assert tracker.zones["Door"].state is state
+	assert tracker.zones["Door"].state.state in (mdr.Zone.ACTIVE, mdr.Zone.COOLDOWN)
+	assert tracker.zones["Gate"].state.state == mdr.Zone.INACTIVE
+	assert resets == []
+	assert not tracker.frame.region == region
+
+	saveZones(path, [("Gate", (20, 20, 80, 80))])
+	tracker.reloadZones(path)
+	assert tracker.step()
+
+	assert list(tracker.zones) == ["Gate"]
+	assert tracker.transitions[-1]['zone'] == "Door" and tracker.transitions[-1]['state'] == "inactive"
+
+
+def test_a_broken_zones_file_keeps_the_current_zones(tracker):
+	path = tracker.settings['polygon_json']
+	zones = tracker.zones
+	with open(path, "w") as handle:
+		handle.write('{"zones": ')
+
+	tracker.reloadZones(path)
+	assert tracker.step()
+	assert tracker.zones is zones
+
+	with open(path, "w") as handle:
+		json.dump({'zones': {'1': {'name': "Door"}}}, handle)
+
+	tracker.reloadZones(path)
+	assert tracker.step()
+	assert tracker.zones is zones
@@ -0,0 +1,74 @@
+import types
+
+import cv2
+import pytest
+
+import motion_detector_refactor as mdr
+from conftest import writeVideo
+
+
+def replaySettings(video, zones, *options):
+	return mdr.parseArguments(["--video", video, "-j", zones, "-a", "100"] + list(options))
+
+
+# Just enough of a MotionTracker for Zone to report its transitions
+def tracker():
+	frame = types.SimpleNamespace(timestamp=0.0, sequence=0)
+	return types.SimpleNamespace(settings={'zabbix_name': "camera"}, zabbix=mdr.NullDispatcher(), timings=None, transitions=[], index=None, frame=frame)
+
+
+def zone(tracker, warmup=1, cooldown=1):
+	attrs = {'name': "Door", 'points': [{'x': 0, 'y': 0}, {'x': 100, 'y': 0}, {'x': 100, 'y': 100}, {'x': 0, 'y': 100}], 'warmup': str(warmup), 'cooldown': str(cooldown), 'continuation': 3, 'minimum_x': 10, 'minimum_y': 10}
+	return mdr.Zone(attrs, (1.0, 1.0), tracker)
+
+
+# Feed 'zone' one frame per (timestamp, hit) and return the state after each
+def play(zone, frames):
+	states = []
+	for (timestamp, hit) in frames:
+		zone.tracker.frame.timestamp = timestamp
+		if hit:
+			zone.registerObject(10, 10, 50, 50, 35, 35, 2500, timestamp)
+		states.append(zone.endFrame(timestamp))
+	return states
+
+
+# Warmup takes a second of capture time, however many frames that is
+@pytest.mark.parametrize("fps", [20, 5, 1.25])
+def test_warmup_is_measured_in_seconds(fps):
+	frames = [(n / fps, True) for n in range(int(fps * 2) + 1)]
+	states = play(zone(tracker()), frames)
+
+	active = frames[states.index(mdr.Zone.ACTIVE)][0]
+	assert 1.0 <= active < 1.0 + 1 / fps
+
+
+# A gap in the frames, as when capture drops them, counts for its length
+def test_cooldown_covers_dropped_frames():
+	states = play(zone(tracker()), [(0.0, True), (0.5, True), (1.0, True), (1.1, False), (1.3, False), (2.2, False)])
+	assert states == [mdr.Zone.MONITOR, mdr.Zone.MONITOR, mdr.Zone.ACTIVE, mdr.Zone.COOLDOWN, mdr.Zone.COOLDOWN, mdr.Zone.INACTIVE]
+
+	states = play(zone(tracker()), [(0.0, True), (0.5, True), (1.0, True)] + [(1.0 + n * 0.05, False) for n in range(1, 20)])
+	assert states[-1] == mdr.Zone.COOLDOWN
+
+
+# The same scene recorded at half the frame rate changes zone state at
+# the same capture times, give or take a frame
+def test_transitions_keep_their_times_at_a_lower_frame_rate(crossing, tmp_path):
+	(video, zones) = crossing
+	capture = cv2.VideoCapture(video)
+	frames = []
+	while True:
+		(success, frame) = capture.read()
+		if not success:
+			break
+		frames.append(frame)
+
+	halved = writeVideo(str(tmp_path / "halved.avi"), frames[::2], fps=10)
+	full = mdr.replay(replaySettings(video, zones))['transitions']
+	half = mdr.replay(replaySettings(halved, zones))['transitions']
+
+	assert [(change['zone'], change['state']) for change in half] == [(change['zone'], change['state']) for change in full]
+	assert "active" in [change['state'] for change in full]
+	for (a, b) in zip(full, half):
+		assert abs(a['time'] - b['time']) <= 0.1 + 1e-6